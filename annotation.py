@@ -1,6 +1,7 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional
 import functools
 import json
+from interval import IntervalIndex
 
 
 class Annotation:
@@ -39,6 +40,49 @@ def sort_annotations(annotations, ascend=True) -> List[Annotation]:
     return sorted(annotations, key=functools.cmp_to_key(cmp), reverse=(not ascend))
 
 
+def overlap_pairs(
+    anns1: List[Annotation], anns2: Optional[List[Annotation]] = None, first=False
+) -> List[Tuple[int, int]]:
+    """
+    找出重叠(与Annotation.overlap相同)的标注的下标对(i, j)，按下标排序：
+    - anns2为None时找anns1中两两重叠的标注，i < j
+    - 否则i为anns1中的下标，j为anns2中的下标
+    一个标注的终止帧落在另一个标注的[f0, f1]内时两者重叠，f0 > f1的标注的范围为空，
+    但它的终止帧仍然可能落在别的标注内。按帧号扫描端点，维护当前帧所在的范围，
+    first为True时找到一对就返回。复杂度O(n log n + k)，k为重叠的对数
+    """
+    lists = [anns1] if anns2 is None else [anns1, anns2]
+    # 同一帧上先加入范围，再查询终止帧，最后移除范围
+    START, POINT, END = range(3)
+    events = []
+    for s, anns in enumerate(lists):
+        for i, ann in enumerate(anns):
+            events.append((ann.f1, POINT, s, i))
+            if ann.f0 <= ann.f1:
+                events.append((ann.f0, START, s, i))
+                events.append((ann.f1, END, s, i))
+    events.sort()
+    active = [{} for _ in lists]  # 每个列表中包含当前帧的标注的下标
+    pairs = set()
+    for _, tp, s, i in events:
+        if tp == START:
+            active[s][i] = None
+        elif tp == END:
+            del active[s][i]
+        else:
+            for j in active[len(lists) - 1 - s]:
+                if anns2 is None:
+                    if i == j:
+                        continue
+                    pair = (min(i, j), max(i, j))
+                else:
+                    pair = (i, j) if s == 0 else (j, i)
+                if first:
+                    return [pair]
+                pairs.add(pair)
+    return sorted(pairs)
+
+
 class EventGroup:
     def __init__(self, group_name, meta) -> None:
         self.group_name = group_name
@@ -65,9 +109,18 @@ class AnnotationManager:
     def __init__(self, event_groups: Dict[str, EventGroup]) -> None:
         self.event_groups = event_groups
         self.annotations: Dict[str, List[Annotation]] = {}
+        # 每个group的区间索引，用于查询覆盖某一帧的标注
+        self.indexes: Dict[str, IntervalIndex] = {}
+        self.version = 0  # 标注每次改变时加1
         self.comments = {}
         for k in event_groups.keys():
-            self.annotations[k] = []
+            self.indexes[k] = IntervalIndex()
+            self.set_annotations(k, [])
+
+    def set_annotations(self, group_name, anns: List[Annotation]):
+        self.annotations[group_name] = anns
+        self.indexes[group_name].reset(anns)
+        self.version += 1
 
     @classmethod
     def from_json(cls, path):
@@ -102,6 +155,8 @@ class AnnotationManager:
         e = Annotation(event_name, type)
         e.f0, e.f1 = start_frame, end_frame
         self.annotations[group.group_name].append(e)
+        self.indexes[group.group_name].invalidate()
+        self.version += 1
 
     def parse_annotations(self, s: str):
         self.clear_annotations()
@@ -126,11 +181,11 @@ class AnnotationManager:
         keys = list(self.annotations.keys())
         self.comments = {}
         for k in keys:
-            self.annotations[k] = []
+            self.set_annotations(k, [])
 
     def sort(self):
-        for k, ann in self.annotations.items():
-            self.annotations[k] = sort_annotations(ann)
+        for k, ann in list(self.annotations.items()):
+            self.set_annotations(k, sort_annotations(ann))
 
     def save(self, path):
         self.sort()
@@ -148,10 +203,8 @@ class AnnotationManager:
     def check_overlap_conflict(self):
         for group_name, ann in self.annotations.items():
             if not self.event_groups[group_name].allow_overlap:
-                for i in range(len(ann)):
-                    for j in range(i + 1, len(ann)):
-                        if ann[i].overlap(ann[j]):
-                            return True
+                if overlap_pairs(ann, first=True):
+                    return True
         return False
     
     def modify_annotation(self, group_name, idx, event_name, start_frame, end_frame):
@@ -164,12 +217,44 @@ class AnnotationManager:
         else:
             if start_frame == end_frame:
                 anns[idx].f0, anns[idx].f1 = start_frame, end_frame
+        self.indexes[group_name].invalidate()
+        self.version += 1
 
     def remove_annotations(self, group_name, indexes: List[int]):
         anns = self.annotations[group_name]
         to_remove = set(indexes)
         anns = [ann for i, ann in enumerate(anns) if i not in to_remove]
-        self.annotations[group_name] = anns
+        self.set_annotations(group_name, anns)
+
+    def covering(self, group_name, frame_id) -> tuple:
+        """
+        group中包含frame_id的标注
+        """
+        return self.indexes[group_name].covering(frame_id)
+
+    def span(self, frame_id):
+        """
+        与frame_id在每个group中包含它的标注都相同的帧的范围[lo, hi)，没有边界的一侧为None
+        """
+        lo, hi = None, None
+        for index in self.indexes.values():
+            l, h = index.span(frame_id)
+            if l is not None and (lo is None or l > lo):
+                lo = l
+            if h is not None and (hi is None or h < hi):
+                hi = h
+        return lo, hi
+
+    def next_boundary(self, frame_id):
+        """
+        frame_id之后第一个使某个group中包含当前帧的标注发生变化的帧，没有时为None
+        """
+        result = None
+        for index in self.indexes.values():
+            b = index.next_boundary(frame_id)
+            if b is not None and (result is None or b < result):
+                result = b
+        return result
 
     def annotations_tuple_list(self):
         result = {}
@@ -0,0 +1,485 @@
+"""
+不依赖Qt的解码基准测试：用cv2.VideoWriter生成不同分辨率和GOP长度的视频，
+代替window.Thread通过队列和共享的消息环直接驱动视频进程，测量
+- 暂停时跳转的延迟(分位数)
+- 各个倍速下不限速消费时持续的帧率
+- 每显示一帧解码的帧数(包括解码进程中解码的帧)
+- 收到的每一帧的内容是否是请求的帧(synth_frame在帧中写入了帧号)
+- 视频进程、解码进程和本进程的CPU时间
+结果保存为JSON，使用--baseline与之前的结果比较
+
+python bench.py --out bench.json
+python bench.py --out new.json --baseline bench.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import cv2
+import numpy as np
+import constants
+from channel import Channel
+from keyframe import KeyframeIndex
+from msg import Msg, MsgType as msgtp
+from shm import attach_shm, release_shm
+
+
+DEFAULT_VIDEOS = "640x360:1,640x360:12,1280x720:12,1920x1080:12,1920x1080:250"
+DEFAULT_RATES = "1,4,8,-1,-8"
+
+
+def synth_frame(i, yy, xx):
+    """
+    缓慢移动的渐变加上表示帧号的色块，编码器不会在每一帧插入关键帧
+    """
+    h, w = yy.shape
+    img = np.empty((h, w, 3), np.uint8)
+    img[..., 0] = (xx + i * 3) % 256
+    img[..., 1] = (yy * 2 + i) % 256
+    img[..., 2] = ((xx + yy) // 4 + i * 5) % 256
+    bw = max(w // 16, 1)
+    for b in range(16):
+        img[: h // 8, b * bw : (b + 1) * bw] = 255 if (i >> b) & 1 else 0
+    return img
+
+
+def synth_frame_id(img):
+    """
+    从synth_frame生成的帧(可能经过缩放)中读出帧号
+    """
+    h, w = img.shape[:2]
+    bw = w / 16
+    frame_id = 0
+    for b in range(16):
+        x0, x1 = int(b * bw + bw / 4), int((b + 1) * bw - bw / 4)
+        if img[h // 32 : h // 10, x0 : max(x1, x0 + 1)].mean() > 127:
+            frame_id |= 1 << b
+    return frame_id
+
+
+def write_video(path, width, height, gop, frames, fps, ffmpeg=None) -> bool:
+    """
+    cv2.VideoWriter只能生成GOP为1(MJPG)或12(mp4v)的视频，
+    其它GOP长度先用mp4v写出再用ffmpeg重新编码，没有ffmpeg时返回False
+    """
+    if gop not in (1, 12) and ffmpeg is None:
+        return False
+    tmp_path = path if gop in (1, 12) else path + ".tmp.avi"
+    fourcc = "MJPG" if gop == 1 else "mp4v"
+    writer = cv2.VideoWriter(
+        tmp_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height)
+    )
+    if not writer.isOpened():
+        return False
+    yy, xx = np.mgrid[0:height, 0:width]
+    for i in range(frames):
+        writer.write(synth_frame(i, yy, xx))
+    writer.release()
+    if tmp_path == path:
+        return True
+    cmd = [
+        ffmpeg, "-y", "-loglevel", "error", "-i", tmp_path,
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+        path,
+    ]  # fmt: skip
+    try:
+        subprocess.run(cmd, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    finally:
+        os.remove(tmp_path)
+    return True
+
+
+def fn_proc_video(q_frame, q_cmd, ctrl_arr, q_result, workers):
+    # 不使用磁盘缓存，每次测量的都是真正的解码
+    constants.Config.DECODER_WORKERS = workers
+    constants.Config.PROXY_CACHE_GB = 0
+    from video import Video
+
+    video = Video(q_frame, q_cmd, ctrl_arr)
+    video.run()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # 解码进程已经在shutdown中join
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    q_result.put(
+        {
+            "decoded": video.decoder.decoded + video.pool_decoded,
+            "cpu_video": usage.ru_utime + usage.ru_stime,
+            "cpu_workers": children.ru_utime + children.ru_stime,
+        }
+    )
+
+
+class HeadlessView:
+    """
+    代替window.Thread：按同样的协议打开视频、发送READ，收到帧之后检查帧号并立即ack，
+    不限速消费
+    """
+
+    def __init__(self, workers, display_size) -> None:
+        self.q_frame = mp.Queue()
+        self.q_cmd = mp.Queue()
+        self.q_result = mp.Queue()
+        ctrl_arr = Channel.alloc()
+        self.channel = Channel(ctrl_arr)
+        self.proc = mp.Process(
+            target=fn_proc_video,
+            args=(self.q_frame, self.q_cmd, ctrl_arr, self.q_result, workers),
+        )
+        self.proc.start()
+        self.v_id = 0
+        self.shm_cap = 1
+        self.total_frames = 0
+        self.shm = None
+        self.shm_mat = None
+        self.kf_index = None
+        self.wrong_frames = []  # (请求的帧号, 收到的帧中的帧号)
+        self.cpu_start = time.process_time()
+        self.q_cmd.put(Msg(msgtp.RESIZE, self.v_id, display_size), block=False)
+
+    def open(self, path, timeout=120):
+        t = time.perf_counter()
+        self.q_cmd.put(Msg(msgtp.OPEN, self.v_id, path), block=False)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                msg = self.q_frame.get(timeout=Channel.WAKE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if msg.type != msgtp.VIDEO_OPEN_ACK:
+                continue
+            self.v_id, name, self.shm_cap, _, shape, dtype, meta = msg.data
+            self.total_frames = meta.total_frames
+            self.shm = attach_shm(name)
+            self.shm_mat = np.ndarray(
+                (self.shm_cap, *shape), dtype=dtype, buffer=self.shm.buf
+            )
+            self.kf_index = KeyframeIndex.load(path)
+            self.q_cmd.put(Msg(msgtp.OPEN_ACK, self.v_id, None), block=False)
+            return time.perf_counter() - t
+        raise TimeoutError(f"open {path}")
+
+    def read(self, start, length, rate):
+        epoch = self.channel.bump_epoch()
+        self.q_cmd.put(
+            Msg(msgtp.READ, self.v_id, (start, length, rate, epoch)), block=False
+        )
+
+    def expected_id(self, frame_id, rate):
+        """
+        倍速不低于KEYFRAME_SKIP_RATE并且有关键帧码流时显示的是之前最近的关键帧
+        """
+        if (
+            abs(rate) >= constants.Config.KEYFRAME_SKIP_RATE
+            and self.kf_index is not None
+            and self.kf_index.stream is not None
+        ):
+            return self.kf_index.keyframe_before(frame_id)
+        return frame_id
+
+    def read_ring(self):
+        frame_ids = []
+        while True:
+            msg = self.channel.peek()
+            if msg is None:
+                break
+            self.channel.pop()
+            if msg.type != msgtp.VIDEO_FRAMES:
+                continue
+            v_id, frame_id, rate, shm_id, cnt = msg.data
+            if v_id != self.v_id:
+                continue
+            last = self.total_frames - 1
+            for i in range(cnt):
+                fid = min(max(frame_id + i * rate, 0), last)
+                got = synth_frame_id(self.shm_mat[(shm_id + i) % self.shm_cap])
+                if got != self.expected_id(fid, rate):
+                    self.wrong_frames.append((fid, got))
+                frame_ids.append(fid)
+            self.channel.ack(self.v_id, (shm_id + cnt) % self.shm_cap)
+            if self.channel.take_sleeping(Channel.VIDEO):
+                self.q_cmd.put(Msg(msgtp.WAKE, self.v_id, None), block=False)
+        return frame_ids
+
+    def poll(self):
+        """
+        与Thread.read_msgs相同：没有帧时设置标志之后阻塞在队列上等待唤醒
+        """
+        frame_ids = self.read_ring()
+        if frame_ids:
+            return frame_ids
+        self.channel.set_sleeping(Channel.THREAD, True)
+        frame_ids = self.read_ring()
+        if not frame_ids:
+            try:
+                while True:
+                    # 缩略图等其它消息直接丢弃
+                    self.q_frame.get(timeout=Channel.WAKE_TIMEOUT)
+                    if self.channel.peek() is not None:
+                        break
+            except queue.Empty:
+                pass
+        self.channel.set_sleeping(Channel.THREAD, False)
+        return frame_ids + self.read_ring()
+
+    def seek(self, frame_id, timeout=30):
+        """
+        暂停时跳转，返回收到这一帧的耗时
+        """
+        t = time.perf_counter()
+        self.read(frame_id, 1, 1)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if frame_id in self.poll():
+                return time.perf_counter() - t
+        raise TimeoutError(f"seek {frame_id}")
+
+    def play(self, start, rate, count, timeout=120):
+        """
+        从start开始按rate请求count帧，返回收到的帧的时间
+        """
+        self.read(start, (count - 1) * abs(rate) + 1, rate)
+        times = []
+        deadline = time.time() + timeout
+        while len(times) < count and time.time() < deadline:
+            for frame_id in self.poll():
+                times.append(time.perf_counter())
+                edge = self.total_frames - 1 if rate > 0 else 0
+                if frame_id == edge:
+                    count = len(times)
+        return times
+
+    def close(self):
+        self.q_cmd.put(Msg(msgtp.CLOSE, self.v_id, None), block=False)
+        # 视频进程退出时要把队列中的消息全部写入管道，一直读取q_frame直到它退出
+        deadline = time.time() + 60
+        result = None
+        while self.proc.is_alive() and time.time() < deadline:
+            try:
+                while True:
+                    self.q_frame.get_nowait()
+            except queue.Empty:
+                pass
+            if result is None:
+                try:
+                    result = self.q_result.get(timeout=Channel.WAKE_TIMEOUT)
+                except queue.Empty:
+                    pass
+            else:
+                self.proc.join(Channel.WAKE_TIMEOUT)
+        if result is None:
+            result = self.q_result.get(timeout=1)
+        self.proc.join()
+        self.shm_mat = None
+        if self.shm is not None:
+            release_shm(self.shm)
+            self.shm = None
+        result["wrong_frames"] = len(self.wrong_frames)
+        result["cpu_client"] = time.process_time() - self.cpu_start
+        return result
+
+
+def percentiles(values_ms):
+    arr = np.asarray(values_ms, dtype=np.float64)
+    return {
+        "count": int(len(arr)),
+        "mean": float(arr.mean()),
+        "p50": float(np.percentile(arr, 50)),
+        "p90": float(np.percentile(arr, 90)),
+        "p99": float(np.percentile(arr, 99)),
+        "max": float(arr.max()),
+    }
+
+
+def cpu_stats(result):
+    return {k[4:]: round(v, 3) for k, v in result.items() if k.startswith("cpu_")}
+
+
+def bench_seek(path, args):
+    view = HeadlessView(args.workers, args.display)
+    open_sec = view.open(path)
+    rng = np.random.default_rng(args.seed)
+    targets = rng.integers(0, view.total_frames, args.seeks)
+    latencies = [view.seek(int(f)) * 1000 for f in targets]
+    result = view.close()
+    stats = {"open_ms": open_sec * 1000, "latency_ms": percentiles(latencies)}
+    stats["decoded_per_seek"] = result["decoded"] / len(targets)
+    stats["wrong_frames"] = result["wrong_frames"]
+    stats["cpu_sec"] = cpu_stats(result)
+    return stats
+
+
+def bench_play(path, rate, args):
+    view = HeadlessView(args.workers, args.display)
+    view.open(path)
+    start = 0 if rate > 0 else view.total_frames - 1
+    count = min(args.play_frames, (view.total_frames - 1) // abs(rate) + 1)
+    t = time.perf_counter()
+    times = view.play(start, rate, count)
+    result = view.close()
+    stats = {"displayed": len(times)}
+    if len(times) > 1:
+        # 不包括第一帧的跳转；解码进程按块送出帧时这个值偏高，还需要看总时间
+        stats["fps"] = (len(times) - 1) / (times[-1] - times[0])
+    if times:
+        stats["total_sec"] = times[-1] - t
+    if times:
+        stats["decoded_per_displayed"] = result["decoded"] / len(times)
+    stats["wrong_frames"] = result["wrong_frames"]
+    stats["cpu_sec"] = cpu_stats(result)
+    return stats
+
+
+def parse_videos(text):
+    specs = []
+    for item in text.split(","):
+        size, gop = item.split(":")
+        width, height = size.split("x")
+        specs.append((int(width), int(height), int(gop)))
+    return specs
+
+
+def prepare_videos(args):
+    os.makedirs(args.dir, exist_ok=True)
+    ffmpeg = args.ffmpeg or shutil.which("ffmpeg")
+    videos = []
+    for width, height, gop in parse_videos(args.videos):
+        name = f"{width}x{height}_g{gop}_n{args.frames}"
+        path = os.path.join(args.dir, name + (".avi" if gop == 1 else ".mp4"))
+        if not os.path.exists(path):
+            print(f"writing {name}")
+            if not write_video(path, width, height, gop, args.frames, 25, ffmpeg):
+                print(f"skip {name}: GOP {gop} needs ffmpeg (--ffmpeg)")
+                continue
+        # 先建立关键帧索引，每次打开的耗时相同
+        index = KeyframeIndex.from_path(path)
+        gop_measured = index.gop_length() if index is not None else None
+        videos.append((name, path, width, height, gop, gop_measured))
+    return videos
+
+
+def run(args):
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "cpu_count": os.cpu_count(),
+            "workers": args.workers,
+            "display": args.display,
+            "frames": args.frames,
+        },
+        "videos": {},
+    }
+    rates = [int(r) for r in args.rates.split(",")]
+    for name, path, width, height, gop, gop_measured in prepare_videos(args):
+        entry = {
+            "width": width,
+            "height": height,
+            "gop": gop,
+            "gop_measured": gop_measured,
+            "seek": bench_seek(path, args),
+            "play": {},
+        }
+        seek = entry["seek"]["latency_ms"]
+        print(f"{name} seek p50 {seek['p50']:.1f}ms p90 {seek['p90']:.1f}ms")
+        for rate in rates:
+            play = bench_play(path, rate, args)
+            entry["play"][str(rate)] = play
+            print(
+                f"{name} rate {rate} fps {play.get('fps', 0):.1f} "
+                f"total {play.get('total_sec', 0):.2f}s"
+            )
+        results["videos"][name] = entry
+    return results
+
+
+def wrong_frames(results):
+    """
+    收到的帧与请求的不一致的条目，这样的结果再快也没有意义
+    """
+    wrong = []
+    for name, entry in results["videos"].items():
+        if entry["seek"]["wrong_frames"]:
+            wrong.append(f"{name} seek")
+        for rate, play in entry["play"].items():
+            if play["wrong_frames"]:
+                wrong.append(f"{name} rate {rate}")
+    return wrong
+
+
+def compare(results, baseline, tolerance):
+    """
+    跳转的p90变慢或者帧率下降超过tolerance时视为退化，返回退化的条目
+    """
+    regressions = []
+    for name, entry in results["videos"].items():
+        old = baseline.get("videos", {}).get(name)
+        if old is None:
+            continue
+        new_p90 = entry["seek"]["latency_ms"]["p90"]
+        old_p90 = old["seek"]["latency_ms"]["p90"]
+        print(f"{name} seek p90 {old_p90:.1f} -> {new_p90:.1f}ms")
+        if new_p90 > old_p90 * (1 + tolerance):
+            regressions.append(f"{name} seek p90")
+        for rate, play in entry["play"].items():
+            old_fps = old["play"].get(rate, {}).get("fps")
+            if old_fps is None or "fps" not in play:
+                continue
+            print(f"{name} rate {rate} fps {old_fps:.1f} -> {play['fps']:.1f}")
+            if play["fps"] < old_fps * (1 - tolerance):
+                regressions.append(f"{name} rate {rate} fps")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument(
+        "--dir", default=os.path.join(tempfile.gettempdir(), "event_annotation_bench")
+    )
+    parser.add_argument("--videos", default=DEFAULT_VIDEOS, help="WxH:GOP,...")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--rates", default=DEFAULT_RATES)
+    parser.add_argument("--seeks", type=int, default=50)
+    parser.add_argument("--play-frames", type=int, default=200)
+    parser.add_argument("--display", default="960x540", help="WxH或full")
+    parser.add_argument("--workers", type=int, default=0, help="解码进程数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ffmpeg", default=None, help="生成GOP不是1或12的视频时使用")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.display == "full":
+        args.display = None
+    else:
+        args.display = tuple(int(v) for v in args.display.split("x"))
+
+    results = run(args)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    wrong = wrong_frames(results)
+    if wrong:
+        print("wrong frames: " + ", ".join(wrong))
+        raise SystemExit(1)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("regressions: " + ", ".join(regressions))
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
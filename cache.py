@@ -0,0 +1,60 @@
+from collections import OrderedDict
+import numpy as np
+
+
+class FrameCache:
+    """
+    最近解码帧的LRU缓存，键为(v_id, frame_id)，缓存帧的总字节数不超过budget。
+    固定(pin)的帧单独存放，不计入budget，也不会被淘汰
+    """
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.nbytes = 0
+        self.frames: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self.pinned: "dict[tuple, np.ndarray]" = {}
+        self.pinned_nbytes = 0
+
+    def __len__(self):
+        return len(self.frames) + len(self.pinned)
+
+    def __contains__(self, key):
+        return key in self.frames or key in self.pinned
+
+    def get(self, key):
+        frame = self.pinned.get(key)
+        if frame is not None:
+            return frame
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame: np.ndarray):
+        if frame.nbytes > self.budget or key in self.pinned:
+            return
+        old = self.frames.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.frames[key] = frame
+        self.nbytes += frame.nbytes
+        while self.nbytes > self.budget:
+            _, evicted = self.frames.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def pin(self, key, frame: np.ndarray):
+        old = self.frames.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        if key not in self.pinned:
+            self.pinned[key] = frame
+            self.pinned_nbytes += frame.nbytes
+
+    def unpin_all(self):
+        self.pinned.clear()
+        self.pinned_nbytes = 0
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+        self.unpin_all()
@@ -0,0 +1,96 @@
+import numpy as np
+from multiprocessing import Array
+from msg import Msg
+from typing import Optional
+
+
+class Channel:
+    """
+    视频进程和Thread之间基于共享内存的控制通道，不经过pickle和队列：
+    - VIDEO_FRAMES写入单生产者单消费者的定长消息环，head只由视频进程写，tail只由Thread写
+    - Thread把ack到的共享内存位置写入ack，代替逐帧的FRAME_ACK消息
+    - 一方阻塞之前设置sleeping标志再检查一次，另一方写入之后看到标志再通过队列唤醒它。
+      标志的读写经过共享的锁，锁保证了标志和消息环之间读写的顺序，不会漏掉唤醒
+    - Thread每次跳转时增加epoch，视频进程发现epoch比正在处理的READ新时放弃当前的解码
+    依赖对齐的int64读写是原子的
+    """
+
+    CAPACITY = 1024
+
+    VIDEO = 0
+    THREAD = 1
+
+    # 阻塞时最多等待这么久(秒)，唤醒不会丢失，只是以防万一
+    WAKE_TIMEOUT = 0.1
+
+    HEAD = 0
+    TAIL = 1
+    ACK = 2  # (v_id << 32) | shm_id
+    SLEEPING = 3  # SLEEPING + VIDEO/THREAD
+    EPOCH = 5
+    HEADER_INTS = 8
+
+    @classmethod
+    def alloc(cls) -> Array:
+        """
+        带锁的共享数组，消息环本身不加锁，锁只用于sleeping标志
+        """
+        return Array("q", cls.HEADER_INTS + cls.CAPACITY * Msg.RECORD_INTS)
+
+    def __init__(self, arr: Array) -> None:
+        self.lock = arr.get_lock()
+        buf = np.frombuffer(arr.get_obj(), dtype=np.int64)
+        self.header = buf[: self.HEADER_INTS]
+        self.records = buf[self.HEADER_INTS :].reshape(self.CAPACITY, Msg.RECORD_INTS)
+
+    def space(self):
+        return self.CAPACITY - int(self.header[self.HEAD] - self.header[self.TAIL])
+
+    def push(self, msg: Msg):
+        head = int(self.header[self.HEAD])
+        assert head - int(self.header[self.TAIL]) < self.CAPACITY
+        msg.to_record(self.records[head % self.CAPACITY])
+        # 先写记录再移动head，Thread看到head时记录已经完整
+        self.header[self.HEAD] = head + 1
+
+    def peek(self) -> Optional[Msg]:
+        tail = int(self.header[self.TAIL])
+        if tail == int(self.header[self.HEAD]):
+            return None
+        return Msg.from_record(self.records[tail % self.CAPACITY])
+
+    def pop(self):
+        self.header[self.TAIL] += 1
+
+    def ack(self, v_id, shm_id):
+        self.header[self.ACK] = (v_id << 32) | shm_id
+
+    def acked(self):
+        value = int(self.header[self.ACK])
+        return value >> 32, value & 0xFFFFFFFF
+
+    def bump_epoch(self):
+        self.header[self.EPOCH] += 1
+        return int(self.header[self.EPOCH])
+
+    def epoch(self):
+        return int(self.header[self.EPOCH])
+
+    def set_sleeping(self, side, sleeping):
+        """
+        设置标志之后调用方还要再检查一次消息环或ack。释放锁之后才读取，
+        这时要么对方的写入已经可见，要么对方之后的take_sleeping能看到标志
+        """
+        with self.lock:
+            self.header[self.SLEEPING + side] = int(sleeping)
+
+    def take_sleeping(self, side):
+        """
+        对方正在阻塞时清除标志并返回True，调用方负责唤醒对方。
+        需要在写入消息环或ack之后调用
+        """
+        with self.lock:
+            if self.header[self.SLEEPING + side]:
+                self.header[self.SLEEPING + side] = 0
+                return True
+        return False
@@ -1,8 +1,8 @@
 import argparse
-from annotation import AnnotationManager, sort_annotations, Annotation
+from annotation import AnnotationManager, sort_annotations, Annotation, overlap_pairs
+from interval import SortedIntervals
 from utils import VideoMetaData
 from typing import Optional, List
-import itertools
 import glob
 import os
 
@@ -40,11 +40,12 @@ def check_non_overlap(groupname, annotations: List[Annotation]):
 
 def check_non_overlap2(anns1: List[Annotation], anns2: List[Annotation]):
     errs = []
-    for a1 in anns1:
-        for a2 in anns2:
-            if a1.overlap(a2):
-                errs.append(f"{a1}和{a2}有重叠部分")
-                break
+    # 按下标排序，每个a1只报告anns2中第一个与它重叠的标注
+    last = None
+    for i, j in overlap_pairs(anns1, anns2):
+        if i != last:
+            errs.append(f"{anns1[i]}和{anns2[j]}有重叠部分")
+            last = i
     return errs
 
 
@@ -95,68 +96,61 @@ def check(ann_manager: AnnotationManager, video_meta: Optional[VideoMetaData] =
 
     errs.extend(check_non_overlap2(zoom_in_annotations, zoom_out_annotations))
 
+    sorted_change = SortedIntervals(change_annotations)
+    sorted_camera = SortedIntervals(camera_annotations)
+
     # 视角切换只能有一帧，并且和除回放外的事件，要么与它不重叠，要么在它的开头
     for vp_ann in viewpoint_annotations:
         if vp_ann.f0 != vp_ann.f1:
             errs.append(f"{vp_ann}超过一帧")
         else:
-            for ann in itertools.chain(change_annotations, camera_annotations):
-                if ann.f0 == vp_ann.f0:
-                    continue
-                if ann.f0 < vp_ann.f0 and ann.f1 >= vp_ann.f0:
+            # 起始帧在视角切换之前并且终止帧不在它之前的事件
+            for anns in (sorted_change, sorted_camera):
+                for ann in anns.find(0, anns.start_before(vp_ann.f0), vp_ann.f0):
                     errs.append(f"{vp_ann}切割了{ann}")
 
     switch_annotations = [ann for ann in change_annotations if ann.event_name == "切换"]
 
     # 回放中的事件要么包含整个切换事件，要么与切换事件没有交集
-    for pb_ann in playback_annotations:
-        for sw_ann in switch_annotations:
-            if pb_ann.overlap(sw_ann) and not pb_ann.contain(sw_ann):
-                errs.append(f"{pb_ann}与{sw_ann}相交")
+    for i, j in overlap_pairs(playback_annotations, switch_annotations):
+        pb_ann, sw_ann = playback_annotations[i], switch_annotations[j]
+        if not pb_ann.contain(sw_ann):
+            errs.append(f"{pb_ann}与{sw_ann}相交")
 
     # 一般情况下切换事件与镜头事件无交集，除非是手册中指明的特殊情况
-    for sw_ann in switch_annotations:
-        special = False
-        for cm_ann in camera_annotations:
-            if cm_ann.event_name == "视角切换":
-                continue
-            elif cm_ann.equal(sw_ann):
-                special = True
-            else:
-                prev_shot, next_shot = False, False
-                # 如果前/后存在变化事件起止都是同一帧，那么说明该切换应该向前/后延长一帧再与镜头事件进行比较
-                for ch_ann in change_annotations:
-                    if ch_ann.f0 == ch_ann.f1:
-                        if ch_ann.f0 == sw_ann.f0 - 1:
-                            prev_shot = True
-                        elif ch_ann.f0 == sw_ann.f1 + 1:
-                            next_shot = True
-                f0, f1 = sw_ann.f0, sw_ann.f1
-                if prev_shot:
-                    f0 -= 1
-                if next_shot:
-                    f1 += 1
-                prev_match = sw_ann.f0 == cm_ann.f0 or f0 == cm_ann.f0
-                after_match = sw_ann.f1 == cm_ann.f1 or f1 == cm_ann.f1
-                if prev_match and after_match:
-                    special = True
-
-            if special:
-                break
-
+    shot_frames = set(ann.f0 for ann in change_annotations if ann.f0 == ann.f1)
+    camera_ranges = set(
+        (ann.f0, ann.f1) for ann in camera_annotations if ann.event_name != "视角切换"
+    )
+    camera_overlaps = [[] for _ in switch_annotations]
+    for i, j in overlap_pairs(switch_annotations, camera_annotations):
+        camera_overlaps[i].append(camera_annotations[j])
+    for sw_ann, overlaps in zip(switch_annotations, camera_overlaps):
+        # 如果前/后存在变化事件起止都是同一帧，那么说明该切换应该向前/后延长一帧再与镜头事件进行比较
+        f0, f1 = sw_ann.f0, sw_ann.f1
+        if sw_ann.f0 - 1 in shot_frames:
+            f0 -= 1
+        if sw_ann.f1 + 1 in shot_frames and sw_ann.f1 + 1 != sw_ann.f0 - 1:
+            f1 += 1
+        special = any(
+            (cm_f0, cm_f1) in camera_ranges
+            for cm_f0 in (sw_ann.f0, f0)
+            for cm_f1 in (sw_ann.f1, f1)
+        )
         if special:
             continue
 
-        for cm_ann in camera_annotations:
-            if cm_ann.overlap(sw_ann):
-                errs.append(f"{cm_ann}与{sw_ann}相交")
+        for cm_ann in overlaps:
+            errs.append(f"{cm_ann}与{sw_ann}相交")
 
     # 不能出现两个连续的切换事件
+    switch_by_end = {}
+    for sw_ann in switch_annotations:
+        switch_by_end.setdefault(sw_ann.f1, sw_ann)
     for sw_ann1 in switch_annotations:
-        for sw_ann2 in switch_annotations:
-            if sw_ann1.f0 == sw_ann2.f1 + 1:
-                errs.append(f"{sw_ann2}与{sw_ann1}连续")
-                break
+        sw_ann2 = switch_by_end.get(sw_ann1.f0 - 1)
+        if sw_ann2 is not None:
+            errs.append(f"{sw_ann2}与{sw_ann1}连续")
 
     return errs
 
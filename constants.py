@@ -1,5 +1,48 @@
+import os
+
+
 class Config:
     # 每次回退/前进算多少帧，可以是数字或者“exp”，exp代表连续按键会导致回退/前进的帧数指数增加，直到到达最大值
     FRAME_PER_BACK = 5
     FRAME_PER_FORWARD = "exp"
     FRAME_MOVE_MAX = 16  # 指数回退/前进的最大值
+    FRAME_CACHE_MB = 256  # 视频进程中缓存最近解码帧的内存上限(MB)
+    REVERSE_CHUNK_FRAMES = 64  # 倒放时每次解码的块中最多保留的帧数
+    KEYFRAME_SKIP_RATE = 8  # 倍速不低于该值时只解码关键帧(需要关键帧码流)，显示每个采样点之前最近的关键帧
+    GRAB_CONTINUE_GOPS = 0.5  # 向前不超过这么多个GOP(按关键帧索引测得)时继续grab，不重新跳转
+    # 视频进程之外的解码进程数，为0时只在视频进程中解码。
+    # 预读只有一两个GOP时并行度很低，默认不启用，用bench.py --workers确认有收益之后再打开
+    DECODER_WORKERS = 0
+    POOL_CHUNK_FRAMES = 32  # 每个解码进程一次解码的最大帧数
+    POOL_RUN_FRAMES = 128  # 交给同一个解码进程顺序解码的一段GOP至少包含的帧数
+    SHM_BUDGET_MB = 512  # 视频进程和窗口之间传递帧的共享内存上限(MB)
+    SHM_MIN_FRAMES = 8  # 帧很大时也至少能放下这么多帧，可以超出上限
+    SHM_MAX_FRAMES = 256  # 帧很小时最多放这么多帧
+    THUMB_INTERVAL_SEC = 2  # 缩略图之间间隔的秒数
+    THUMB_MAX_COUNT = 1000  # 一个视频最多生成的缩略图数量
+    THUMB_WIDTH = 160  # 缩略图缩放到THUMB_WIDTH x THUMB_WIDTH之内
+    THUMB_BATCH = 8  # 每次发送给窗口的缩略图数量
+    PROXY_CACHE_GB = 4  # 磁盘上缩放后的帧的缓存上限(GB)，为0时不使用
+    PROXY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "event_annotation")
+    PROXY_HEIGHTS = (360, 540, 720, 1080)  # 使用磁盘缓存时解码的高度按这几档取不低于显示高度的最小一档
+    # 只包含关键帧的码流的总大小上限(GB)，为0时不生成，高倍速时退化为grab
+    KEYFRAME_STREAM_GB = 2
+    KEYFRAME_STREAM_DIR = os.path.join(PROXY_CACHE_DIR, "kfstream")
+    READ_AHEAD_SEC = 1.0  # 播放时至少预读多少秒的帧
+    READ_AHEAD_MAX_SEC = 8.0  # 卡顿时预读时间最多加长到多少秒
+    READ_AHEAD_MIN_FRAMES = 8  # 最少预读的帧数
+    UNDERRUN_WINDOW_SEC = 30  # 统计卡顿次数的时间窗口(秒)
+    UNDERRUN_TARGET = 0  # 时间窗口内允许的卡顿次数，超过时加长预读时间
+    STATS_INTERVAL_SEC = 0.5  # 视频进程报告解码速度的间隔(秒)
+    LOOP_PIN_MB = 512  # A-B循环中固定在内存中的帧的上限(MB)
+    SHEET_RADIUS = 3  # 邻近帧面板显示当前帧前后各多少帧
+    SHEET_TILE_WIDTH = 96  # 邻近帧面板中每一帧的宽度
+    PREFETCH_FRAMES = 32  # 预先打开播放列表中的下一个视频时解码开头的帧数
+    PREFETCH_INDEX_PACKETS = 256  # 预先打开时建立关键帧索引，每次读取的数据包数
+    LATENCY_WINDOW = 300  # 按最近多少帧计算各阶段耗时的分位数
+    # 设置这个环境变量时把每一帧各阶段的时间写入这个JSONL文件
+    LATENCY_LOG = os.environ.get("EVENT_ANNOTATION_LATENCY_LOG")
+    # 解码跟不上时：keep-all逐帧显示，整体变慢(标注)；keep-time跳过过了显示时间的帧(复查)
+    PLAYBACK_DROP_POLICY = "keep-all"
+    PLAYBACK_MAX_LAG_SEC = 1.0  # keep-time落后超过这么多秒时不再追赶，从当前时间重新开始
+    PLAYBACK_MAX_STRIDE = 8  # keep-time解码跟不上时最多每隔这么多帧显示一帧
@@ -0,0 +1,256 @@
+import cv2
+from keyframe import KeyframeIndex
+import constants
+
+
+class Decoder:
+    """
+    对cv2.VideoCapture的封装，记录cap当前的位置，借助关键帧索引进行跳转，
+    并将解码得到的帧缩放到显示大小
+    """
+
+    # opencv跳转到第n帧时，会先跳到第n-16帧之前的关键帧再解码到第n帧
+    SEEK_BACKOFF = 16
+    # 跳转后越过了目标帧时重新跳转的次数，仍然越过时从头开始
+    SEEK_RETRIES = 3
+    # 关键帧码流中向前不超过这么多个关键帧时继续读取，否则重新打开(打开比解码几个关键帧慢)
+    KEYFRAME_GRAB_LIMIT = 4
+
+    def __init__(self) -> None:
+        self.path = None
+        self.cap = None
+        self.kf_index = None
+        self.frame_rd = 0  # pos of opencv cap
+        self.width, self.height = 0, 0
+        # 解码后缩放到显示区域的大小(w, h)，None表示原始分辨率
+        self.display_size = None
+        # 不为空时高度取不低于显示高度的最小一档(不超过原始分辨率)，窗口绘制时再缩小，
+        # 显示区域在同一档之内变化时解码得到的帧相同
+        self.size_steps = ()
+        # 返回True时放弃正在进行的grab，用于中止已经过时的跳转
+        self.interrupt = None
+        # 向前不超过这么多帧时顺序grab，不跳转
+        self.grab_limit = self.SEEK_BACKOFF
+        # 解码过的帧数(包括只grab的帧和跳转时opencv内部解码的帧)，用于基准测试
+        self.decoded = 0
+        # 关键帧码流，kf_next为kf_cap下一个读取的关键帧的序号
+        self.kf_cap = None
+        self.kf_next = 0
+        self.kf_last = None  # (序号, 显示大小, 帧)，相邻的采样点可能落在同一个GOP中
+
+    def open(self, path):
+        self.open_with_index(path, KeyframeIndex.from_path(path))
+
+    def open_with_index(self, path, kf_index):
+        """
+        使用已经建立好的关键帧索引，kf_index为None时不使用索引
+        """
+        self.release()
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        self.kf_index = kf_index
+        self.frame_rd = 0
+        self.grab_limit = self.measure_grab_limit()
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+        self.release_keyframes()
+        self.path = None
+        self.cap = None
+        self.kf_index = None
+
+    def measure_grab_limit(self):
+        """
+        跳转之后要从关键帧重新解码，GOP越长跳转越贵，按GOP长度确定继续grab的距离；
+        opencv的跳转至少也要解码SEEK_BACKOFF帧
+        """
+        if self.kf_index is None:
+            return self.SEEK_BACKOFF
+        gop = self.kf_index.gop_length()
+        return max(int(gop * constants.Config.GRAB_CONTINUE_GOPS), self.SEEK_BACKOFF)
+
+    def fit_size(self, width, height):
+        """
+        保持长宽比缩放到显示区域之内，不放大；有size_steps时按档位取高度
+        """
+        if self.display_size is None:
+            return width, height
+        view_w, view_h = self.display_size
+        scale = min(view_w / width, view_h / height, 1.0)
+        h = max(round(height * scale), 1)
+        steps = [step for step in self.size_steps if step >= h]
+        if steps:
+            scale = min(steps[0] / height, 1.0)
+            h = max(round(height * scale), 1)
+        return max(round(width * scale), 1), h
+
+    def frame_shape(self):
+        w, h = self.fit_size(self.width, self.height)
+        return (h, w, 3)
+
+    def convert(self, frame):
+        """
+        将解码得到的帧缩放到显示大小，保持BGR，窗口直接按BGR888绘制
+        """
+        h, w = frame.shape[:2]
+        # 以实际解码得到的帧为准
+        self.height, self.width = h, w
+        size = self.fit_size(w, h)
+        if size != (w, h):
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def seek(self, frame_id):
+        """
+        从frame_id之前最近的关键帧开始解码，grab到frame_id，没有索引时退化为直接跳转
+        """
+        pos = frame_id
+        if self.kf_index is not None:
+            keyframe = self.kf_index.keyframe_before(frame_id)
+            # 让opencv回退后正好落在keyframe上
+            pos = min(keyframe + self.SEEK_BACKOFF, frame_id)
+        for _ in range(self.SEEK_RETRIES):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+            if self.kf_index is not None:
+                self.decoded += pos - self.seek_origin(pos)
+            else:
+                self.decoded += min(pos, self.SEEK_BACKOFF)
+            self.frame_rd = self.landed(pos)
+            if self.frame_rd <= frame_id:
+                break
+            # 跳过了目标帧，按超出的距离往前退
+            pos = max(pos - (self.frame_rd - frame_id), 0)
+        else:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.frame_rd = 0
+        self.advance(frame_id)
+
+    def landed(self, pos):
+        """
+        跳转到pos之后cap实际的位置。opencv在跳转时已经grab到了pos的前一帧，
+        按它的pts在索引中查出帧号，可变帧率的视频上和pos不一定相同
+        """
+        if self.kf_index is None or pos == 0:
+            return pos
+        t = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        return self.kf_index.frame_at(t) + 1
+
+    def seek_origin(self, frame_id):
+        """
+        跳转到frame_id时实际开始解码的关键帧
+        """
+        return self.kf_index.keyframe_before(max(frame_id - self.SEEK_BACKOFF, 0))
+
+    def advance(self, frame_id):
+        """
+        只grab不retrieve，直到cap的位置到达frame_id
+        """
+        while self.frame_rd < frame_id:
+            if self.interrupt is not None and self.interrupt():
+                return False
+            if not self.cap.grab():
+                return False
+            self.frame_rd += 1
+            self.decoded += 1
+        return True
+
+    def release_keyframes(self):
+        if self.kf_cap is not None:
+            self.kf_cap.release()
+        self.kf_cap = None
+        self.kf_next = 0
+        self.kf_last = None
+
+    def keyframes_only(self, rate):
+        """
+        倍速不低于KEYFRAME_SKIP_RATE并且有关键帧码流时只解码关键帧
+        """
+        return (
+            abs(rate) >= constants.Config.KEYFRAME_SKIP_RATE
+            and self.kf_index is not None
+            and self.kf_index.stream is not None
+        )
+
+    def read_keyframe(self, frame_id):
+        """
+        从关键帧码流中解码frame_id之前最近的关键帧，用来代替frame_id
+        """
+        stream = self.kf_index.stream
+        i = self.kf_index.gop_id(frame_id)
+        if self.kf_last is not None and self.kf_last[:2] == (i, self.display_size):
+            return self.kf_last[2]
+        if (
+            self.kf_cap is None
+            or i < self.kf_next
+            or i - self.kf_next > self.KEYFRAME_GRAB_LIMIT
+        ):
+            if self.kf_cap is not None:
+                self.kf_cap.release()
+            self.kf_cap = stream.open(i)
+            self.kf_next = i
+            if not self.kf_cap.isOpened():
+                # 码流超出上限被删除了，之后退化为grab
+                self.release_keyframes()
+                self.kf_index.stream = None
+                return None
+        while self.kf_next < i:
+            if not self.kf_cap.grab():
+                return None
+            self.kf_next += 1
+            self.decoded += 1
+        ret, frame = self.kf_cap.read()
+        if not ret:
+            return None
+        self.kf_next += 1
+        self.decoded += 1
+        frame = self.convert(frame)
+        self.kf_last = (i, self.display_size, frame)
+        return frame
+
+    def locate(self, frame_id, rate=1):
+        """
+        将cap移动到frame_id。向前的距离在grab_limit之内，或者中间没有可以跳过的关键帧时
+        继续grab，否则先跳转。
+        倍速很高(步长超过SEEK_BACKOFF)时，只要跳转之后开始解码的关键帧在当前位置之后就跳转
+        """
+        distance = frame_id - self.frame_rd
+        need_seek = distance < 0 or distance >= max(rate, self.grab_limit + 1)
+        if (
+            need_seek
+            and distance >= 0
+            and self.kf_index is not None
+            and self.seek_origin(frame_id) <= self.frame_rd
+        ):
+            # 跳转之后解码的帧不会比继续grab少
+            need_seek = False
+        if (
+            not need_seek
+            and self.kf_index is not None
+            and rate >= constants.Config.KEYFRAME_SKIP_RATE
+            and self.seek_origin(frame_id) > self.frame_rd
+        ):
+            need_seek = True
+        if need_seek:
+            self.seek(frame_id)
+        return self.advance(frame_id)
+
+    def decode_frame(self, frame_id, rate=1):
+        """
+        解码frame_id对应的帧。keyframes_only(rate)时返回的是frame_id之前最近的关键帧，
+        不能作为frame_id缓存
+        """
+        if self.keyframes_only(rate):
+            frame = self.read_keyframe(frame_id)
+            if frame is not None or self.keyframes_only(rate):
+                return frame
+        if not self.locate(frame_id, rate):
+            return None
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        self.frame_rd += 1
+        self.decoded += 1
+        return self.convert(frame)
@@ -0,0 +1,122 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Tuple
+
+
+class SortedIntervals:
+    """
+    按起始帧排好序的闭区间：起始帧有序，另外用线段树记录每一段中最大的终止帧，
+    用于按顺序找出下标在某个范围内并且终止帧不小于某个值的区间
+    """
+
+    def __init__(self, items) -> None:
+        self.items = items
+        self.f0s = [item.f0 for item in items]
+        size = 1
+        while size < len(items):
+            size *= 2
+        self.size = size
+        self.tree = [float("-inf")] * (2 * size)
+        for i, item in enumerate(items):
+            self.tree[size + i] = item.f1
+        for i in range(size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def start_before(self, frame_id) -> int:
+        """
+        起始帧小于frame_id的区间的数量
+        """
+        return bisect_left(self.f0s, frame_id)
+
+    def start_until(self, frame_id) -> int:
+        """
+        起始帧不大于frame_id的区间的数量
+        """
+        return bisect_right(self.f0s, frame_id)
+
+    def find(self, lo, hi, f1) -> list:
+        """
+        下标在[lo, hi)内并且终止帧不小于f1的区间
+        """
+        result = []
+        self._find(1, 0, self.size, lo, hi, f1, result)
+        return result
+
+    def _find(self, node, l, r, lo, hi, f1, result):
+        if r <= lo or hi <= l or self.tree[node] < f1:
+            return
+        if r - l == 1:
+            result.append(self.items[l])
+            return
+        m = (l + r) // 2
+        self._find(2 * node, l, m, lo, hi, f1, result)
+        self._find(2 * node + 1, m, r, lo, hi, f1, result)
+
+
+class IntervalIndex:
+    """
+    一组闭区间[f0, f1]的索引。所有区间的边界(f0和f1+1)把帧号分成若干段，同一段内
+    每一帧被相同的区间覆盖，查询下一个边界只需要二分查找；覆盖某一帧的区间用
+    SortedIntervals查询，耗时与结果的数量成正比，建立索引的时间和空间都与区间数量成正比
+    (排序除外)，不会因为区间互相重叠而变大。
+    修改区间之后调用invalidate，下一次查询时重新建立
+    """
+
+    def __init__(self) -> None:
+        self.items = []
+        self.points: List[int] = []  # 有序的边界
+        self.sorted = SortedIntervals([])
+        self.dirty = False
+
+    def reset(self, items):
+        """
+        items中的每一项需要有f0和f1属性
+        """
+        self.items = items
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def build(self):
+        # 按起始帧稳定排序，覆盖同一帧的区间按加入的顺序返回
+        valid = [item for item in self.items if item.f0 <= item.f1]
+        valid.sort(key=lambda item: item.f0)
+        points = set()
+        for item in valid:
+            points.add(item.f0)
+            points.add(item.f1 + 1)
+        self.points = sorted(points)
+        self.sorted = SortedIntervals(valid)
+        self.dirty = False
+
+    def segment(self, frame_id) -> int:
+        """
+        frame_id所在的段，在第一个边界之前时为-1
+        """
+        if self.dirty:
+            self.build()
+        return bisect_right(self.points, frame_id) - 1
+
+    def covering(self, frame_id) -> tuple:
+        """
+        覆盖frame_id的区间
+        """
+        if self.dirty:
+            self.build()
+        return tuple(self.sorted.find(0, self.sorted.start_until(frame_id), frame_id))
+
+    def next_boundary(self, frame_id) -> Optional[int]:
+        """
+        frame_id之后覆盖集合发生变化的第一帧，没有时为None
+        """
+        i = self.segment(frame_id) + 1
+        return self.points[i] if i < len(self.points) else None
+
+    def span(self, frame_id) -> Tuple[Optional[int], Optional[int]]:
+        """
+        与frame_id覆盖集合相同的帧的范围[lo, hi)，没有边界的一侧为None
+        """
+        i = self.segment(frame_id)
+        lo = self.points[i] if i >= 0 else None
+        hi = self.points[i + 1] if i + 1 < len(self.points) else None
+        return lo, hi
@@ -0,0 +1,400 @@
+import os
+import bisect
+import hashlib
+import cv2
+import numpy as np
+import constants
+from typing import Optional
+
+
+class KeyframeStream:
+    """
+    只包含关键帧的裸码流，保存在缓存目录KEYFRAME_STREAM_DIR中。高倍速播放时只解码其中的关键帧，
+    借助ffmpeg的subfile协议可以从任意一个关键帧开始读取。
+    所有码流的总大小超过KEYFRAME_STREAM_GB时删除最久没有使用过的，没有码流时高倍速退化为grab
+    """
+
+    SUFFIX = ".kfstream"
+    # fourcc -> (扩展名, 每个关键帧之前是否需要加上extradata)
+    # 原始数据包模式下opencv会把h264/hevc转换成Annex B格式，关键帧之前已经带有参数集
+    FORMATS = {
+        "FMP4": (".m4v", True),
+        "mp4v": (".m4v", True),
+        "XVID": (".m4v", True),
+        "DIVX": (".m4v", True),
+        "DX50": (".m4v", True),
+        "h264": (".h264", False),
+        "avc1": (".h264", False),
+        "H264": (".h264", False),
+        "hevc": (".hevc", False),
+        "hev1": (".hevc", False),
+        "hvc1": (".hevc", False),
+    }
+    # 关键帧的间隔太小时码流和视频差不多大，并且顺序解码也不慢，不生成
+    MIN_GOP = 4
+
+    def __init__(self, path, offsets) -> None:
+        self.path = path
+        self.offsets = [int(o) for o in offsets]  # 每个关键帧的起始位置，最后一项为文件大小
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def stream_path(cls, path, ext):
+        """
+        用视频的路径、大小和修改时间作为文件名
+        """
+        stat = os.stat(path)
+        text = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return os.path.join(constants.Config.KEYFRAME_STREAM_DIR, key + cls.SUFFIX + ext)
+
+    @classmethod
+    def budget(cls) -> int:
+        return int(constants.Config.KEYFRAME_STREAM_GB * 1024 * 1024 * 1024)
+
+    @classmethod
+    def format_of(cls, cap):
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, "little")
+        return cls.FORMATS.get(fourcc.decode("latin-1"))
+
+    def open(self, i) -> cv2.VideoCapture:
+        """
+        从第i个关键帧开始顺序读取
+        """
+        url = f"subfile,,start,{self.offsets[i]},end,0,,:{self.path}"
+        return cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+
+    def valid(self) -> bool:
+        """
+        文件没有被改动
+        """
+        try:
+            return os.path.getsize(self.path) == self.offsets[-1]
+        except OSError:
+            return False
+
+    def decodable(self) -> bool:
+        """
+        中间的关键帧可以单独解码
+        """
+        cap = self.open(len(self) // 2)
+        ok = cap.isOpened() and cap.grab()
+        cap.release()
+        return ok
+
+    def touch(self):
+        """
+        最近使用过的码流最后被删除
+        """
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+
+    def evict(self) -> bool:
+        """
+        删除其它的码流，直到总大小不超过上限，做不到时返回False
+        """
+        root = os.path.dirname(self.path)
+        others = []
+        total = self.offsets[-1]
+        try:
+            for name in os.listdir(root):
+                other = os.path.join(root, name)
+                if self.SUFFIX not in name or other == self.path:
+                    continue
+                stat = os.stat(other)
+                others.append((stat.st_mtime, other, stat.st_size))
+                total += stat.st_size
+        except OSError:
+            return False
+        others.sort()
+        for _, other, size in others:
+            if total <= self.budget():
+                break
+            try:
+                os.remove(other)
+                total -= size
+            except OSError:
+                pass
+        return total <= self.budget()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class KeyframeIndex:
+    """
+    视频的关键帧索引，记录每个关键帧的帧号和每一帧的pts(毫秒)。
+    跳转时从目标帧之前最近的关键帧开始解码，再向前grab到目标帧，
+    这样跳转的耗时有上界。opencv按帧率把帧号换算成时间来跳转，可变帧率的视频上会跳到
+    别的帧，跳转之后用pts确认实际的位置，帧号是精确的。
+    支持的编码格式还会同时生成只包含关键帧的码流(KeyframeStream)
+    """
+
+    SUFFIX = ".kfidx.npz"
+    VERSION = 3
+
+    def __init__(self, keyframes, pts, stream: Optional[KeyframeStream] = None) -> None:
+        self.keyframes = [int(k) for k in keyframes]  # 升序
+        self.pts = np.asarray(pts, dtype=np.float64)  # 按帧号排列
+        self.stream = stream  # 第i个关键帧对应码流中的第i帧
+
+    def __len__(self):
+        return len(self.pts)
+
+    def keyframe_before(self, frame_id) -> int:
+        """
+        frame_id之前(包含)最近的关键帧
+        """
+        i = bisect.bisect_right(self.keyframes, frame_id) - 1
+        if i < 0:
+            return 0
+        return self.keyframes[i]
+
+    def keyframe_after(self, frame_id) -> Optional[int]:
+        """
+        frame_id之后(不包含)最近的关键帧，不存在时返回None
+        """
+        i = bisect.bisect_right(self.keyframes, frame_id)
+        if i >= len(self.keyframes):
+            return None
+        return self.keyframes[i]
+
+    def gop_id(self, frame_id) -> int:
+        """
+        frame_id所在GOP的序号
+        """
+        return max(bisect.bisect_right(self.keyframes, frame_id) - 1, 0)
+
+    def gop_length(self) -> int:
+        if len(self.keyframes) < 2:
+            return max(len(self.pts), 1)
+        return int(np.median(np.diff(self.keyframes)))
+
+    def frame_pts(self, frame_id) -> float:
+        return float(self.pts[frame_id])
+
+    def frame_at(self, t) -> int:
+        """
+        pts最接近t(毫秒)的帧号
+        """
+        i = int(np.searchsorted(self.pts, t))
+        if i >= len(self.pts) or (i > 0 and t - self.pts[i - 1] < self.pts[i] - t):
+            i -= 1
+        return max(i, 0)
+
+    @classmethod
+    def sidecar_path(cls, path):
+        return path + cls.SUFFIX
+
+    @classmethod
+    def build(cls, path) -> Optional["KeyframeIndex"]:
+        """
+        一次读取所有的数据包，见KeyframeIndexBuilder
+        """
+        builder = KeyframeIndexBuilder(path)
+        while not builder.step(KeyframeIndexBuilder.STEP_PACKETS):
+            pass
+        return builder.index
+
+    @classmethod
+    def load(cls, path) -> Optional["KeyframeIndex"]:
+        sidecar = cls.sidecar_path(path)
+        if not os.path.exists(sidecar):
+            return None
+        try:
+            stat = os.stat(path)
+            with np.load(sidecar) as data:
+                version, size, mtime_ns = data["key"].tolist()
+                if (
+                    version != cls.VERSION
+                    or size != stat.st_size
+                    or mtime_ns != stat.st_mtime_ns
+                ):
+                    return None
+                stream = None
+                ext = str(data["stream_ext"])
+                if ext:
+                    stream = KeyframeStream(
+                        KeyframeStream.stream_path(path, ext), data["stream_offsets"]
+                    )
+                    if stream.valid():
+                        stream.touch()
+                    else:
+                        # 已经因为超出上限被删除，高倍速时退化为grab
+                        stream = None
+                return cls(data["keyframes"], data["pts"], stream)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path):
+        sidecar = self.sidecar_path(path)
+        try:
+            stat = os.stat(path)
+            key = np.array([self.VERSION, stat.st_size, stat.st_mtime_ns], np.int64)
+            ext, offsets = "", []
+            if self.stream is not None:
+                ext = os.path.splitext(self.stream.path)[1]
+                offsets = self.stream.offsets
+            with open(sidecar, "wb") as f:
+                np.savez(
+                    f,
+                    key=key,
+                    keyframes=np.asarray(self.keyframes, np.int64),
+                    pts=self.pts,
+                    stream_ext=np.array(ext),
+                    stream_offsets=np.asarray(offsets, np.int64),
+                )
+        except OSError:
+            # 视频所在目录不可写时不缓存索引
+            pass
+
+    @classmethod
+    def from_path(cls, path) -> Optional["KeyframeIndex"]:
+        index = cls.load(path)
+        if index is None:
+            index = cls.build(path)
+            if index is not None:
+                index.save(path)
+        return index
+
+
+class KeyframeIndexBuilder:
+    """
+    分多次读取数据包建立KeyframeIndex，每次step只读取一部分，长视频的扫描不会一直阻塞调用者。
+    只读取数据包而不解码，速度很快。
+    数据包是按解码顺序排列的，因此需要将pts排序后得到每一帧的显示顺序
+    """
+
+    STEP_PACKETS = 1024
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.index: Optional[KeyframeIndex] = None
+        self.done = False
+        self.cap = None
+        self.fmt = None
+        self.writer, self.stream_path, self.extradata = None, None, None
+        self.pts = []
+        self.key_pts = []
+        self.key_offsets = []
+        if not hasattr(cv2, "CAP_PROP_LRF_HAS_KEY_FRAME"):
+            self.done = True
+            return
+        self.cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+        if not self.cap.isOpened():
+            self.release()
+            self.done = True
+            return
+        self.fmt = KeyframeStream.format_of(self.cap)
+        if self.fmt is not None and KeyframeStream.budget() > 0:
+            try:
+                self.stream_path = KeyframeStream.stream_path(path, self.fmt[0])
+                os.makedirs(os.path.dirname(self.stream_path), exist_ok=True)
+                self.writer = open(self.stream_path, "wb")
+            except OSError:
+                # 缓存目录不可写时不生成关键帧码流
+                pass
+
+    def step(self, packets) -> bool:
+        """
+        最多读取packets个数据包，读完之后建立索引(失败时为None)，返回是否已经结束
+        """
+        if self.done:
+            return True
+        cap, writer = self.cap, self.writer
+        for _ in range(packets):
+            if not cap.grab():
+                self.finish()
+                return True
+            t = cap.get(cv2.CAP_PROP_POS_MSEC)
+            self.pts.append(t)
+            if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                self.key_pts.append(t)
+                if writer is not None and not self.write_keyframe():
+                    # 写入失败或者超出上限时不生成关键帧码流
+                    self.drop_stream()
+                    writer = None
+        return False
+
+    def write_keyframe(self) -> bool:
+        cap, writer = self.cap, self.writer
+        try:
+            self.key_offsets.append(writer.tell())
+            if self.fmt[1]:
+                if self.extradata is None:
+                    idx = int(cap.get(cv2.CAP_PROP_CODEC_EXTRADATA_INDEX))
+                    ret, data = cap.retrieve(flag=idx)
+                    self.extradata = data.tobytes() if ret and data is not None else b""
+                writer.write(self.extradata)
+            ret, data = cap.retrieve()
+            writer.write(data.tobytes() if ret and data is not None else b"")
+            return writer.tell() <= KeyframeStream.budget()
+        except OSError:
+            return False
+
+    def drop_stream(self):
+        """
+        删除写了一半的关键帧码流
+        """
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        self.writer = None
+        try:
+            os.remove(self.stream_path)
+        except OSError:
+            pass
+
+    def finish(self):
+        self.done = True
+        self.cap.release()
+        self.cap = None
+        stream = None
+        if self.writer is not None:
+            try:
+                self.key_offsets.append(self.writer.tell())
+                self.writer.close()
+                self.writer = None
+                stream = KeyframeStream(self.stream_path, self.key_offsets)
+            except OSError:
+                self.drop_stream()
+        if not self.pts:
+            if stream is not None:
+                stream.remove()
+            return
+
+        pts = np.sort(np.asarray(self.pts, dtype=np.float64))
+        key_ids = [int(k) for k in np.searchsorted(pts, np.asarray(self.key_pts, dtype=np.float64))]
+        keyframes = sorted(set(key_ids))
+        if not keyframes or keyframes[0] != 0:
+            keyframes.insert(0, 0)
+        if stream is not None and (
+            # 码流中关键帧的顺序需要和帧号一一对应
+            key_ids != keyframes
+            or len(keyframes) * KeyframeStream.MIN_GOP > len(pts)
+            or not stream.decodable()
+            or not stream.evict()
+        ):
+            stream.remove()
+            stream = None
+        self.index = KeyframeIndex(keyframes, pts, stream)
+
+    def release(self):
+        """
+        中途放弃，删除写了一半的关键帧码流
+        """
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+        self.drop_stream()
+        self.done = True
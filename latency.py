@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+import numpy as np
+from collections import OrderedDict, deque
+
+# 共享内存中每个位置的帧之后记录的时间：解码开始、解码结束、写入消息环
+SLOT_TIMES = 3
+DECODE_START, DECODE_END, RING_WRITE = range(SLOT_TIMES)
+
+
+def clock():
+    # Linux上perf_counter是系统范围的单调时钟，不同进程的时间可以直接比较
+    return time.perf_counter()
+
+
+def times_offset(cap, frame_nbytes):
+    # 按8字节对齐
+    return (cap * frame_nbytes + 7) // 8 * 8
+
+
+def shm_nbytes(cap, frame_nbytes):
+    """
+    cap个帧加上每个位置的计时
+    """
+    return times_offset(cap, frame_nbytes) + cap * SLOT_TIMES * 8
+
+
+def slot_times(buf, cap, frame_nbytes) -> np.ndarray:
+    return np.ndarray(
+        (cap, SLOT_TIMES),
+        dtype=np.float64,
+        buffer=buf,
+        offset=times_offset(cap, frame_nbytes),
+    )
+
+
+class LatencyStats:
+    """
+    Thread显示的每一帧从解码到绘制各阶段的耗时，保留最近window帧用于计算分位数：
+    - decode: 视频进程或解码进程解码(缓存命中时为0)
+    - ring: 解码之后等待按顺序写入消息环
+    - relay: 写入消息环之后Thread取出
+    - buffer: 在Thread的缓冲中等待显示的时间
+    - paint: Thread发出之后窗口绘制完成
+    窗口合并了多次更新而没有绘制的帧算作丢帧，比计划晚一个间隔以上显示的帧算作迟到，
+    keep-time播放时Thread为了保持实际速度没有发出的帧算作跳帧。
+    给出log_path时每一帧写入一行JSON
+    """
+
+    STAGES = ("decode", "ring", "relay", "buffer", "paint", "total")
+    MAX_PENDING = 64
+
+    def __init__(self, window, log_path=None) -> None:
+        self.lock = threading.Lock()
+        self.log = None
+        if log_path:
+            try:
+                self.log = open(log_path, "a", encoding="utf-8")
+            except OSError:
+                pass
+        # 显示统计时或者需要记录时才收集
+        self.enabled = self.log is not None
+        self.samples = {stage: deque(maxlen=window) for stage in self.STAGES}
+        self.pending = OrderedDict()  # (v_id, shm_id) -> 还没有绘制的帧
+        self.shown = 0
+        self.dropped = 0
+        self.late = 0
+        self.skipped = 0
+        self.occupancy = (0, 0, 0)  # (缓冲中的帧数, 共享内存中的位置数, 消息环中的记录数)
+
+    def set_enabled(self, enabled):
+        with self.lock:
+            # 停止收集期间绘制的帧不能算作丢帧
+            self.pending.clear()
+            self.enabled = enabled or self.log is not None
+
+    def emitted(self, slot, frame_id, times, dequeue_t, late):
+        """
+        Thread发出一帧之前调用，times为这一帧所在位置的计时
+        """
+        buffered, cap, backlog = self.occupancy
+        record = {
+            "v_id": slot[0],
+            "frame_id": int(frame_id),
+            "decode_start": float(times[DECODE_START]),
+            "decode_end": float(times[DECODE_END]),
+            "ring_write": float(times[RING_WRITE]),
+            "dequeue": dequeue_t,
+            "emit": clock(),
+            "late": late,
+            "buffered": buffered,
+            "backlog": backlog,
+        }
+        with self.lock:
+            if late:
+                self.late += 1
+            self.pending.pop(slot, None)
+            self.pending[slot] = record
+            while len(self.pending) > self.MAX_PENDING:
+                self.drop(self.pending.popitem(last=False)[1])
+
+    def painted(self, slot):
+        """
+        窗口线程中调用，之前发出的还没有绘制的帧都已经被跳过
+        """
+        t = clock()
+        with self.lock:
+            if slot not in self.pending:
+                return
+            while self.pending:
+                key, record = self.pending.popitem(last=False)
+                if key == slot:
+                    record["painted"] = t
+                    self.add(record)
+                    break
+                self.drop(record)
+
+    def drop(self, record):
+        self.dropped += 1
+        record["painted"] = None
+        self.write(record)
+
+    def add(self, record):
+        durations = (
+            record["decode_end"] - record["decode_start"],
+            record["ring_write"] - record["decode_end"],
+            record["dequeue"] - record["ring_write"],
+            record["emit"] - record["dequeue"],
+            record["painted"] - record["emit"],
+            record["painted"] - record["decode_start"],
+        )
+        for stage, d in zip(self.STAGES, durations):
+            self.samples[stage].append(d * 1000)
+        self.shown += 1
+        self.write(record)
+
+    def write(self, record):
+        if self.log is not None:
+            self.log.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        """
+        每个阶段的(p50, p95, p99)毫秒，没有数据时为None
+        """
+        with self.lock:
+            result = {}
+            for stage, samples in self.samples.items():
+                if samples:
+                    p = np.percentile(np.fromiter(samples, np.float64), (50, 95, 99))
+                    result[stage] = tuple(float(v) for v in p)
+                else:
+                    result[stage] = None
+            return result
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
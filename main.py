@@ -1,32 +1,36 @@
 import multiprocessing as mp
-from multiprocessing import Queue, RawArray
+from multiprocessing import Queue, Array
 from window import AnnWindow
 from video import Video
+from channel import Channel
 from PySide6.QtWidgets import QApplication
 from PySide6.QtCore import QObject, QEvent
 from argparse import ArgumentParser
 
 
-def fn_proc_window(q_frame: Queue, q_cmd: Queue, shm_arr: RawArray):
+def fn_proc_window(q_frame: Queue, q_cmd: Queue, ctrl_arr: Array, playlist):
     app = QApplication()
-    window = AnnWindow(q_frame, q_cmd, shm_arr)
+    window = AnnWindow(q_frame, q_cmd, ctrl_arr, playlist)
     window.show()
     window.th.start()
     import sys
     sys.exit(app.exec())
 
 
-def fn_proc_video(q_frame: Queue, q_cmd: Queue, shm_arr: RawArray):
-    video = Video(q_frame, q_cmd, shm_arr)
+def fn_proc_video(q_frame: Queue, q_cmd: Queue, ctrl_arr: Array):
+    video = Video(q_frame, q_cmd, ctrl_arr)
     video.run()
 
 
-def main():
+def main(playlist=None):
     q_frame = Queue()
     q_cmd = Queue()
-    shm_arr = RawArray("b", 500 * 1024 * 1024)
-    p_video = mp.Process(target=fn_proc_video, args=(q_frame, q_cmd, shm_arr))
-    p_window = mp.Process(target=fn_proc_window, args=(q_frame, q_cmd, shm_arr))
+    # 帧所在的共享内存由视频进程在打开视频时创建
+    ctrl_arr = Channel.alloc()
+    p_video = mp.Process(target=fn_proc_video, args=(q_frame, q_cmd, ctrl_arr))
+    p_window = mp.Process(
+        target=fn_proc_window, args=(q_frame, q_cmd, ctrl_arr, playlist)
+    )
     p_video.start()
     p_window.start()
     p_video.join()
@@ -35,4 +39,6 @@ def main():
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    main()
+    parser.add_argument("--playlist", help="视频列表文件，每行一个视频路径")
+    args = parser.parse_args()
+    main(args.playlist)
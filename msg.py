@@ -7,10 +7,23 @@ class MsgType(IntEnum):
     READ = auto()
     FRAME_ACK = auto()
     OPEN_ACK = auto()
+    RESIZE = auto()
+    LOOP = auto()
+    READ_SHEET = auto()
+    PREFETCH = auto()
+
+    # video to decoder pool
+    DECODE = auto()
+    # decoder pool to video
+    CHUNK_DONE = auto()
 
     # video to cmd
     VIDEO_OPEN_ACK = auto()
     VIDEO_FRAMES = auto()
+    VIDEO_LAYOUT = auto()
+    VIDEO_THUMBS = auto()
+    VIDEO_STATS = auto()
+    VIDEO_SHEET = auto()
 
     # view to cmd
     VIEW_OPEN = auto()
@@ -21,9 +34,34 @@ class MsgType(IntEnum):
     VIEW_SEEK = auto()
     VIEW_PLAYRATE = auto()
     VIEW_NAVIGATE = auto()
+    VIEW_RESIZE = auto()
+    VIEW_LOOP = auto()
+    VIEW_SHEET = auto()
+    VIEW_PREFETCH = auto()
+    VIEW_DROP_POLICY = auto()
+    VIEW_CLOSE = auto()
+
+    # 通过共享内存通信时唤醒阻塞在队列上的一方
+    WAKE = auto()
 
 class Msg:
     def __init__(self, type: MsgType, v_id: int, data) -> None:
         self.type = type
         self.v_id = v_id
         self.data = data
+
+    # 只包含整数的消息可以写入共享内存中的定长int64记录，不需要pickle
+    # 记录格式：type, v_id, len(data), data...
+    RECORD_INTS = 8
+
+    def to_record(self, rec):
+        n = len(self.data)
+        assert n <= self.RECORD_INTS - 3
+        rec[:3] = (self.type, self.v_id, n)
+        rec[3 : 3 + n] = self.data
+
+    @classmethod
+    def from_record(cls, rec) -> "Msg":
+        values = rec.tolist()
+        n = values[2]
+        return cls(MsgType(values[0]), values[1], tuple(values[3 : 3 + n]))
@@ -0,0 +1,38 @@
+import os
+from typing import List, Optional
+
+
+class Playlist:
+    """
+    依次标注的视频列表，文本文件中每行一个视频路径，相对路径相对于列表文件所在的目录
+    """
+
+    def __init__(self, paths: List[str]) -> None:
+        self.paths = paths
+        self.index = -1
+
+    @classmethod
+    def from_file(cls, list_path) -> "Playlist":
+        root = os.path.dirname(os.path.abspath(list_path))
+        paths = []
+        with open(list_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                paths.append(os.path.normpath(os.path.join(root, line)))
+        return cls(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def current(self) -> Optional[str]:
+        if 0 <= self.index < len(self.paths):
+            return self.paths[self.index]
+        return None
+
+    def peek(self, offset) -> Optional[str]:
+        i = self.index + offset
+        if 0 <= i < len(self.paths):
+            return self.paths[i]
+        return None
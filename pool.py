@@ -0,0 +1,118 @@
+import multiprocessing as mp
+from multiprocessing import Queue
+import numpy as np
+from msg import Msg, MsgType as msgtp
+from decoder import Decoder
+from shm import attach_shm, release_shm
+import latency
+from typing import List
+
+
+def fn_proc_decoder(q_task: Queue, q_cmd: Queue):
+    """
+    解码进程：解码一块连续的帧，写入共享内存中视频进程预留的位置，完成后通知视频进程
+    """
+    decoder = Decoder()
+    shm = None
+    while True:
+        task = q_task.get()
+        if task is None:
+            break
+        task_id, path, display_size, size_steps, frame_ids, rate, shm_layout = task.data
+        shm_name, shm_start, shm_cap, shape, dtype = shm_layout
+        if decoder.path != path:
+            decoder.open(path)
+        decoder.display_size = display_size
+        decoder.size_steps = size_steps
+        if shm is None or shm.name != shm_name:
+            if shm is not None:
+                release_shm(shm)
+            shm = attach_shm(shm_name)
+        shm_mat = np.ndarray((shm_cap, *shape), dtype=dtype, buffer=shm.buf)
+        frame_nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm_times = latency.slot_times(shm.buf, shm_cap, frame_nbytes)
+        decoded = 0
+        decode_start = decoder.decoded
+        for frame_id in frame_ids:
+            t = latency.clock()
+            frame = decoder.decode_frame(frame_id, rate)
+            if frame is None or frame.shape != shm_mat.shape[1:]:
+                break
+            shm_id = (shm_start + decoded) % shm_cap
+            shm_mat[shm_id] = frame
+            shm_times[shm_id, latency.DECODE_START] = t
+            shm_times[shm_id, latency.DECODE_END] = latency.clock()
+            decoded += 1
+        del shm_mat, shm_times
+        # 同时报告实际解码的帧数(包括只grab的帧)，用于基准测试
+        data = (task_id, decoded, decoder.decoded - decode_start)
+        q_cmd.put(Msg(msgtp.CHUNK_DONE, task.v_id, data), block=False)
+    decoder.release()
+    if shm is not None:
+        release_shm(shm)
+
+
+class ChunkJob:
+    """
+    一块已经预留了共享内存的帧，按预留的顺序发送给窗口
+    """
+
+    def __init__(self, task_id, v_id, frame_ids: List[int], rate, shm_id, worker=None) -> None:
+        self.task_id = task_id
+        self.worker = worker  # 负责解码的进程，None表示在视频进程中解码
+        self.v_id = v_id
+        self.frame_ids = frame_ids
+        self.rate = rate
+        self.shm_id = shm_id
+        self.frame_cnt = len(frame_ids)
+        self.decoded = 0
+        self.done = False
+        # 请求已经被新的READ取代，这些位置不再发送给窗口
+        self.stale = False
+
+
+class DecoderPool:
+    """
+    多个解码进程，每个进程有自己的cv2.VideoCapture，结果通过q_cmd返回给视频进程
+    """
+
+    def __init__(self, n_workers, q_cmd: Queue) -> None:
+        self.q_tasks = [Queue() for _ in range(n_workers)]
+        self.procs = [
+            mp.Process(target=fn_proc_decoder, args=(q, q_cmd), daemon=True)
+            for q in self.q_tasks
+        ]
+        for p in self.procs:
+            p.start()
+        self.task_id = 0
+
+    def __len__(self):
+        """
+        还在运行的解码进程数
+        """
+        return len(self.alive_workers())
+
+    def alive_workers(self) -> List[int]:
+        return [i for i, p in enumerate(self.procs) if p.is_alive()]
+
+    def alive(self, worker) -> bool:
+        return self.procs[worker].is_alive()
+
+    def submit(self, key, v_id, data):
+        """
+        key相同的任务交给同一个解码进程(只在还在运行的进程中选)，返回(task_id, 解码进程)。
+        全部退出时任务不会被处理，由视频进程的recover_jobs解码
+        """
+        workers = self.alive_workers() or list(range(len(self.procs)))
+        worker = workers[key % len(workers)]
+        self.task_id += 1
+        self.q_tasks[worker].put(
+            Msg(msgtp.DECODE, v_id, (self.task_id, *data)), block=False
+        )
+        return self.task_id, worker
+
+    def close(self):
+        for q in self.q_tasks:
+            q.put(None, block=False)
+        for p in self.procs:
+            p.join()
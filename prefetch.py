@@ -0,0 +1,90 @@
+from decoder import Decoder
+from keyframe import KeyframeIndex, KeyframeIndexBuilder
+import cv2
+import constants
+
+
+class PrefetchJob:
+    """
+    标注当前视频时，视频进程空闲时预先打开播放列表中的下一个视频：
+    读取元数据和关键帧索引，按当前的显示大小解码开头的PREFETCH_FRAMES帧。
+    切换到这个视频时直接接管其中的cap和帧，不需要再冷启动。
+    没有保存的索引时分多次扫描数据包建立，每次step的耗时都很短，不会耽误当前视频
+    """
+
+    def __init__(self, path, display_size, size_steps=()) -> None:
+        self.path = path
+        self.display_size = display_size
+        self.size_steps = size_steps
+        self.decoder = None
+        self.builder = None
+        self.fps = 1
+        self.total_frames = 0
+        self.frames = []
+        self.failed = False
+
+    def done(self):
+        if self.failed:
+            return True
+        if self.decoder is None:
+            return False
+        target = min(constants.Config.PREFETCH_FRAMES, self.total_frames)
+        return len(self.frames) >= target
+
+    def step(self):
+        """
+        先读取或者分多次建立关键帧索引，然后打开视频，之后每次解码一帧
+        """
+        if self.decoder is None:
+            if self.builder is None:
+                kf_index = KeyframeIndex.load(self.path)
+                if kf_index is None:
+                    self.builder = KeyframeIndexBuilder(self.path)
+                    return
+            else:
+                if not self.builder.step(constants.Config.PREFETCH_INDEX_PACKETS):
+                    return
+                kf_index = self.builder.index
+                self.builder = None
+                if kf_index is not None:
+                    kf_index.save(self.path)
+            self.decoder = Decoder()
+            self.decoder.open_with_index(self.path, kf_index)
+            self.decoder.display_size = self.display_size
+            self.decoder.size_steps = self.size_steps
+            cap = self.decoder.cap
+            if not cap.isOpened():
+                self.failed = True
+                return
+            self.fps = cap.get(cv2.CAP_PROP_FPS)
+            self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            return
+        frame = self.decoder.decode_frame(len(self.frames))
+        if frame is None:
+            self.failed = True
+        else:
+            self.frames.append(frame)
+
+    def matches(self, path, display_size):
+        """
+        显示大小改变之后预先解码的帧形状不对，不能使用
+        """
+        return (
+            path == self.path
+            and display_size == self.display_size
+            and len(self.frames) > 0
+        )
+
+    def take_decoder(self):
+        decoder = self.decoder
+        self.decoder = None
+        return decoder
+
+    def release(self):
+        if self.builder is not None:
+            self.builder.release()
+            self.builder = None
+        if self.decoder is not None:
+            self.decoder.release()
+            self.decoder = None
+        self.frames = []
@@ -0,0 +1,207 @@
+import os
+import hashlib
+import numpy as np
+import constants
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    # windows上被内存映射的文件不能删除，不需要加锁
+    fcntl = None
+
+
+def lock_file(path, create=True) -> int:
+    """
+    打开path并加排它锁，返回文件描述符，关闭之后释放；已经被其它进程锁住时抛出BlockingIOError。
+    加锁之前文件可能已经被其它进程删除，这时重新打开
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0))
+        if fcntl is None:
+            return fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            if not create:
+                os.close(fd)
+                raise
+        except OSError:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+class ProxyCache:
+    """
+    磁盘上每个视频缩放后的帧，用视频的路径、大小、修改时间和帧的形状作为key。
+    解码时帧的高度按PROXY_HEIGHTS分档(见size_steps)，窗口大小在同一档之内变化时共用一份缓存。
+    帧按照写入的顺序放在.dat文件的slot中，.idx记录每一帧所在的slot(-1表示没有)，
+    两个文件都通过内存映射读写。打开期间锁住.idx，同一份缓存只能被一个进程使用。
+    所有视频的缓存总大小超过上限时，删除最久没有打开过的、没有被使用的视频的缓存
+    """
+
+    IDX_SUFFIX = ".idx"
+    DAT_SUFFIX = ".dat"
+    GROW_FRAMES = 64  # .dat文件每次增大这么多帧
+    FORMAT = "bgr"  # 帧的像素格式改变之后旧的缓存不再有效
+
+    def __init__(self, root, key, total_frames, shape, budget) -> None:
+        self.root = root
+        self.key = key
+        self.shape = tuple(shape)
+        self.frame_nbytes = int(np.prod(shape))
+        self.budget = budget
+        self.full = False
+
+        idx_path = self.path(key, self.IDX_SUFFIX)
+        dat_path = self.path(key, self.DAT_SUFFIX)
+        self.lock = lock_file(idx_path)
+        try:
+            valid = os.path.exists(dat_path)
+            if valid:
+                valid = os.path.getsize(idx_path) == total_frames * 4
+                valid = valid and os.path.getsize(dat_path) % self.frame_nbytes == 0
+            if not valid:
+                self.index = np.memmap(idx_path, np.int32, mode="w+", shape=(total_frames,))
+                self.index[:] = -1
+                open(dat_path, "wb").close()
+            else:
+                self.index = np.memmap(idx_path, np.int32, mode="r+", shape=(total_frames,))
+                # 最近打开过的缓存最后被删除
+                os.utime(idx_path)
+
+            self.capacity = os.path.getsize(dat_path) // self.frame_nbytes
+            self.slots = int(self.index.max(initial=-1)) + 1
+            if self.slots > self.capacity:
+                self.index[:] = -1
+                self.slots = 0
+            self.data = None
+            self.map_data()
+        except OSError:
+            os.close(self.lock)
+            raise
+
+    @classmethod
+    def size_steps(cls):
+        """
+        使用磁盘缓存时解码的高度档位(Decoder.size_steps)，只缩小不放大，
+        缓存中的帧和显示的帧相同，读写时都不需要缩放
+        """
+        if constants.Config.PROXY_CACHE_GB <= 0:
+            return ()
+        return tuple(constants.Config.PROXY_HEIGHTS)
+
+    @classmethod
+    def open(cls, path, total_frames, shape) -> Optional["ProxyCache"]:
+        config = constants.Config
+        if config.PROXY_CACHE_GB <= 0 or total_frames <= 0:
+            return None
+        try:
+            stat = os.stat(path)
+            text = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{shape}|{cls.FORMAT}"
+            key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            os.makedirs(config.PROXY_CACHE_DIR, exist_ok=True)
+            budget = int(config.PROXY_CACHE_GB * 1024 * 1024 * 1024)
+            return cls(config.PROXY_CACHE_DIR, key, total_frames, shape, budget)
+        except OSError:
+            # 缓存目录不可写，或者其它进程正在使用同一份缓存时不使用磁盘缓存
+            return None
+
+    def path(self, key, suffix):
+        return os.path.join(self.root, key + suffix)
+
+    def map_data(self):
+        self.data = None
+        if self.capacity > 0:
+            self.data = np.memmap(
+                self.path(self.key, self.DAT_SUFFIX),
+                np.uint8,
+                mode="r+",
+                shape=(self.capacity, *self.shape),
+            )
+
+    def get(self, frame_id) -> Optional[np.ndarray]:
+        if frame_id < 0 or frame_id >= len(self.index):
+            return None
+        slot = int(self.index[frame_id])
+        if slot < 0:
+            return None
+        return self.data[slot]
+
+    def put(self, frame_id, frame):
+        if (
+            self.full
+            or frame_id < 0
+            or frame_id >= len(self.index)
+            or frame.shape != self.shape
+            or self.index[frame_id] >= 0
+        ):
+            return
+        if self.slots >= self.capacity and not self.grow():
+            return
+        self.data[self.slots] = frame
+        self.index[frame_id] = self.slots
+        self.slots += 1
+
+    def grow(self):
+        capacity = self.capacity + self.GROW_FRAMES
+        nbytes = capacity * self.frame_nbytes
+        try:
+            if not self.evict(nbytes):
+                self.full = True
+                return False
+            with open(self.path(self.key, self.DAT_SUFFIX), "r+b") as f:
+                f.truncate(nbytes)
+        except OSError:
+            self.full = True
+            return False
+        self.capacity = capacity
+        self.map_data()
+        return True
+
+    def evict(self, nbytes):
+        """
+        删除其它视频的缓存，直到加上nbytes之后不超过上限，做不到时返回False。
+        其它进程正在使用的缓存不删除
+        """
+        others = []
+        total = nbytes
+        for name in os.listdir(self.root):
+            key, suffix = os.path.splitext(name)
+            if suffix != self.DAT_SUFFIX or key == self.key:
+                continue
+            size = os.path.getsize(self.path(key, self.DAT_SUFFIX))
+            idx_path = self.path(key, self.IDX_SUFFIX)
+            used = os.path.getmtime(idx_path) if os.path.exists(idx_path) else 0
+            others.append((used, key, size))
+            total += size
+        others.sort()
+        for _, key, size in others:
+            if total <= self.budget:
+                break
+            try:
+                fd = lock_file(self.path(key, self.IDX_SUFFIX), create=False)
+            except FileNotFoundError:
+                fd = None
+            except OSError:
+                continue
+            try:
+                for suffix in (self.IDX_SUFFIX, self.DAT_SUFFIX):
+                    if os.path.exists(self.path(key, suffix)):
+                        os.remove(self.path(key, suffix))
+                total -= size
+            except OSError:
+                pass
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        return total <= self.budget
+
+    def close(self):
+        self.index.flush()
+        self.index = None
+        self.data = None
+        os.close(self.lock)
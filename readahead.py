@@ -0,0 +1,59 @@
+import constants
+from collections import deque
+
+
+class ReadAhead:
+    """
+    自适应的预读深度(按采样后的帧计)：
+    - 预读的帧要能覆盖lead_sec秒的播放，解码速度跟不上显示速度时按比例加深
+    - 一段时间内卡顿次数超过目标时加长lead_sec，长时间没有卡顿时逐渐缩短
+    """
+
+    def __init__(self) -> None:
+        config = constants.Config
+        self.lead_sec = config.READ_AHEAD_SEC
+        self.produce_fps = None  # 视频进程有请求时每秒能发送的帧数
+        self.underruns = 0
+        self.recent_underruns = deque()
+        self.last_adjust_t = 0
+
+    def report(self, frames, busy_us):
+        """
+        视频进程在busy_us微秒内发送了frames帧
+        """
+        if busy_us <= 0:
+            return
+        fps = frames * 1e6 / busy_us
+        if self.produce_fps is None:
+            self.produce_fps = fps
+        else:
+            self.produce_fps = 0.8 * self.produce_fps + 0.2 * fps
+
+    def underrun(self, cur_t):
+        self.underruns += 1
+        self.recent_underruns.append(cur_t)
+        self.adjust(cur_t)
+
+    def adjust(self, cur_t):
+        config = constants.Config
+        window = config.UNDERRUN_WINDOW_SEC
+        while self.recent_underruns and self.recent_underruns[0] < cur_t - window:
+            self.recent_underruns.popleft()
+        if len(self.recent_underruns) > config.UNDERRUN_TARGET:
+            self.lead_sec = min(self.lead_sec * 1.5, config.READ_AHEAD_MAX_SEC)
+            self.recent_underruns.clear()
+            self.last_adjust_t = cur_t
+        elif cur_t - self.last_adjust_t > window and not self.recent_underruns:
+            self.lead_sec = max(self.lead_sec * 0.8, config.READ_AHEAD_SEC)
+            self.last_adjust_t = cur_t
+
+    def depth(self, consume_fps, max_frames, cur_t):
+        """
+        consume_fps为每秒显示的帧数，max_frames为共享内存中最多能放下的帧数
+        """
+        self.adjust(cur_t)
+        depth = consume_fps * self.lead_sec
+        if self.produce_fps is not None and self.produce_fps < consume_fps:
+            depth *= consume_fps / max(self.produce_fps, 1e-3)
+        depth = max(int(depth), constants.Config.READ_AHEAD_MIN_FRAMES)
+        return max(min(depth, max_frames), 1)
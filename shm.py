@@ -0,0 +1,33 @@
+from multiprocessing import shared_memory, resource_tracker
+
+
+def create_shm(size) -> shared_memory.SharedMemory:
+    return shared_memory.SharedMemory(create=True, size=size)
+
+
+def attach_shm(name) -> shared_memory.SharedMemory:
+    """
+    打开其它进程创建的共享内存，由创建者负责unlink。
+    打开的一方不登记到resource_tracker：和创建者共用resource_tracker时注销会删掉创建者的登记，
+    使用自己的resource_tracker时登记了又会在退出时被unlink
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # python < 3.13没有track参数，打开时暂时跳过登记
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def release_shm(shm: shared_memory.SharedMemory, unlink=False):
+    """
+    释放之前需要删除所有引用这块共享内存的numpy数组
+    """
+    shm.close()
+    if unlink:
+        shm.unlink()
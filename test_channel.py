@@ -0,0 +1,65 @@
+import multiprocessing as mp
+import queue
+import random
+import time
+import unittest
+from channel import Channel
+from msg import Msg, MsgType as msgtp
+
+COUNT = 2000
+
+
+def fn_producer(ctrl_arr, q_wake):
+    """
+    与视频进程相同：写入消息环之后看到Thread的标志再唤醒
+    """
+    channel = Channel(ctrl_arr)
+    rng = random.Random(0)
+    for i in range(COUNT):
+        while channel.space() == 0:
+            time.sleep(0.0001)
+        channel.push(Msg(msgtp.VIDEO_FRAMES, 0, (0, i, 1, 0, 1)))
+        if channel.take_sleeping(Channel.THREAD):
+            q_wake.put(Msg(msgtp.WAKE, 0, None))
+        if rng.random() < 0.3:
+            time.sleep(rng.random() * 0.0005)
+
+
+class ChannelTest(unittest.TestCase):
+    def test_no_lost_wakeup(self):
+        """
+        与Thread.read_msgs相同地阻塞，唤醒没有丢失时不会等到超时
+        """
+        ctrl_arr = Channel.alloc()
+        channel = Channel(ctrl_arr)
+        q_wake = mp.Queue()
+        proc = mp.Process(target=fn_producer, args=(ctrl_arr, q_wake))
+        proc.start()
+        received, timeouts = [], 0
+        deadline = time.time() + 60
+        while len(received) < COUNT and time.time() < deadline:
+            msg = channel.peek()
+            if msg is not None:
+                channel.pop()
+                received.append(msg.data[1])
+                continue
+            channel.set_sleeping(Channel.THREAD, True)
+            if channel.peek() is None:
+                try:
+                    q_wake.get(timeout=2)
+                except queue.Empty:
+                    timeouts += 1
+            channel.set_sleeping(Channel.THREAD, False)
+            # 被唤醒之前已经读到了消息时，唤醒留在队列中
+            while True:
+                try:
+                    q_wake.get_nowait()
+                except queue.Empty:
+                    break
+        proc.join()
+        self.assertEqual(received, list(range(COUNT)))
+        self.assertEqual(timeouts, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import os
+import random
+import unittest
+from typing import List, Optional
+from annotation import AnnotationManager, Annotation, sort_annotations, overlap_pairs
+from checker import check, check_partition, check_non_overlap
+from utils import VideoMetaData
+
+EVENT_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "event.json")
+
+
+def reference_check(ann_manager: AnnotationManager, video_meta: Optional[VideoMetaData] = None):
+    """
+    改写之前逐对比较的check，作为对照
+    """
+
+    def check_non_overlap2(anns1: List[Annotation], anns2: List[Annotation]):
+        errs = []
+        for a1 in anns1:
+            for a2 in anns2:
+                if a1.overlap(a2):
+                    errs.append(f"{a1}和{a2}有重叠部分")
+                    break
+        return errs
+
+    errs = []
+    total_frames = video_meta.total_frames if video_meta else None
+    if video_meta:
+        if video_meta.fps != 25:
+            errs.append("视频不是25fps")
+    change_annotations = sort_annotations(ann_manager.annotations["变化事件"])
+    playback_annotations = sort_annotations(ann_manager.annotations["回放"])
+    camera_annotations = sort_annotations(ann_manager.annotations["镜头情况"])
+
+    errs.extend(check_partition("变化事件", change_annotations, total_frames))
+    errs.extend(check_non_overlap("变化事件", change_annotations))
+
+    for e_name in ann_manager.event_groups["回放"].event_names:
+        anns = [ann for ann in playback_annotations if ann.event_name == e_name]
+        errs.extend(check_non_overlap("回放", anns))
+
+    for e_name in ann_manager.event_groups["镜头情况"].event_names:
+        anns = [ann for ann in camera_annotations if ann.event_name == e_name]
+        errs.extend(check_non_overlap("镜头情况", anns))
+
+    zoom_in_annotations = [ann for ann in camera_annotations if ann.event_name == "镜头拉近"]
+    zoom_out_annotations = [ann for ann in camera_annotations if ann.event_name == "镜头拉远"]
+    viewpoint_annotations = [ann for ann in camera_annotations if ann.event_name == "视角切换"]
+
+    errs.extend(check_non_overlap2(zoom_in_annotations, zoom_out_annotations))
+
+    for vp_ann in viewpoint_annotations:
+        if vp_ann.f0 != vp_ann.f1:
+            errs.append(f"{vp_ann}超过一帧")
+        else:
+            for ann in change_annotations + camera_annotations:
+                if ann.f0 == vp_ann.f0:
+                    continue
+                if ann.f0 < vp_ann.f0 and ann.f1 >= vp_ann.f0:
+                    errs.append(f"{vp_ann}切割了{ann}")
+
+    switch_annotations = [ann for ann in change_annotations if ann.event_name == "切换"]
+
+    for pb_ann in playback_annotations:
+        for sw_ann in switch_annotations:
+            if pb_ann.overlap(sw_ann) and not pb_ann.contain(sw_ann):
+                errs.append(f"{pb_ann}与{sw_ann}相交")
+
+    for sw_ann in switch_annotations:
+        special = False
+        for cm_ann in camera_annotations:
+            if cm_ann.event_name == "视角切换":
+                continue
+            elif cm_ann.equal(sw_ann):
+                special = True
+            else:
+                prev_shot, next_shot = False, False
+                for ch_ann in change_annotations:
+                    if ch_ann.f0 == ch_ann.f1:
+                        if ch_ann.f0 == sw_ann.f0 - 1:
+                            prev_shot = True
+                        elif ch_ann.f0 == sw_ann.f1 + 1:
+                            next_shot = True
+                f0, f1 = sw_ann.f0, sw_ann.f1
+                if prev_shot:
+                    f0 -= 1
+                if next_shot:
+                    f1 += 1
+                prev_match = sw_ann.f0 == cm_ann.f0 or f0 == cm_ann.f0
+                after_match = sw_ann.f1 == cm_ann.f1 or f1 == cm_ann.f1
+                if prev_match and after_match:
+                    special = True
+
+            if special:
+                break
+
+        if special:
+            continue
+
+        for cm_ann in camera_annotations:
+            if cm_ann.overlap(sw_ann):
+                errs.append(f"{cm_ann}与{sw_ann}相交")
+
+    for sw_ann1 in switch_annotations:
+        for sw_ann2 in switch_annotations:
+            if sw_ann1.f0 == sw_ann2.f1 + 1:
+                errs.append(f"{sw_ann2}与{sw_ann1}连续")
+                break
+
+    return errs
+
+
+def random_manager(rng: random.Random, n, span, partition):
+    """
+    随机生成标注，包含只有一帧的和起始帧大于终止帧的标注
+    """
+    manager = AnnotationManager.from_json(EVENT_JSON)
+    names = manager.get_all_events()
+    change_names = manager.event_groups["变化事件"].event_names
+    if partition:
+        f = 0
+        while f < span:
+            length = rng.choice([1, 1, 2, 3, rng.randint(1, 30)])
+            name = rng.choice(change_names + ["切换"] * 3)
+            manager.add_annotation(name, f, f + length - 1)
+            f += length
+    for _ in range(n):
+        name = rng.choice(names + ["切换", "视角切换", "镜头拉近", "镜头拉远"] * 2)
+        f0 = rng.randint(0, span)
+        if manager.get_event_type(name) == "shot" and rng.random() < 0.8:
+            f1 = f0
+        else:
+            f1 = f0 + rng.choice([-3, -1, 0, 0, 1, 2, rng.randint(-20, 40)])
+        manager.add_annotation(name, f0, f1)
+    return manager
+
+
+class CheckerTest(unittest.TestCase):
+    def test_same_as_reference(self):
+        rng = random.Random(0)
+        for _ in range(1500):
+            manager = random_manager(
+                rng, rng.randint(0, 40), rng.choice([10, 30, 100, 300]), rng.random() < 0.5
+            )
+            self.assertEqual(check(manager), reference_check(manager))
+
+    def test_overlap_pairs(self):
+        rng = random.Random(1)
+        for _ in range(1000):
+            lists = []
+            for _ in range(2):
+                anns = []
+                for _ in range(rng.randint(0, 25)):
+                    ann = Annotation("x", "interval")
+                    ann.f0 = rng.randint(0, 60)
+                    ann.f1 = ann.f0 + rng.randint(-10, 20)
+                    anns.append(ann)
+                lists.append(anns)
+            a, b = lists
+            expected = [
+                (i, j)
+                for i in range(len(a))
+                for j in range(i + 1, len(a))
+                if a[i].overlap(a[j])
+            ]
+            self.assertEqual(overlap_pairs(a), expected)
+            self.assertEqual(bool(overlap_pairs(a, first=True)), bool(expected))
+            expected = [
+                (i, j) for i in range(len(a)) for j in range(len(b)) if a[i].overlap(b[j])
+            ]
+            self.assertEqual(overlap_pairs(a, b), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
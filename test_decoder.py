@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import constants
+from bench import write_video, synth_frame_id
+from decoder import Decoder
+from keyframe import KeyframeIndex, KeyframeStream
+
+
+class ShiftedCapture:
+    """
+    跳转时落在别的帧上，模拟opencv在可变帧率视频上按帧率换算的跳转
+    """
+
+    def __init__(self, cap, shift) -> None:
+        self.cap = cap
+        self.shift = shift
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES and value > 0:
+            value = max(value + self.shift, 1)
+        return self.cap.set(prop, value)
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+class DecoderTest(unittest.TestCase):
+    FRAMES = 240
+    GOP = 12
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.saved = constants.Config.KEYFRAME_STREAM_DIR
+        constants.Config.KEYFRAME_STREAM_DIR = os.path.join(cls.dir, "kfstream")
+        cls.path = os.path.join(cls.dir, "gop12.mp4")
+        if not write_video(cls.path, 320, 192, cls.GOP, cls.FRAMES, 25):
+            raise unittest.SkipTest("cv2不能生成mp4v视频")
+
+    @classmethod
+    def tearDownClass(cls):
+        constants.Config.KEYFRAME_STREAM_DIR = cls.saved
+        shutil.rmtree(cls.dir, ignore_errors=True)
+
+    def setUp(self):
+        self.decoder = Decoder()
+        self.decoder.open(self.path)
+
+    def tearDown(self):
+        self.decoder.release()
+
+    def play(self, rate):
+        frames = {}
+        for frame_id in range(0, self.FRAMES, rate):
+            frame = self.decoder.decode_frame(frame_id, rate)
+            self.assertIsNotNone(frame)
+            frames[frame_id] = synth_frame_id(frame)
+        return frames
+
+    def test_exact_frames(self):
+        frames = self.play(1)
+        self.assertEqual(frames, {f: f for f in frames})
+        self.decoder.decode_frame(100)
+        self.assertEqual(synth_frame_id(self.decoder.decode_frame(37)), 37)
+
+    def test_seek_checked_by_pts(self):
+        cap = self.decoder.cap
+        for shift in (5, -5, 30):
+            self.decoder.cap = ShiftedCapture(cap, shift)
+            for frame_id in (100, 37, 200, 13, 239, 150):
+                frame = self.decoder.decode_frame(frame_id)
+                self.assertEqual(synth_frame_id(frame), frame_id)
+        self.decoder.cap = cap
+
+    def test_keyframes_only(self):
+        rate = constants.Config.KEYFRAME_SKIP_RATE
+        kf_index = self.decoder.kf_index
+        self.assertIsNotNone(kf_index.stream)
+        frames = self.play(rate)
+        # 高倍速时只解码关键帧，每个采样点显示它之前最近的关键帧
+        self.assertEqual(frames, {f: kf_index.keyframe_before(f) for f in frames})
+        self.assertLessEqual(self.decoder.decoded, len(kf_index.keyframes))
+        self.assertLess(self.decoder.decoded, len(frames))
+
+        # 之后正常倍速仍然是准确的帧
+        self.assertEqual(synth_frame_id(self.decoder.decode_frame(101)), 101)
+        # 码流在缓存目录中，不在视频旁边
+        self.assertEqual(
+            os.path.dirname(kf_index.stream.path), constants.Config.KEYFRAME_STREAM_DIR
+        )
+        self.assertFalse([n for n in os.listdir(self.dir) if KeyframeStream.SUFFIX in n])
+
+    def test_without_stream(self):
+        saved = constants.Config.KEYFRAME_STREAM_GB
+        constants.Config.KEYFRAME_STREAM_GB = 0
+        try:
+            kf_index = KeyframeIndex.build(self.path)
+        finally:
+            constants.Config.KEYFRAME_STREAM_GB = saved
+        self.assertIsNone(kf_index.stream)
+        # 没有码流时高倍速grab到每个采样点，仍然是准确的帧
+        self.decoder.open_with_index(self.path, kf_index)
+        frames = self.play(constants.Config.KEYFRAME_SKIP_RATE)
+        self.assertEqual(frames, {f: f for f in frames})
+
+    def test_normal_rate_decodes_every_frame(self):
+        rate = constants.Config.KEYFRAME_SKIP_RATE - 1
+        frames = self.play(rate)
+        self.assertEqual(frames, {f: f for f in frames})
+        self.assertGreaterEqual(self.decoder.decoded, self.FRAMES - rate)
+
+    def test_size_steps(self):
+        decoder = self.decoder
+        decoder.display_size = (300, 100)
+        self.assertEqual(decoder.frame_shape(), (100, 167, 3))
+        # 取不低于显示高度的最小一档，只缩小不放大
+        decoder.size_steps = (90, 120, 160)
+        self.assertEqual(decoder.frame_shape(), (120, 200, 3))
+        self.assertEqual(decoder.decode_frame(10).shape, (120, 200, 3))
+        decoder.size_steps = (240,)
+        self.assertEqual(decoder.frame_shape(), (192, 320, 3))
+        decoder.display_size = (1000, 1000)
+        self.assertEqual(decoder.frame_shape(), (192, 320, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
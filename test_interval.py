@@ -0,0 +1,36 @@
+import random
+import unittest
+from annotation import Annotation
+from interval import IntervalIndex
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def test_same_as_scan(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            items = []
+            for _ in range(rng.randint(0, 30)):
+                ann = Annotation("x", "interval")
+                ann.f0 = rng.randint(0, 80)
+                ann.f1 = ann.f0 + rng.choice([-2, 0, 0, 1, rng.randint(0, 60)])
+                items.append(ann)
+            index = IntervalIndex()
+            index.reset(items)
+            for f in range(-2, 150):
+                expected = [item for item in items if item.f0 <= f <= item.f1]
+                expected.sort(key=lambda item: item.f0)
+                self.assertEqual(index.covering(f), tuple(expected))
+                lo, hi = index.span(f)
+                for g in (lo, None if hi is None else hi - 1):
+                    if g is not None:
+                        self.assertEqual(index.covering(g), tuple(expected))
+                for g in (lo, hi):
+                    if g is not None:
+                        # 边界之外的一帧的覆盖集合不同
+                        other = g - 1 if g == lo else g
+                        self.assertNotEqual(index.covering(other), tuple(expected))
+                self.assertEqual(index.next_boundary(f), hi)
+
+
+if __name__ == "__main__":
+    unittest.main()
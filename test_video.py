@@ -0,0 +1,108 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import unittest
+import constants
+from bench import write_video, synth_frame_id
+from channel import Channel
+
+
+class ReverseChunkTest(unittest.TestCase):
+    """
+    倒放按块解码，GOP长短不同时每显示一帧解码的帧数都应该接近倍速(中间的帧只grab)
+    """
+
+    FRAMES = 300
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        config = constants.Config
+        cls.saved = (config.DECODER_WORKERS, config.PROXY_CACHE_GB, config.KEYFRAME_STREAM_DIR)
+        config.DECODER_WORKERS = 0
+        config.PROXY_CACHE_GB = 0
+        config.KEYFRAME_STREAM_DIR = cls.dir
+
+    @classmethod
+    def tearDownClass(cls):
+        config = constants.Config
+        config.DECODER_WORKERS, config.PROXY_CACHE_GB, config.KEYFRAME_STREAM_DIR = cls.saved
+        shutil.rmtree(cls.dir, ignore_errors=True)
+
+    def play_reverse(self, gop, rate):
+        from video import Video
+
+        path = os.path.join(self.dir, f"gop{gop}" + (".avi" if gop == 1 else ".mp4"))
+        if not os.path.exists(path) and not write_video(
+            path, 320, 192, gop, self.FRAMES, 25
+        ):
+            self.skipTest(f"cv2不能生成GOP为{gop}的视频")
+        video = Video(mp.Queue(), mp.Queue(), Channel.alloc())
+        try:
+            self.assertTrue(video.open(path) is not False)
+            video.sample_rate = -rate
+            start = video.decoder.decoded
+            frame_ids = range(self.FRAMES - 1, -1, -rate)
+            for frame_id in frame_ids:
+                frame = video.reverse_frame(frame_id)
+                self.assertEqual(synth_frame_id(frame), frame_id)
+            return (video.decoder.decoded - start) / len(frame_ids)
+        finally:
+            video.shutdown()
+
+    def test_short_gop(self):
+        # 每一块只剩一帧时约为17
+        self.assertLess(self.play_reverse(1, 1), 2)
+        self.assertLess(self.play_reverse(1, 4), 5)
+
+    def test_gop12(self):
+        self.assertLess(self.play_reverse(12, 1), 2)
+
+
+class DeadWorkerTest(unittest.TestCase):
+    """
+    解码进程意外退出之后，交给它的块由视频进程自己解码，不会一直等待
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config = constants.Config
+        self.saved = (config.DECODER_WORKERS, config.PROXY_CACHE_GB, config.KEYFRAME_STREAM_DIR)
+        config.DECODER_WORKERS = 1
+        config.PROXY_CACHE_GB = 0
+        config.KEYFRAME_STREAM_DIR = self.dir
+
+    def tearDown(self):
+        config = constants.Config
+        config.DECODER_WORKERS, config.PROXY_CACHE_GB, config.KEYFRAME_STREAM_DIR = self.saved
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_recover(self):
+        from video import Video
+
+        path = os.path.join(self.dir, "gop12.mp4")
+        if not write_video(path, 320, 192, 12, 120, 25):
+            self.skipTest("cv2不能生成mp4视频")
+        video = Video(mp.Queue(), mp.Queue(), Channel.alloc())
+        try:
+            self.assertTrue(video.open(path) is not False)
+            video.read(1, 60, 1)
+            self.assertTrue(video.schedule_chunks())
+            frame_ids = [f for job in video.jobs for f in job.frame_ids]
+            # 已经发出的CHUNK_DONE也可能还没有读取，结果相同
+            proc = video.pool.procs[0]
+            proc.kill()
+            proc.join()
+            video.recover_jobs()
+            self.assertIsNone(video.pool)
+            self.assertFalse(video.jobs)
+            for frame_id in frame_ids:
+                self.assertEqual(synth_frame_id(video.lookup(frame_id)), frame_id)
+            video.wait_jobs()
+        finally:
+            video.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
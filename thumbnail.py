@@ -0,0 +1,92 @@
+import numpy as np
+from decoder import Decoder
+import constants
+from typing import List
+
+
+class ThumbnailJob:
+    """
+    视频进程空闲时为整段视频生成缩略图，每隔THUMB_INTERVAL_SEC秒取一帧。
+    先生成稀疏的再逐步加密，这样很快就能覆盖整段视频；
+    使用单独的cap，不影响播放时cap的位置
+    """
+
+    def __init__(self, path, total_frames, fps) -> None:
+        self.path = path
+        self.total_frames = total_frames
+        self.fps = fps
+        self.decoder = None
+        self.targets = []
+        self.next = 0
+
+        self.batch_ids = []
+        self.batch = []
+
+    def plan(self, kf_index) -> List[int]:
+        """
+        每一段取关键帧之后第SEEK_BACKOFF帧：opencv跳转到这一帧时正好从关键帧开始解码，
+        不需要解码前一个GOP
+        """
+        config = constants.Config
+        step = max(
+            int(round(self.fps * config.THUMB_INTERVAL_SEC)),
+            -(-self.total_frames // config.THUMB_MAX_COUNT),
+            1,
+        )
+        ids = []
+        for t in range(0, self.total_frames, step):
+            f = t
+            if kf_index is not None:
+                keyframe = kf_index.keyframe_after(t - 1)
+                if keyframe is not None:
+                    f = keyframe + Decoder.SEEK_BACKOFF
+                    if f >= t + step or f >= self.total_frames:
+                        f = t
+            if not ids or f > ids[-1]:
+                ids.append(f)
+
+        # 由粗到细的顺序
+        order = []
+        added = set()
+        stride = 1
+        while stride * 2 < len(ids):
+            stride *= 2
+        while stride >= 1:
+            for i in range(0, len(ids), stride):
+                if i not in added:
+                    added.add(i)
+                    order.append(ids[i])
+            stride //= 2
+        return order
+
+    def done(self):
+        return self.decoder is not None and self.next >= len(self.targets)
+
+    def step(self):
+        """
+        解码一张缩略图，攒够一批或者全部完成时返回(帧号列表, 缩略图数组)
+        """
+        if self.decoder is None:
+            self.decoder = Decoder()
+            self.decoder.open(self.path)
+            size = constants.Config.THUMB_WIDTH
+            self.decoder.display_size = (size, size)
+            self.targets = self.plan(self.decoder.kf_index)
+        if self.next < len(self.targets):
+            frame_id = self.targets[self.next]
+            self.next += 1
+            frame = self.decoder.decode_frame(frame_id)
+            if frame is not None:
+                self.batch_ids.append(frame_id)
+                self.batch.append(frame)
+        if self.batch and (
+            len(self.batch) >= constants.Config.THUMB_BATCH or self.done()
+        ):
+            batch = (self.batch_ids, np.stack(self.batch))
+            self.batch_ids, self.batch = [], []
+            return batch
+        return None
+
+    def release(self):
+        if self.decoder is not None:
+            self.decoder.release()
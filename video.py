@@ -3,71 +3,127 @@ from multiprocessing import Queue
 from msg import Msg, MsgType as msgtp
 import numpy as np
 from utils import VideoMetaData
-import time
-from multiprocessing import RawArray
+from decoder import Decoder
+from pool import DecoderPool, ChunkJob
+from cache import FrameCache
+from thumbnail import ThumbnailJob
+from prefetch import PrefetchJob
+from proxy import ProxyCache
+from channel import Channel
+import constants
+from multiprocessing import Array
+from shm import create_shm, release_shm
+import latency
 import queue
+import time
+from collections import deque
 
 
 class Video:
-    def __init__(self, q_video: Queue, q_cmd: Queue, shm_arr: RawArray) -> None:
-        self.cap = None
+    def __init__(self, q_video: Queue, q_cmd: Queue, ctrl_arr: Array) -> None:
+        self.decoder = Decoder()
+        self.decoder.interrupt = self.cancelled
+        self.decoder.size_steps = ProxyCache.size_steps()
         self.fps = 1
-        self.width, self.height = 0, 0
         self.total_frames = 0
+        self.cache = FrameCache(constants.Config.FRAME_CACHE_MB * 1024 * 1024)
 
         self.close = False
 
         self.q_video = q_video
         self.q_cmd = q_cmd
+        self.channel = Channel(ctrl_arr)
 
         self.frame_start = 0
         self.frame_end = -1
         self.frame_cur = 0
-        self.frame_rd = 0
         self.frame_nbytes = 0
         self.sample_rate = 1
+        # 正在处理的READ所属的跳转，Thread跳转之后这个READ剩下的帧都不需要了
+        self.read_epoch = 0
+
+        # 倒放时按块解码，chunks中最多保存当前块和下一块
+        self.chunks = deque()
+        self.chunk_next = None
 
         self.v_id = 0
 
-        self.shm_arr = shm_arr
-        self.shm_size = len(shm_arr)
+        # 打开视频时按照帧的大小和内存预算创建
+        self.shm = None
+        self.shm_nbytes = 0
+        self.shm_mat = None
+        self.shm_times = None  # 每个位置的帧的解码和写入消息环的时间
         self.shm_cap = -1
         self.shm_begin = 0
         self.shm_end = 0
+        self.shm_acked = 0  # Thread上一次ack到的位置
 
         self.waiting_open_ack = True
 
+        # 按共享内存预留顺序排列、还没有发送给窗口的帧
+        self.jobs = deque()
+        # 预留了但不发送的位置，shm_id -> 长度
+        self.holes = {}
+        # 当前交给同一个解码进程顺序解码的一段GOP的最后一帧(包含)，以及已经分出的段数
+        self.run_end = -1
+        self.run_count = 0
+        # 等待解码进程时收到的其它命令
+        self.deferred_cmds = deque()
+        # 空闲时生成缩略图
+        self.thumbs = None
+        # 空闲时预先打开播放列表中的下一个视频
+        self.prefetch = None
+        # 磁盘上缩放后的帧，再次打开同一个视频时不需要解码
+        self.proxy = None
+        # A-B循环的范围(包含两端)，空闲时把其中的帧解码并固定在缓存中
+        self.loop = None
+        self.loop_next = 0  # 下一个要固定的帧
+
+        # 有请求时发送的帧数和花费的时间，定期报告给Thread用于决定预读的深度
+        self.stats_frames = 0
+        self.stats_time = 0.0
+        self.stats_report_t = 0.0
+
+        self.pool = None
+        # 解码进程解码过的帧数，与decoder.decoded含义相同
+        self.pool_decoded = 0
+        if constants.Config.DECODER_WORKERS > 0:
+            self.pool = DecoderPool(constants.Config.DECODER_WORKERS, q_cmd)
+
     def open(self, path):
-        self.cap = cv2.VideoCapture(path)
-        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-        self.width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        self.height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        self.total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        ret, frame = self.cap.read()
-        if not ret:
-            return False
+        self.wait_jobs()
+        self.stop_thumbnails()
+        # 之前的跳转都属于旧的视频，不能中止第一帧的解码
+        self.read_epoch = self.channel.epoch()
+        frames = self.adopt_prefetch(path)
+        if not frames:
+            self.decoder.open(path)
+            cap = self.decoder.cap
+            self.fps = cap.get(cv2.CAP_PROP_FPS)
+            self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            frame = self.decoder.decode_frame(0)
+            if frame is None:
+                return False
+            frames = [frame]
+        frame = frames[0]
 
         self.v_id += 1
+        self.cache.clear()
+        self.loop = None
 
         self.frame_start = 0
         self.frame_end = -1  # (included)
         self.frame_cur = 0  # next frame to send
-        self.frame_rd = 0  # pos of opencv cap
         self.sample_rate = 1
-        self.frame_nbytes = frame.nbytes
+        self.chunks.clear()
+        self.chunk_next = None
+        self.run_end = -1
         self.frame_tot_cnt = 0
-
-        self.shm_begin = 0
-        self.shm_end = 0
-        self.shm_cap = self.shm_size // frame.nbytes
-        self.shm_mat = None
-
-        shm_sliced = np.frombuffer(self.shm_arr, dtype="b")[
-            : self.shm_cap * frame.nbytes
-        ]
-        self.shm_mat = np.frombuffer(shm_sliced, dtype=frame.dtype).reshape(
-            (self.shm_cap, *frame.shape)
-        )
+        self.setup_shm(frame.shape, frame.dtype)
+        self.open_proxy()
+        # 新的v_id之下只有这个视频的帧
+        for frame_id, f in enumerate(frames):
+            self.remember(frame_id, f)
 
         meta_data = VideoMetaData(path, self.total_frames, self.fps)
         self.q_video.put(
@@ -76,6 +132,7 @@ class Video:
                 self.v_id,
                 (
                     self.v_id,
+                    self.shm.name,
                     self.shm_cap,
                     frame.nbytes,
                     frame.shape,
@@ -86,20 +143,303 @@ class Video:
             block=False,
         )
         self.waiting_open_ack = True
+        self.thumbs = ThumbnailJob(path, self.total_frames, self.fps)
+
+    def adopt_prefetch(self, path):
+        """
+        要打开的正是预先打开的视频时接管它的cap，返回已经解码的帧，否则返回None
+        """
+        job = self.prefetch
+        self.prefetch = None
+        if job is None:
+            return None
+        if not job.matches(path, self.decoder.display_size):
+            job.release()
+            return None
+        self.decoder.release()
+        self.decoder = job.take_decoder()
+        self.decoder.interrupt = self.cancelled
+        self.fps = job.fps
+        self.total_frames = job.total_frames
+        return job.frames
+
+    def start_prefetch(self, path):
+        self.stop_prefetch()
+        if path is not None and path != self.decoder.path:
+            self.prefetch = PrefetchJob(
+                path, self.decoder.display_size, self.decoder.size_steps
+            )
+
+    def stop_prefetch(self):
+        if self.prefetch is not None:
+            self.prefetch.release()
+            self.prefetch = None
+
+    def step_prefetch(self):
+        """
+        播放不需要解码时推进预取，完成之后保留结果等待打开
+        """
+        if self.prefetch is None or self.prefetch.done():
+            return False
+        self.prefetch.step()
+        return True
+
+    def setup_shm(self, shape, dtype):
+        """
+        按照内存预算和帧的大小确定共享内存中能放多少帧，大小变化时重新创建共享内存
+        """
+        config = constants.Config
+        self.frame_nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.shm_begin = 0
+        self.shm_end = 0
+        self.shm_acked = 0
+        cap = (config.SHM_BUDGET_MB * 1024 * 1024) // self.frame_nbytes
+        self.shm_cap = min(max(cap, config.SHM_MIN_FRAMES), config.SHM_MAX_FRAMES)
+        nbytes = latency.shm_nbytes(self.shm_cap, self.frame_nbytes)
+        self.shm_mat = None
+        self.shm_times = None
+        if self.shm is not None and self.shm_nbytes != nbytes:
+            # Thread和解码进程还打开着的话，unlink之后它们的映射仍然有效
+            release_shm(self.shm, unlink=True)
+            self.shm = None
+        if self.shm is None:
+            self.shm = create_shm(nbytes)
+            self.shm_nbytes = nbytes
+        self.shm_mat = np.ndarray(
+            (self.shm_cap, *shape), dtype=dtype, buffer=self.shm.buf
+        )
+        self.shm_times = latency.slot_times(
+            self.shm.buf, self.shm_cap, self.frame_nbytes
+        )
+
+    def resize(self, display_size):
+        """
+        显示区域大小改变之后重新划分共享内存，v_id加一使之前的帧和缓存全部失效
+        """
+        if display_size is not None:
+            display_size = tuple(display_size)
+        if display_size == self.decoder.display_size:
+            return
+        self.decoder.display_size = display_size
+        if self.prefetch is not None:
+            # 按新的大小重新预取
+            self.start_prefetch(self.prefetch.path)
+        if self.decoder.cap is None:
+            return
+
+        shape = self.decoder.frame_shape()
+        if shape == self.shm_mat.shape[1:]:
+            return
+        self.wait_jobs()
+        self.v_id += 1
+        self.cache.clear()
+        # 按新的大小重新固定循环范围内的帧
+        self.set_loop(self.loop)
+        self.chunks.clear()
+        self.chunk_next = None
+        self.frame_cur = 0
+        self.frame_end = -1
+        self.sample_rate = 1
+        self.setup_shm(shape, self.shm_mat.dtype)
+        self.open_proxy()
+        self.q_video.put(
+            Msg(
+                msgtp.VIDEO_LAYOUT,
+                self.v_id,
+                (
+                    self.v_id,
+                    self.shm.name,
+                    self.shm_cap,
+                    self.frame_nbytes,
+                    shape,
+                    self.shm_mat.dtype,
+                ),
+            ),
+            block=False,
+        )
+        self.waiting_open_ack = True
+
+    def open_proxy(self):
+        """
+        按原始分辨率解码时帧太大，不使用磁盘缓存
+        """
+        self.close_proxy()
+        if self.decoder.display_size is not None:
+            self.proxy = ProxyCache.open(
+                self.decoder.path, self.total_frames, self.shm_mat.shape[1:]
+            )
+
+    def close_proxy(self):
+        if self.proxy is not None:
+            self.proxy.close()
+            self.proxy = None
+
+    def lookup(self, frame_id):
+        """
+        依次查找内存中的缓存和磁盘缓存
+        """
+        frame = self.cache.get((self.v_id, frame_id))
+        if frame is None and self.proxy is not None:
+            frame = self.proxy.get(frame_id)
+        return frame
+
+    def remember(self, frame_id, frame):
+        self.cache.put((self.v_id, frame_id), frame)
+        if self.proxy is not None:
+            self.proxy.put(frame_id, frame)
+
+    def get_direction(self):
+        return 1 if self.sample_rate > 0 else -1
+
+    def set_loop(self, loop):
+        self.cache.unpin_all()
+        self.loop = None if loop is None else tuple(loop)
+        if self.loop is not None:
+            self.loop_next = self.loop[0]
+
+    def pin_loop(self):
+        """
+        固定循环范围内的一帧，之后循环播放不再需要解码；返回是否有进展
+        """
+        if self.loop is None or self.decoder.cap is None:
+            return False
+        budget = constants.Config.LOOP_PIN_MB * 1024 * 1024
+        end = min(self.loop[1], self.total_frames - 1)
+        while self.loop_next <= end:
+            if self.cache.pinned_nbytes + self.frame_nbytes > budget:
+                break
+            frame_id = self.loop_next
+            self.loop_next += 1
+            frame = self.cache.get((self.v_id, frame_id))
+            if frame is None and self.proxy is not None:
+                frame = self.proxy.get(frame_id)
+                if frame is not None:
+                    # 从磁盘映射中复制出来
+                    frame = np.array(frame)
+            if frame is None:
+                frame = self.decoder.decode_frame(frame_id)
+                if frame is None:
+                    break
+                if self.proxy is not None:
+                    self.proxy.put(frame_id, frame)
+            self.cache.pin((self.v_id, frame_id), frame)
+            return True
+        self.loop_next = end + 1
+        return False
 
     def read(self, start, length, sample_rate):
-        self.sample_rate = sample_rate
-        if start == self.frame_end + 1:
-            self.frame_end = min(start + length - 1, self.total_frames - 1)
-        else:
-            if self.cap:
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        """
+        sample_rate为负数时表示倒放，此时读取start, start+sample_rate, ...直到start-length+1
+        """
+        # cap的跳转推迟到decode_frame中，缓存命中时不需要跳转
+        direction = 1 if sample_rate > 0 else -1
+        if start != self.frame_end + direction or direction != self.get_direction():
             self.frame_start = start
             self.frame_cur = start
-            self.frame_rd = start
+            self.chunks.clear()
+            self.chunk_next = None
+            self.run_end = -1
+            for job in self.jobs:
+                job.stale = True
+        self.sample_rate = sample_rate
+        if direction > 0:
             self.frame_end = min(start + length - 1, self.total_frames - 1)
+        else:
+            self.frame_end = max(start - length + 1, 0)
+
+    def cancelled(self):
+        """
+        Thread已经发出了新的跳转，对应的READ还在队列中
+        """
+        return self.channel.epoch() != self.read_epoch
+
+    def decode_chunk(self, frame_id):
+        """
+        倒放时以GOP为单位解码：从frame_id之前的关键帧附近顺序解码到frame_id，
+        保留其中需要发送的帧，之后再倒序发送
+        """
+        rate = abs(self.sample_rate)
+        lo = max(frame_id - rate * (constants.Config.REVERSE_CHUNK_FRAMES - 1), 0)
+        decoder = self.decoder
+        keyframes_only = decoder.keyframes_only(rate)
+        if decoder.kf_index is not None and not keyframes_only:
+            # 跳转到origin + SEEK_BACKOFF时opencv正好从origin开始解码，不会多解码前一个GOP，
+            # 但GOP很短时块只剩几帧，每一块都要付出跳转的代价。按每保留一帧解码的帧数
+            # 选择是否截断，GOP短时块跨过多个GOP，从seek_origin(lo)一直解码到frame_id
+            origin = decoder.seek_origin(frame_id)
+            clipped = max(lo, origin + decoder.SEEK_BACKOFF if origin > 0 else 0)
+
+            def cost(start):
+                kept = (frame_id - start) // rate + 1
+                return (frame_id - decoder.seek_origin(start) + 1) / kept
+
+            if cost(clipped) < cost(lo):
+                lo = clipped
+        self.chunk_next = None
+        if not keyframes_only and not decoder.locate(lo, rate):
+            return
+        chunk = {}
+        for f in range(lo + (frame_id - lo) % rate, frame_id + 1, rate):
+            # 跳过的帧在decode_frame中只grab
+            frame = decoder.decode_frame(f, rate)
+            if frame is None:
+                break
+            chunk[f] = frame
+            if not keyframes_only:
+                self.remember(f, frame)
+        if not chunk:
+            return
+        self.chunks.append(chunk)
+        first = min(chunk)
+        if first > 0:
+            # the first frame is always included
+            self.chunk_next = max(first - rate, 0)
+
+    def reverse_frame(self, frame_id):
+        for i, chunk in enumerate(self.chunks):
+            if frame_id in chunk:
+                for _ in range(i):
+                    self.chunks.popleft()
+                return chunk.pop(frame_id)
+        frame = self.lookup(frame_id)
+        if frame is not None:
+            return frame
+        self.chunks.clear()
+        self.decode_chunk(frame_id)
+        if self.chunks and frame_id in self.chunks[0]:
+            return self.chunks[0].pop(frame_id)
+        return None
+
+    def prefetch_chunk(self):
+        """
+        当前块还没有发送完时就解码下一块(双缓冲)
+        """
+        if (
+            self.get_direction() < 0
+            and len(self.chunks) == 1
+            and self.chunk_next is not None
+        ):
+            self.decode_chunk(self.chunk_next)
+            return True
+        return False
 
     def execute_cmd(self, cmd: Msg):
+        # 显示区域的大小和循环的范围与共享内存的划分无关
+        if cmd.type == msgtp.RESIZE:
+            self.resize(cmd.data)
+            return
+        if cmd.type == msgtp.LOOP:
+            self.set_loop(cmd.data)
+            return
+        if cmd.type == msgtp.WAKE:
+            return
+        # 解码进程的结果由job自己记录v_id
+        if cmd.type == msgtp.CHUNK_DONE:
+            self.chunk_done(*cmd.data)
+            return
+        # 旧视频的READ也会带来新的epoch，否则会一直认为被取消
+        if cmd.type == msgtp.READ:
+            self.read_epoch = max(self.read_epoch, cmd.data[3])
         if cmd.v_id != self.v_id:
             return
         if cmd.type == msgtp.CLOSE:
@@ -107,95 +447,425 @@ class Video:
         elif cmd.type == msgtp.OPEN:
             self.open(cmd.data)
         elif cmd.type == msgtp.READ:
-            start, length, sample_rate = cmd.data
+            start, length, sample_rate, _ = cmd.data
             self.read(start, length, sample_rate)
-        elif cmd.type == msgtp.FRAME_ACK:
-            shm_start, shm_len = cmd.data
-            next_shm_id = (shm_start + shm_len) % self.shm_cap
-            assert shm_start == self.shm_end
-            if shm_start != self.shm_end:
-                raise ValueError(f"{shm_start} {self.shm_end}")
-
-            if shm_start == self.shm_end:
-                self.shm_end = next_shm_id
+        elif cmd.type == msgtp.READ_SHEET:
+            self.read_sheet(*cmd.data)
+        elif cmd.type == msgtp.PREFETCH:
+            self.start_prefetch(cmd.data)
         elif cmd.type == msgtp.OPEN_ACK:
             if cmd.v_id == self.v_id:
                 self.waiting_open_ack = False
 
-    def read_cmd(self):
+    def read_cmd(self, block=False):
+        """
+        block为True时阻塞等待第一条命令，之后处理完队列中已有的命令
+        """
         while True:
             try:
-                cmd = self.q_cmd.get(block=False)
+                if self.deferred_cmds:
+                    cmd = self.deferred_cmds.popleft()
+                else:
+                    cmd = self.q_cmd.get(block=block, timeout=Channel.WAKE_TIMEOUT)
+                block = False
                 self.execute_cmd(cmd)
                 if self.close:
                     break
             except queue.Empty:
                 break
 
-    def send_frames(self, frame_id, frames):
+    def update_shm_end(self):
+        """
+        读取Thread写入的ack位置，窗口已经用完的帧所在的位置可以重新使用
+        """
+        v_id, shm_id = self.channel.acked()
+        if v_id != self.v_id or shm_id == self.shm_acked:
+            return False
+        self.shm_acked = shm_id
+        # 越过的空洞不再需要跳过
+        span = (shm_id - self.shm_end) % self.shm_cap
+        for start in list(self.holes):
+            if (start - self.shm_end) % self.shm_cap < span:
+                del self.holes[start]
+        self.shm_end = shm_id
+        self.skip_holes()
+        return True
+
+    def free_slots(self):
+        # 每个待发送的块还需要消息环中的一条记录
+        if self.channel.space() <= len(self.jobs):
+            return 0
+        return (self.shm_end - self.shm_begin - 1) % self.shm_cap
+
+    def reserve_slots(self, cnt):
+        shm_id = self.shm_begin
+        self.shm_begin = (self.shm_begin + cnt) % self.shm_cap
+        return shm_id
+
+    def release_slots(self, shm_id, cnt):
+        """
+        预留了但不会发送给窗口的位置，窗口ack到这里时直接跳过
+        """
+        self.holes[shm_id] = cnt
+        self.skip_holes()
+
+    def skip_holes(self):
+        while self.shm_end in self.holes:
+            self.shm_end = (self.shm_end + self.holes.pop(self.shm_end)) % self.shm_cap
+
+    def send_frames(self, frame_id, frames, times=None):
+        """
+        times为每一帧解码开始和结束的时间，缓存命中时不需要解码
+        """
         f = frames[0]
         assert self.frame_nbytes == f.nbytes
+        assert len(frames) <= self.free_slots()
 
-        start_shm_id = self.shm_begin
+        frame_ids = [frame_id]
+        while len(frame_ids) < len(frames):
+            frame_ids.append(self.next_frame_id(frame_ids[-1]))
+        job = ChunkJob(0, self.v_id, frame_ids, self.sample_rate, self.shm_begin)
+        now = latency.clock()
         for i, frame in enumerate(frames):
             self.shm_mat[self.shm_begin] = frame
+            start, end = times[i] if times is not None else (now, now)
+            self.shm_times[self.shm_begin, latency.DECODE_START] = start
+            self.shm_times[self.shm_begin, latency.DECODE_END] = end
             self.shm_begin = (self.shm_begin + 1) % self.shm_cap
-            assert self.shm_begin != self.shm_end
+        job.decoded = len(frames)
+        job.done = True
+        self.jobs.append(job)
+        self.flush_jobs()
+
+    def flush_jobs(self):
+        """
+        按预留顺序发送已经完成的块，保证窗口收到的帧是连续的
+        """
+        while self.jobs and self.jobs[0].done:
+            job = self.jobs.popleft()
+            sent = 0 if job.stale else job.decoded
+            if sent > 0:
+                # 先写时间再写入消息环
+                now = latency.clock()
+                for i in range(sent):
+                    shm_id = (job.shm_id + i) % self.shm_cap
+                    self.shm_times[shm_id, latency.RING_WRITE] = now
+                msg = Msg(
+                    msgtp.VIDEO_FRAMES,
+                    job.v_id,
+                    (job.v_id, job.frame_ids[0], job.rate, job.shm_id, sent),
+                )
+                self.channel.push(msg)
+                self.stats_frames += sent
+                if self.channel.take_sleeping(Channel.THREAD):
+                    self.q_video.put(Msg(msgtp.WAKE, 0, None), block=False)
+            if sent < job.frame_cnt:
+                self.release_slots(
+                    (job.shm_id + sent) % self.shm_cap, job.frame_cnt - sent
+                )
+
+    def chunk_done(self, task_id, decoded, decode_cost):
+        self.pool_decoded += decode_cost
+        for job in self.jobs:
+            if job.task_id == task_id:
+                job.decoded = decoded
+                job.done = True
+                if job.v_id == self.v_id:
+                    for i in range(decoded):
+                        slot = self.shm_mat[(job.shm_id + i) % self.shm_cap]
+                        self.remember(job.frame_ids[i], slot.copy())
+                break
+        self.flush_jobs()
 
-        msg = Msg(
-            msgtp.VIDEO_FRAMES,
-            self.v_id,
-            (
+    def wait_jobs(self):
+        """
+        等待解码进程写完预留的位置，之后才能重新划分共享内存
+        """
+        for job in self.jobs:
+            job.stale = True
+        while any(not job.done for job in self.jobs):
+            try:
+                cmd = self.q_cmd.get(timeout=Channel.WAKE_TIMEOUT)
+            except queue.Empty:
+                self.recover_jobs()
+                continue
+            if cmd.type == msgtp.CHUNK_DONE:
+                self.chunk_done(*cmd.data)
+            else:
+                self.deferred_cmds.append(cmd)
+        self.jobs.clear()
+        self.holes.clear()
+
+    def recover_jobs(self):
+        """
+        解码进程意外退出时它的CHUNK_DONE不会到来，由视频进程自己解码这些块，
+        写入预留的位置，窗口收到的帧仍然是连续的。
+        需要在读完q_cmd之后调用：进程退出之前已经把发出的消息写入管道
+        """
+        if self.pool is None:
+            return
+        for job in list(self.jobs):
+            if job.done or job.worker is None or self.pool.alive(job.worker):
+                continue
+            decoded = 0
+            if not job.stale and job.v_id == self.v_id:
+                for frame_id in job.frame_ids:
+                    start = latency.clock()
+                    frame = self.decoder.decode_frame(frame_id, abs(job.rate))
+                    if frame is None or frame.shape != self.shm_mat.shape[1:]:
+                        break
+                    shm_id = (job.shm_id + decoded) % self.shm_cap
+                    self.shm_mat[shm_id] = frame
+                    self.shm_times[shm_id, latency.DECODE_START] = start
+                    self.shm_times[shm_id, latency.DECODE_END] = latency.clock()
+                    decoded += 1
+            self.chunk_done(job.task_id, decoded, 0)
+        if len(self.pool) == 0:
+            # 全部退出之后改为在视频进程中解码
+            self.pool.close()
+            self.pool = None
+
+    def next_frame_id(self, frame_id):
+        """
+        按sample_rate前进一帧，总是包含第一帧和最后一帧
+        """
+        edge = self.total_frames - 1 if self.sample_rate > 0 else 0
+        if frame_id == edge:
+            return frame_id + self.sample_rate
+        elif self.sample_rate > 0:
+            return min(frame_id + self.sample_rate, edge)
+        else:
+            return max(frame_id + self.sample_rate, edge)
+
+    def schedule_chunks(self):
+        """
+        正放时把请求的帧分成若干段连续的GOP(见next_run)，每一段交给一个解码进程，
+        按POOL_CHUNK_FRAMES切成块依次发送，解码进程接着上一块顺序解码，不需要重新跳转；
+        不同的段轮流交给各个解码进程并行解码。发送顺序仍然由jobs保证
+        """
+        progress = False
+        while self.frame_cur <= self.frame_end and not self.cancelled():
+            if sum(not job.done for job in self.jobs) >= 2 * len(self.pool):
+                break
+            free = self.free_slots()
+            if free == 0:
+                break
+            if self.frame_cur > self.run_end:
+                self.run_end = self.next_run(self.frame_cur)
+                self.run_count += 1
+            limit = min(free, constants.Config.POOL_CHUNK_FRAMES)
+            frame_ids = []
+            f = self.frame_cur
+            while f <= min(self.frame_end, self.run_end) and len(frame_ids) < limit:
+                frame_ids.append(f)
+                f = self.next_frame_id(f)
+            self.frame_cur = f
+            progress = True
+
+            frames = [self.lookup(i) for i in frame_ids]
+            if all(frame is not None for frame in frames):
+                self.send_frames(frame_ids[0], frames)
+                continue
+            shm_id = self.reserve_slots(len(frame_ids))
+            rate = self.sample_rate
+            task_id, worker = self.pool.submit(
+                self.run_count,
                 self.v_id,
-                frame_id,
-                self.sample_rate,
-                start_shm_id,
-                len(frames),
-                self.shm_mat.shape,
-                self.shm_mat.dtype,
-            ),
-        )
-        self.q_video.put(msg, block=False)
+                (
+                    self.decoder.path,
+                    self.decoder.display_size,
+                    self.decoder.size_steps,
+                    frame_ids,
+                    rate,
+                    (
+                        self.shm.name,
+                        shm_id,
+                        self.shm_cap,
+                        self.shm_mat.shape[1:],
+                        self.shm_mat.dtype,
+                    ),
+                ),
+            )
+            self.jobs.append(
+                ChunkJob(task_id, self.v_id, frame_ids, rate, shm_id, worker)
+            )
+        return progress
+
+    def next_run(self, frame_id):
+        """
+        从frame_id开始的一段交给同一个解码进程的帧，返回最后一帧(包含)。
+        下一段从关键帧k开始解码时，opencv的跳转需要落在k+SEEK_BACKOFF上，
+        所以每一段都结束在某个k+SEEK_BACKOFF之前，中间的GOP都只解码一次；
+        每一段至少POOL_RUN_FRAMES帧，两段之间重复解码的SEEK_BACKOFF帧占比很小
+        """
+        decoder = self.decoder
+        kf_index = decoder.kf_index
+        k = kf_index.keyframe_after(decoder.seek_origin(frame_id))
+        while (
+            k is not None
+            and k + decoder.SEEK_BACKOFF - frame_id < constants.Config.POOL_RUN_FRAMES
+        ):
+            k = kf_index.keyframe_after(k)
+        if k is None:
+            return self.total_frames - 1
+        return k + decoder.SEEK_BACKOFF - 1
 
     def read_frames(self, maxframes=3):
+        """
+        返回是否有进展，没有进展时需要等待新的命令
+        """
+        self.update_shm_end()
+        rate = abs(self.sample_rate)
+        # 只解码关键帧时很快，不需要解码进程
+        keyframes_only = self.decoder.keyframes_only(rate)
+        if (
+            self.pool is not None
+            and self.get_direction() > 0
+            and self.decoder.kf_index is not None
+            and not keyframes_only
+        ):
+            return self.schedule_chunks()
         results = []
+        times = []
         init_id = self.frame_cur
         cur_shm_begin = self.shm_begin
-        while not self.close and self.frame_cur <= self.frame_end:
-            if self.cap is None:
+        direction = self.get_direction()
+        while not self.close and (self.frame_end - self.frame_cur) * direction >= 0:
+            if self.decoder.cap is None or self.cancelled():
                 break
-            assert (cur_shm_begin + 1) % self.shm_cap != self.shm_end
             if (cur_shm_begin + 1) % self.shm_cap == self.shm_end:
                 break
-            ret, frame = self.cap.read()
-            if ret:
-                # always include the last frame
-                if self.frame_rd == self.frame_cur:
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    results.append(frame)
-                    if self.frame_cur == self.total_frames - 1:
-                        self.frame_cur += self.sample_rate
-                    else:
-                        self.frame_cur = min(
-                            self.frame_cur + self.sample_rate, self.total_frames - 1
-                        )
-                    cur_shm_begin += 1
-
-                self.frame_rd += 1
-                if len(results) >= maxframes:
-                    break
+            t = latency.clock()
+            if direction > 0:
+                frame = self.lookup(self.frame_cur)
+                if frame is None:
+                    frame = self.decoder.decode_frame(self.frame_cur, rate)
+                    if frame is not None and not keyframes_only:
+                        self.remember(self.frame_cur, frame)
             else:
+                frame = self.reverse_frame(self.frame_cur)
+            if frame is None:
+                break
+            results.append(frame)
+            times.append((t, latency.clock()))
+            # always include the first/last frame
+            self.frame_cur = self.next_frame_id(self.frame_cur)
+            cur_shm_begin = (cur_shm_begin + 1) % self.shm_cap
+            if len(results) >= maxframes:
                 break
         if results:
-            self.send_frames(init_id, results)
+            self.send_frames(init_id, results, times)
+        if self.cancelled():
+            return len(results) > 0
+        return self.prefetch_chunk() or len(results) > 0
+
+    def has_demand(self):
+        """
+        是否有正在解码的块，或者有请求了但还没有发送的帧并且共享内存中有空位
+        """
+        if self.waiting_open_ack or self.decoder.cap is None:
+            return False
+        if any(not job.done for job in self.jobs):
+            return True
+        pending = (self.frame_end - self.frame_cur) * self.get_direction() >= 0
+        return pending and self.free_slots() > 0
+
+    def report_stats(self):
+        cur_t = time.time()
+        if (
+            self.stats_frames == 0
+            or cur_t - self.stats_report_t < constants.Config.STATS_INTERVAL_SEC
+        ):
+            return
+        self.stats_report_t = cur_t
+        # 不能占用待发送的块需要的记录
+        if self.channel.space() > len(self.jobs) + 1:
+            busy_us = int(self.stats_time * 1e6)
+            data = (self.v_id, self.stats_frames, busy_us)
+            self.channel.push(Msg(msgtp.VIDEO_STATS, self.v_id, data))
+        self.stats_frames = 0
+        self.stats_time = 0.0
+
+    def read_sheet(self, center, radius):
+        """
+        顺序解码center前后radius帧，缩小之后放在一条消息中发送给窗口
+        """
+        if self.decoder.cap is None:
+            return
+        lo = max(center - radius, 0)
+        hi = min(center + radius, self.total_frames - 1)
+        width = constants.Config.SHEET_TILE_WIDTH
+        frame_ids, tiles = [], []
+        for frame_id in range(lo, hi + 1):
+            frame = self.lookup(frame_id)
+            if frame is None:
+                frame = self.decoder.decode_frame(frame_id)
+                if frame is None:
+                    break
+                self.remember(frame_id, frame)
+            h, w = frame.shape[:2]
+            size = (width, max(round(h * width / w), 1))
+            tiles.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+            frame_ids.append(frame_id)
+        if tiles:
+            self.q_video.put(
+                Msg(msgtp.VIDEO_SHEET, self.v_id, (center, frame_ids, np.stack(tiles))),
+                block=False,
+            )
+
+    def make_thumbnail(self):
+        """
+        播放不需要解码时生成一张缩略图，攒够一批之后发送给窗口
+        """
+        batch = self.thumbs.step()
+        if batch is not None:
+            self.q_video.put(Msg(msgtp.VIDEO_THUMBS, self.v_id, batch), block=False)
+        if self.thumbs.done():
+            self.stop_thumbnails()
+        return True
+
+    def stop_thumbnails(self):
+        if self.thumbs is not None:
+            self.thumbs.release()
+            self.thumbs = None
 
     def shutdown(self):
-        pass
+        self.stop_thumbnails()
+        self.stop_prefetch()
+        self.close_proxy()
+        if self.pool is not None:
+            self.pool.close()
+        self.decoder.release()
+        if self.shm is not None:
+            self.shm_mat = None
+            self.shm_times = None
+            release_shm(self.shm, unlink=True)
+            self.shm = None
 
     def run(self):
+        busy = False
         while not self.close:
-            self.read_cmd()
-            if not self.waiting_open_ack:
-                self.read_frames()
-            time.sleep(0.00001)
+            # 等待解码进程的时间也算作生产帧的时间，没有请求时的阻塞不算
+            t = time.time()
+            demand = self.has_demand()
+            if not busy:
+                # 没有可以解码的帧时阻塞在命令队列上，不空转；
+                # 先设置标志再检查一次ack，避免Thread在这之间ack而没有唤醒
+                self.channel.set_sleeping(Channel.VIDEO, True)
+                busy = self.update_shm_end()
+            self.read_cmd(block=not busy)
+            self.channel.set_sleeping(Channel.VIDEO, False)
+            self.recover_jobs()
+            if not demand and self.has_demand():
+                t, demand = time.time(), True
+            busy = not self.waiting_open_ack and self.read_frames()
+            if not busy and not self.waiting_open_ack:
+                busy = self.pin_loop()
+            if not busy and not self.waiting_open_ack:
+                busy = self.step_prefetch()
+            if not busy and not self.waiting_open_ack and self.thumbs is not None:
+                busy = self.make_thumbnail()
+            if demand:
+                self.stats_time += time.time() - t
+            self.report_stats()
         self.shutdown()
@@ -17,10 +17,14 @@ from PySide6.QtWidgets import (
     QMessageBox,
     QButtonGroup,
     QHeaderView,
+    QCheckBox,
+    QSizePolicy,
+    QStyle,
+    QStyleOptionSlider,
 )
 from PySide6 import QtWidgets
-from PySide6.QtCore import Signal, Slot, QThread, Qt
-from PySide6.QtGui import QImage, QPixmap, QAction
+from PySide6.QtCore import Signal, Slot, QThread, Qt, QTimer, QPoint, QRect
+from PySide6.QtGui import QImage, QPixmap, QAction, QCursor, QPainter
 from multiprocessing import Queue
 from msg import Msg, MsgType as msgtp
 import constants
@@ -30,10 +34,18 @@ import queue
 from utils import VideoMetaData
 from enum import IntEnum
 import os
+import bisect
+import threading
 from typing import Dict, List, Optional, Tuple
-from multiprocessing import RawArray
+from multiprocessing import Array
 from annotation import AnnotationManager
 from checker import check
+from channel import Channel
+from shm import attach_shm, release_shm
+from readahead import ReadAhead
+from playlist import Playlist
+from latency import LatencyStats
+import latency
 
 
 class QModelessTextDialog(QDialog):
@@ -47,6 +59,203 @@ class QModelessTextDialog(QDialog):
         self.setLayout(self.vlayout)
 
 
+class FrameView(QWidget):
+    """
+    直接绘制共享内存中的帧，不复制，绘制时缩放到控件的大小。
+    绘制之后才通过on_painted通知Thread这一帧之前的位置可以ack；
+    Thread重新映射共享内存之前调用detach，把正在显示的帧复制出来
+    """
+
+    sig_resized = Signal(int, int)
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.lock = threading.Lock()
+        self.image = None
+        self.slot = None  # image所在的(v_id, shm_id)，复制出来之后为None
+        self.v_id = 0  # Thread当前映射的共享内存对应的v_id
+        self.on_painted = None
+
+    def set_frame(self, image, slot):
+        """
+        共享内存已经重新映射时丢弃这一帧，返回False
+        """
+        with self.lock:
+            if slot[0] != self.v_id:
+                return False
+            self.image = image
+            self.slot = slot
+        if self.isVisible():
+            self.update()
+        elif self.on_painted is not None:
+            # 不可见时不会绘制，不能一直占着这个位置
+            self.on_painted(slot)
+        return True
+
+    def detach(self, v_id):
+        with self.lock:
+            self.v_id = v_id
+            if self.slot is not None:
+                self.image = self.image.copy()
+                self.slot = None
+
+    def paintEvent(self, event) -> None:
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        with self.lock:
+            if self.image is None:
+                return
+            size = self.image.size()
+            if size.width() > self.width() or size.height() > self.height():
+                size = size.scaled(self.size(), Qt.KeepAspectRatio)
+            x = (self.width() - size.width()) // 2
+            y = (self.height() - size.height()) // 2
+            painter.drawImage(QRect(x, y, size.width(), size.height()), self.image)
+            slot = self.slot
+        painter.end()
+        if slot is not None and self.on_painted is not None:
+            self.on_painted(slot)
+
+    def resizeEvent(self, event) -> None:
+        self.sig_resized.emit(event.size().width(), event.size().height())
+        return super().resizeEvent(event)
+
+
+class FrameSlider(QSlider):
+    """
+    鼠标悬停时发出鼠标位置对应的帧号，用于显示缩略图预览
+    """
+
+    sig_hover = Signal(int)
+    sig_leave = Signal()
+
+    def __init__(self, orientation, parent=None) -> None:
+        super().__init__(orientation, parent)
+        self.setMouseTracking(True)
+
+    def value_at(self, x):
+        opt = QStyleOptionSlider()
+        self.initStyleOption(opt)
+        style = self.style()
+        groove = style.subControlRect(
+            QStyle.CC_Slider, opt, QStyle.SC_SliderGroove, self
+        )
+        handle = style.subControlRect(
+            QStyle.CC_Slider, opt, QStyle.SC_SliderHandle, self
+        )
+        span = max(groove.width() - handle.width(), 1)
+        pos = x - groove.x() - handle.width() // 2
+        return QStyle.sliderValueFromPosition(
+            self.minimum(), self.maximum(), pos, span, opt.upsideDown
+        )
+
+    def mouseMoveEvent(self, event) -> None:
+        if not self.isSliderDown():
+            self.sig_hover.emit(self.value_at(int(event.position().x())))
+        return super().mouseMoveEvent(event)
+
+    def leaveEvent(self, event) -> None:
+        self.sig_leave.emit()
+        return super().leaveEvent(event)
+
+
+class Filmstrip:
+    """
+    视频进程生成的缩略图，按帧号排序
+    """
+
+    def __init__(self) -> None:
+        self.frame_ids = []
+        self.images = []
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def clear(self):
+        self.frame_ids = []
+        self.images = []
+
+    def add(self, frame_ids, images):
+        for frame_id, image in zip(frame_ids, images):
+            i = bisect.bisect_left(self.frame_ids, frame_id)
+            if i < len(self.frame_ids) and self.frame_ids[i] == frame_id:
+                continue
+            self.frame_ids.insert(i, frame_id)
+            self.images.insert(i, image)
+
+    def nearest(self, frame_id):
+        """
+        离frame_id最近的缩略图，没有缩略图时返回None
+        """
+        if not self.frame_ids:
+            return None
+        i = bisect.bisect_left(self.frame_ids, frame_id)
+        if i == len(self.frame_ids) or (
+            i > 0 and frame_id - self.frame_ids[i - 1] < self.frame_ids[i] - frame_id
+        ):
+            i -= 1
+        return self.frame_ids[i], self.images[i]
+
+
+class SheetTile(QLabel):
+    sig_clicked = Signal(int)
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.frame_id = -1
+
+    def mousePressEvent(self, event) -> None:
+        if self.frame_id >= 0:
+            self.sig_clicked.emit(self.frame_id)
+        return super().mousePressEvent(event)
+
+
+class ContactSheet(QWidget):
+    """
+    当前帧前后各SHEET_RADIUS帧，由视频进程一次顺序解码得到；点击直接跳到对应的帧
+    """
+
+    sig_clicked = Signal(int)
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.tiles = []
+        for _ in range(2 * constants.Config.SHEET_RADIUS + 1):
+            tile = SheetTile(self)
+            tile.setFixedWidth(constants.Config.SHEET_TILE_WIDTH + 4)
+            tile.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            tile.sig_clicked.connect(self.sig_clicked)
+            self.tiles.append(tile)
+            layout.addWidget(tile)
+        self.setLayout(layout)
+
+    def clear(self):
+        for tile in self.tiles:
+            tile.frame_id = -1
+            tile.clear()
+
+    def set_frames(self, center, frame_ids, images):
+        """
+        靠近视频开头或结尾时不足的位置留空，当前帧总是在中间
+        """
+        self.clear()
+        radius = constants.Config.SHEET_RADIUS
+        for frame_id, image in zip(frame_ids, images):
+            i = frame_id - center + radius
+            if i < 0 or i >= len(self.tiles):
+                continue
+            h, w, ch = image.shape
+            img = QImage(image.data, w, h, ch * w, QImage.Format_BGR888)
+            tile = self.tiles[i]
+            tile.frame_id = frame_id
+            tile.setPixmap(QPixmap.fromImage(img))
+            tile.setToolTip(str(frame_id))
+            border = "red" if frame_id == center else "transparent"
+            tile.setStyleSheet(f"border: 2px solid {border}")
+
+
 class BufferItem:
     def __init__(self, frame_id, rate, frame_cnt, shm_id) -> None:
         self.frame_id = frame_id
@@ -54,6 +263,7 @@ class BufferItem:
         self.frame_cnt = frame_cnt
         self.shm_id = shm_id
         self.cursor = 0
+        self.dequeue_t = latency.clock()  # Thread从消息环中取出的时间
 
     def last_frame_id(self):
         return self.frame_id + (self.frame_cnt - 1) * self.rate
@@ -63,38 +273,69 @@ class BufferItem:
 
 
 class Thread(QThread):
-    sig_update_frame = Signal(int, QImage)
+    sig_update_frame = Signal(int, QImage, object)
     sig_open_video = Signal(VideoMetaData)
-
-    BASE_EXTENT_PACE = 16
+    sig_thumbs = Signal(list, object)
+    sig_sheet = Signal(int, list, object)
+    sig_underrun = Signal(int)
 
     def __init__(
-        self, parent, q_frame: Queue, q_cmd: Queue, q_view: Queue, shm_arr: RawArray
+        self,
+        parent,
+        q_frame: Queue,
+        q_cmd: Queue,
+        q_view: Queue,
+        ctrl_arr: Array,
+        frame_view: FrameView,
     ):
         super().__init__(parent=parent)
         self.q_frame = q_frame  # this thread to decoder
         self.q_cmd = q_cmd  # this thread to viewer
-        self.q_view = q_view  # viewer to this thread
+        self.q_view = q_view  # viewer to this thread, may be the same queue as q_frame
 
-        self.shm_arr = shm_arr
+        self.channel = Channel(ctrl_arr)
+        self.frame_view = frame_view
+        frame_view.on_painted = self.on_painted
 
         self.view_cur_id = 0  # current frame id
         self.view_next_id = 0  # next frame to consume
         self.view_last_to_show = 0  # last frame to show(included)
         self.view_subscribed = 0
         self.view_playrate = 1
+        self.loop = None  # A-B循环的范围(a, b)，包含两端
 
         self.buffer = []
         self.buffer_disabled = True
         self.total_frames = 0
 
+        # 上一帧计划显示的时间(time.monotonic)，下一帧在此之后一个间隔显示
         self.last_update_t = 0
+        # keep-all逐帧显示，落后时整体推迟；keep-time跳过已经过了显示时间的帧，保持实际速度
+        self.drop_policy = constants.Config.PLAYBACK_DROP_POLICY
+        self.stride = 1  # keep-time解码跟不上时每隔stride帧显示一帧
+        self.stride_t = 0  # 上一次改变stride的时间
+        self.late_t = 0  # 上一次有帧迟到的时间
+        # 上一帧是否是在连续播放中显示的，只有连续播放中的延迟才算卡顿
+        self.last_show_playing = False
+        self.readahead = ReadAhead()
 
         self.stopped = False
         self.paused = False
 
+        self.shm = None  # 视频进程创建的共享内存
         self.shm_cap = 1
         self.shm_mat = None
+        self.shm_times = None  # 每个位置的帧的解码和写入消息环的时间
+        self.ack_pos = 0  # 窗口已经用完的帧之后的位置
+        self.acked_pos = 0  # 已经写入channel的ack位置
+        # 窗口最近绘制的帧所在的(v_id, shm_id)，由窗口线程写入
+        self.painted = None
+        # 窗口可能还在引用的最早的位置，ack不能越过它
+        self.hold = None
+
+        self.display_size = None  # 视频进程解码后缩放到的大小，None表示原始分辨率
+        config = constants.Config
+        self.latency = LatencyStats(config.LATENCY_WINDOW, config.LATENCY_LOG)
 
         self.v_id = 0
 
@@ -109,26 +350,54 @@ class Thread(QThread):
         self.buffer = []
 
     def is_view_paused(self):
-        return self.view_last_to_show < self.view_next_id and self.paused
+        return self.ahead(self.view_last_to_show, self.view_next_id) < 0 and self.paused
 
     def get_playrate(self):
-        return max(self.view_playrate, 1)
+        return max(abs(self.view_playrate), 1)
+
+    def get_direction(self):
+        # view_playrate为负数时表示倒放
+        return -1 if self.view_playrate < 0 else 1
+
+    def get_sample_rate(self):
+        return self.get_direction() * self.get_playrate() * self.stride
+
+    def ahead(self, frame_a, frame_b):
+        """
+        按照播放方向，frame_a在frame_b之后多少帧
+        """
+        return (frame_a - frame_b) * self.get_direction()
+
+    def clamp_frame_id(self, frame_id):
+        return min(max(frame_id, 0), self.total_frames - 1)
 
     def get_view_interval(self):
-        if self.view_playrate < 1:
-            return 1.0 / 25 / self.view_playrate
+        if abs(self.view_playrate) < 1:
+            return 1.0 / 25 / abs(self.view_playrate) * self.stride
         else:
-            return 1.0 / 25
+            return 1.0 / 25 * self.stride
 
     def pause(self, show_current_frame):
         if show_current_frame:
             self.view_last_to_show = self.view_next_id
         else:
-            self.view_last_to_show = self.view_next_id - 1
+            self.view_last_to_show = self.view_next_id - self.get_direction()
         self.paused = True
 
+    def pause_playing(self, show_current_frame):
+        was_playing = not self.paused
+        self.pause(show_current_frame)
+        if (
+            was_playing
+            and self.total_frames > 0
+            and abs(self.get_sample_rate()) >= constants.Config.KEYFRAME_SKIP_RATE
+        ):
+            # 高倍速时视频进程可能只解码关键帧，显示的不是准确的帧，暂停之后重新读取
+            self.seek(self.clamp_frame_id(self.view_last_to_show))
+
     def open(self, path):
         self.pause(show_current_frame=False)
+        self.loop = None
         self.clear_buffer()
         self.buffer_disabled = True
         self.q_cmd.put(Msg(msgtp.OPEN, self.v_id, path), block=False)
@@ -136,35 +405,75 @@ class Thread(QThread):
     def open_ack(self, v_id):
         self.q_cmd.put(Msg(msgtp.OPEN_ACK, v_id, None), block=False)
 
+    def get_read_depth(self):
+        """
+        预读的深度(采样后的帧数)，不超过共享内存中能放下的帧数
+        """
+        consume_fps = 1.0 / self.get_view_interval()
+        return self.readahead.depth(consume_fps, self.shm_cap - 1, time.monotonic())
+
+    def loop_bounds(self):
+        """
+        按播放方向返回循环的起点和终点
+        """
+        a, b = self.loop
+        return (a, b) if self.get_direction() > 0 else (b, a)
+
+    def set_loop(self, loop):
+        self.loop = None if loop is None else tuple(loop)
+        self.q_cmd.put(Msg(msgtp.LOOP, self.v_id, self.loop), block=False)
+        if self.loop is not None and not (
+            self.loop[0] <= self.view_cur_id <= self.loop[1]
+        ):
+            self.seek(self.loop_bounds()[0])
+            if not self.paused:
+                self.play()
+
     def play(self):
         self.paused = False
+        direction = self.get_direction()
+        if self.loop is not None:
+            start, end = self.loop_bounds()
+            if self.ahead(self.view_next_id, end) > 0 or self.ahead(
+                start, self.view_next_id
+            ) > 0:
+                self.seek(start)
         least_subscribed = (
-            self.view_next_id + self.BASE_EXTENT_PACE * self.get_playrate()
+            self.view_next_id + self.get_read_depth() * self.get_sample_rate()
         )
-        sample_rate = self.get_playrate()
-        if self.view_subscribed < least_subscribed:
+        if self.loop is not None:
+            # 不请求循环终点之后的帧
+            end = self.loop_bounds()[1] + direction
+            if self.ahead(least_subscribed, end) > 0:
+                least_subscribed = end
+        sample_rate = self.get_sample_rate()
+        if self.ahead(least_subscribed, self.view_subscribed) > 0:
             self.q_cmd.put(
                 Msg(
                     msgtp.READ,
                     self.v_id,
                     (
                         self.view_subscribed,
-                        least_subscribed - self.view_subscribed,
+                        abs(least_subscribed - self.view_subscribed),
                         sample_rate,
+                        self.channel.epoch(),
                     ),
                 )
             )
             self.view_subscribed = least_subscribed
-        self.view_last_to_show = self.view_subscribed - 1
+        self.view_last_to_show = self.view_subscribed - direction
 
     def seek(self, seek_id):
+        self.last_show_playing = False
         self.view_next_id = seek_id
         self.view_last_to_show = seek_id
-        self.view_subscribed = seek_id + 1
+        self.view_subscribed = seek_id + self.get_direction()
         self.clear_buffer()
-        sample_rate = 1 if self.paused else self.get_playrate()
+        sample_rate = self.get_direction() if self.paused else self.get_sample_rate()
+        # 让视频进程放弃之前的跳转还没有完成的解码
+        epoch = self.channel.bump_epoch()
         self.q_cmd.put(
-            Msg(msgtp.READ, self.v_id, (seek_id, 1, sample_rate)), block=False
+            Msg(msgtp.READ, self.v_id, (seek_id, 1, sample_rate, epoch)), block=False
         )
 
     def change_playrate(self, rate):
@@ -179,112 +488,345 @@ class Thread(QThread):
         # GIL to protect it
         self.stopped = True
         self.q_cmd.put(Msg(msgtp.CLOSE, self.v_id, None), block=False)
+        # 唤醒阻塞在队列上的run
+        self.q_view.put(Msg(msgtp.VIEW_CLOSE, -1, None), block=False)
 
     def frame_ack(self, v_id, shm_start, shm_len):
-        self.q_cmd.put(Msg(msgtp.FRAME_ACK, v_id, (shm_start, shm_len)), block=False)
+        # 视频进程重新划分共享内存之后，旧的帧不需要ack
+        if v_id != self.v_id:
+            return
+        self.ack_pos = (shm_start + shm_len) % self.shm_cap
+        self.flush_ack()
 
-    def change_view_image(self, frame_id, frame):
+    def on_painted(self, slot):
+        # 在窗口线程中调用，GIL保证赋值是原子的
+        self.painted = slot
+        if self.latency.enabled:
+            self.latency.painted(slot)
+
+    def flush_ack(self):
+        """
+        窗口还在显示的帧不能被覆盖，最多ack到这一帧之前
+        """
+        painted = self.painted
+        if painted is not None and painted[0] == self.v_id and self.hold is not None:
+            # 窗口按发送的顺序绘制，绘制了这一帧之后不再引用之前的帧
+            self.hold = painted[1]
+        pos = self.ack_pos
+        if self.hold is not None:
+            span = (pos - self.acked_pos) % self.shm_cap
+            if (self.hold - self.acked_pos) % self.shm_cap < span:
+                pos = self.hold
+        if pos == self.acked_pos:
+            return
+        self.acked_pos = pos
+        self.channel.ack(self.v_id, pos)
+        if self.channel.take_sleeping(Channel.VIDEO):
+            self.q_cmd.put(Msg(msgtp.WAKE, self.v_id, None), block=False)
+
+    def resize(self, width, height, full_resolution):
+        display_size = None if full_resolution else (width, height)
+        if display_size != self.display_size:
+            self.display_size = display_size
+            self.q_cmd.put(Msg(msgtp.RESIZE, self.v_id, display_size), block=False)
+
+    def map_shm(self, name, shape, dtype):
+        # 窗口不能再引用旧的映射
+        self.frame_view.detach(self.v_id)
+        self.painted = None
+        self.hold = None
+        self.ack_pos = 0
+        self.acked_pos = 0
+        self.shm_mat = None
+        self.shm_times = None
+        if self.shm is not None and self.shm.name != name:
+            release_shm(self.shm)
+            self.shm = None
+        if self.shm is None:
+            self.shm = attach_shm(name)
+        self.shm_mat = np.ndarray(
+            (self.shm_cap, *shape), dtype=dtype, buffer=self.shm.buf
+        )
+        frame_nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.shm_times = latency.slot_times(self.shm.buf, self.shm_cap, frame_nbytes)
+
+    def unmap_shm(self):
+        self.frame_view.detach(-1)
+        self.shm_mat = None
+        self.shm_times = None
+        if self.shm is not None:
+            release_shm(self.shm)
+            self.shm = None
+
+    def change_view_image(self, frame_id, shm_id, dequeue_t, late):
+        """
+        QImage直接引用共享内存，窗口绘制之后才会ack这个位置
+        """
+        frame = self.shm_mat[shm_id]
         h, w, ch = frame.shape
-        img = QImage(frame.data, w, h, ch * w, QImage.Format_RGB888)
-        scaled_img = img.scaled(640, 480, Qt.KeepAspectRatio)
-        self.sig_update_frame.emit(frame_id, scaled_img)
+        img = QImage(frame.data, w, h, ch * w, QImage.Format_BGR888)
+        if self.hold is None:
+            self.hold = shm_id
+        slot = (self.v_id, shm_id)
+        if self.latency.enabled:
+            times = self.shm_times[shm_id]
+            self.latency.emitted(slot, frame_id, times, dequeue_t, late)
+        self.sig_update_frame.emit(frame_id, img, slot)
+
+    def update_occupancy(self):
+        buffered = sum(item.frame_cnt - item.cursor for item in self.buffer)
+        backlog = Channel.CAPACITY - self.channel.space()
+        self.latency.occupancy = (buffered, self.shm_cap - 1, backlog)
+
+    def read_ring(self):
+        """
+        处理视频进程写入消息环的帧。v_id比当前新的帧要等队列中的
+        VIDEO_OPEN_ACK/VIDEO_LAYOUT处理之后才能处理
+        """
+        progress = False
+        while not self.stopped:
+            msg = self.channel.peek()
+            if msg is None or msg.v_id > self.v_id:
+                break
+            self.channel.pop()
+            self.read_video(msg)
+            progress = True
+        return progress
+
+    COALESCED_VIEW_MSGS = (msgtp.VIEW_SEEK, msgtp.VIEW_NAVIGATE)
 
-    def read_view(self):
-        while True:
-            if self.q_view.empty():
+    def read_msgs(self, timeout):
+        """
+        阻塞等待消息，最多等待timeout秒(None表示一直等待)，之后处理完队列中已有的消息。
+        连续的同类跳转只处理最后一条，按住方向键或拖动进度条时只解码最终显示的帧
+        """
+        pending = None
+        block = not self.read_ring()
+        if block and timeout is None:
+            # 没有要显示的帧时需要视频进程写入之后唤醒；
+            # 先设置标志再检查一次，避免视频进程在这之间写入而没有唤醒
+            self.channel.set_sleeping(Channel.THREAD, True)
+            block = not self.read_ring()
+            timeout = Channel.WAKE_TIMEOUT
+        while not self.stopped:
+            try:
+                msg = self.q_frame.get(block=block, timeout=timeout if block else None)
+            except queue.Empty:
                 break
-            msg = self.q_view.get(block=False)
-            if msg.type == msgtp.VIEW_PAUSE:
-                self.pause(show_current_frame=msg.data)
-            elif msg.type == msgtp.VIEW_PLAY:
-                self.play()
-            elif msg.type == msgtp.VIEW_OPEN:
-                self.open(msg.data)
-            elif msg.type == msgtp.VIEW_TOGGLE:
-                if self.paused:
-                    self.play()
+            block = False
+            if pending is not None and pending.type != msg.type:
+                self.read_view(pending)
+            pending = None
+            # 窗口发来的消息v_id为-1
+            if msg.v_id < 0:
+                if msg.type in self.COALESCED_VIEW_MSGS:
+                    pending = msg
                 else:
-                    self.pause(show_current_frame=False)
-            elif msg.type == msgtp.VIEW_SEEK:
-                self.seek(msg.data)
-            elif msg.type == msgtp.VIEW_PLAYRATE:
-                self.change_playrate(msg.data)
-            elif msg.type == msgtp.VIEW_NAVIGATE:
-                if self.is_view_paused():
-                    self.seek(msg.data)
+                    self.read_view(msg)
             else:
-                raise ValueError(f"Invalid type: {msg.type}")
-
-    def read_video(self):
-        try:
-            msg = self.q_frame.get(block=False)
-
-            if msg.type == msgtp.VIDEO_FRAMES:
-                v_id, frame_id, rate, shm_id, frame_cnt, arr_shape, arr_type = msg.data
-                accepted = False
-                if not self.buffer_disabled and v_id == self.v_id:
-                    assert (
-                        self.shm_mat.dtype == arr_type
-                        and self.shm_mat.shape == arr_shape
-                    )
-
-                    cond_empty = len(self.buffer) == 0 and frame_id == self.view_next_id
-                    cond_not_empty = (
-                        len(self.buffer) > 0
-                        and min(self.buffer[-1].next_frame_id(), self.total_frames - 1)
-                        == frame_id
-                    )
-                    cond_rate = rate == self.get_playrate() or (
-                        self.paused and rate == 1
-                    )
-                    if (cond_empty or cond_not_empty) and cond_rate:
-                        accepted = True
-                        self.buffer.append(
-                            BufferItem(frame_id, rate, frame_cnt, shm_id)
-                        )
-                if not accepted:
-                    self.frame_ack(v_id, shm_id, frame_cnt)
-
-            elif msg.type == msgtp.VIDEO_OPEN_ACK:
-                self.v_id, self.shm_cap, nbytes, shape, dtype, video_meta = msg.data
-                shm_sliced = np.frombuffer(self.shm_arr, dtype="b")[
-                    : self.shm_cap * nbytes
-                ]
-                self.shm_mat = np.frombuffer(shm_sliced, dtype=dtype).reshape(
-                    (self.shm_cap, *shape)
+                # 先处理在这条消息之前写入消息环的帧
+                self.read_ring()
+                self.read_video(msg)
+        if pending is not None:
+            self.read_view(pending)
+        self.channel.set_sleeping(Channel.THREAD, False)
+        self.read_ring()
+
+    def read_view(self, msg: Msg):
+        if msg.type == msgtp.VIEW_PAUSE:
+            self.pause_playing(show_current_frame=msg.data)
+        elif msg.type == msgtp.VIEW_PLAY:
+            self.play()
+        elif msg.type == msgtp.VIEW_OPEN:
+            self.open(msg.data)
+        elif msg.type == msgtp.VIEW_TOGGLE:
+            if self.paused:
+                self.play()
+            else:
+                self.pause_playing(show_current_frame=False)
+        elif msg.type == msgtp.VIEW_SEEK:
+            self.seek(msg.data)
+        elif msg.type == msgtp.VIEW_PLAYRATE:
+            self.change_playrate(msg.data)
+        elif msg.type == msgtp.VIEW_NAVIGATE:
+            if self.is_view_paused():
+                self.seek(msg.data)
+        elif msg.type == msgtp.VIEW_RESIZE:
+            self.resize(*msg.data)
+        elif msg.type == msgtp.VIEW_LOOP:
+            self.set_loop(msg.data)
+        elif msg.type == msgtp.VIEW_SHEET:
+            radius = constants.Config.SHEET_RADIUS
+            self.q_cmd.put(
+                Msg(msgtp.READ_SHEET, self.v_id, (msg.data, radius)), block=False
+            )
+        elif msg.type == msgtp.VIEW_DROP_POLICY:
+            self.drop_policy = msg.data
+            if self.drop_policy != "keep-time":
+                self.set_stride(1)
+        elif msg.type == msgtp.VIEW_PREFETCH:
+            # 视频进程只接受当前视频的预取请求
+            self.q_cmd.put(Msg(msgtp.PREFETCH, self.v_id, msg.data), block=False)
+        elif msg.type == msgtp.VIEW_CLOSE:
+            pass
+        else:
+            raise ValueError(f"Invalid type: {msg.type}")
+
+    def read_video(self, msg: Msg):
+        if msg.type == msgtp.VIDEO_FRAMES:
+            v_id, frame_id, rate, shm_id, frame_cnt = msg.data
+            accepted = False
+            if not self.buffer_disabled and v_id == self.v_id:
+                cond_empty = len(self.buffer) == 0 and frame_id == self.view_next_id
+                cond_not_empty = (
+                    len(self.buffer) > 0
+                    and self.clamp_frame_id(self.buffer[-1].next_frame_id())
+                    == frame_id
                 )
-                self.total_frames = int(video_meta.total_frames)
-                self.sig_open_video.emit(video_meta)
-                self.view_cur_id = -1
-                self.view_next_id = 0
-                self.view_last_to_show = 0
-                self.view_playrate = 1
-                self.buffer_disabled = False
-                self.seek(0)
+                cond_rate = rate == self.get_sample_rate() or (
+                    self.paused and rate == self.get_direction()
+                )
+                if (cond_empty or cond_not_empty) and cond_rate:
+                    accepted = True
+                    self.buffer.append(BufferItem(frame_id, rate, frame_cnt, shm_id))
+            if not accepted:
+                self.frame_ack(v_id, shm_id, frame_cnt)
+
+        elif msg.type == msgtp.VIDEO_OPEN_ACK:
+            self.v_id, name, self.shm_cap, nbytes, shape, dtype, video_meta = msg.data
+            self.map_shm(name, shape, dtype)
+            self.total_frames = int(video_meta.total_frames)
+            self.sig_open_video.emit(video_meta)
+            self.view_cur_id = -1
+            self.view_next_id = 0
+            self.view_last_to_show = 0
+            self.view_playrate = 1
+            self.stride = 1
+            self.buffer_disabled = False
+            self.seek(0)
+            self.open_ack(self.v_id)
+
+        elif msg.type == msgtp.VIDEO_LAYOUT:
+            if not self.buffer_disabled:
+                # 视频进程已经重置了共享内存，之前的帧不需要ack
+                self.buffer = []
+                self.v_id, name, self.shm_cap, nbytes, shape, dtype = msg.data
+                self.map_shm(name, shape, dtype)
+                self.seek(max(self.view_cur_id, 0))
+                if not self.paused:
+                    self.play()
                 self.open_ack(self.v_id)
 
-        except queue.Empty:
-            pass
+        elif msg.type == msgtp.VIDEO_THUMBS:
+            self.sig_thumbs.emit(*msg.data)
 
-    def update_view(self):
-        cur_t = time.time()
-        if (
-            self.buffer
-            and cur_t - self.last_update_t >= self.get_view_interval()
-            and self.view_last_to_show >= self.view_next_id
+        elif msg.type == msgtp.VIDEO_SHEET:
+            if msg.v_id == self.v_id:
+                self.sig_sheet.emit(*msg.data)
+
+        elif msg.type == msgtp.VIDEO_STATS:
+            _, frames, busy_us = msg.data
+            self.readahead.report(frames, busy_us)
+
+    def next_deadline(self):
+        """
+        下一帧应该显示的时间，没有可以显示的帧时返回None
+        """
+        if self.buffer and self.ahead(self.view_last_to_show, self.view_next_id) >= 0:
+            return self.last_update_t + self.get_view_interval()
+        return None
+
+    def droppable(self):
+        """
+        缓冲中的第一帧之后还有可以显示的帧时，第一帧可以跳过
+        """
+        item: BufferItem = self.buffer[0]
+        if item.cursor + 1 >= item.frame_cnt and len(self.buffer) < 2:
+            return False
+        return self.ahead(self.view_last_to_show, self.view_next_id + item.rate) >= 0
+
+    def drop_frame(self):
+        """
+        跳过缓冲中的第一帧，不显示，直接ack
+        """
+        item: BufferItem = self.buffer[0]
+        shm_id = (item.shm_id + item.cursor) % self.shm_cap
+        item.cursor += 1
+        self.frame_ack(self.v_id, shm_id, 1)
+        if item.cursor >= item.frame_cnt:
+            self.buffer.pop(0)
+        self.view_next_id += item.rate
+        self.latency.skipped += 1
+
+    # 改变stride之后等待这么久(秒)再根据新的情况调整
+    STRIDE_SETTLE_SEC = 1.0
+    # 这么久没有迟到的帧之后才考虑减小stride
+    STRIDE_CALM_SEC = 5.0
+
+    def adapt_stride(self, cur_t, late):
+        """
+        keep-time播放时跳过缓冲中的帧之后仍然迟到，说明视频进程发送帧的速度跟不上，
+        改为每隔stride帧显示一帧，中间的帧只grab不解码；一段时间没有迟到并且发送速度
+        有余量时再减小
+        """
+        if late:
+            self.late_t = cur_t
+        if cur_t - self.stride_t < self.STRIDE_SETTLE_SEC:
+            return
+        stride = self.stride
+        fps = self.readahead.produce_fps
+        if late:
+            stride = min(stride + 1, constants.Config.PLAYBACK_MAX_STRIDE)
+        elif (
+            stride > 1
+            and fps is not None
+            and cur_t - self.late_t > self.STRIDE_CALM_SEC
+            and fps >= 1.2 * stride / (stride - 1) / self.get_view_interval()
         ):
+            stride -= 1
+        self.set_stride(stride)
+
+    def set_stride(self, stride):
+        if stride == self.stride:
+            return
+        self.stride = stride
+        self.stride_t = time.monotonic()
+        # 和改变倍速一样重新请求之后的帧
+        if not self.paused:
+            self.seek(self.clamp_frame_id(self.view_next_id))
+            self.play()
+
+    def update_view(self):
+        cur_t = time.monotonic()
+        deadline = self.next_deadline()
+        if deadline is not None and cur_t >= deadline:
+            interval = self.get_view_interval()
+            playing = self.last_show_playing and not self.paused
+            # 落后太多时(例如解码卡住了很久)不再追赶，从当前时间重新开始
+            keep_time = (
+                playing
+                and self.drop_policy == "keep-time"
+                and cur_t - deadline < constants.Config.PLAYBACK_MAX_LAG_SEC
+            )
+            if keep_time:
+                # 显示时间已经过去的帧都跳过，只显示其中最后一帧
+                while cur_t - deadline >= interval and self.droppable():
+                    self.drop_frame()
+                    deadline += interval
+            late = playing and cur_t - deadline >= interval
             item: BufferItem = self.buffer[0]
             frame_id = item.frame_id + item.cursor * item.rate
-            frame_id = min(frame_id, self.total_frames - 1)
+            frame_id = self.clamp_frame_id(frame_id)
             shm_id = (item.shm_id + item.cursor) % self.shm_cap
 
             assert self.shm_mat.shape[0] == self.shm_cap
-            assert frame_id == min(
-                self.view_next_id, self.total_frames - 1
+            assert frame_id == self.clamp_frame_id(
+                self.view_next_id
             ), f"get {frame_id}, expect {self.view_next_id}"
 
-            frame_content = self.shm_mat[shm_id].copy()
-            self.change_view_image(frame_id, frame_content)
+            if self.latency.enabled:
+                self.update_occupancy()
+            self.change_view_image(frame_id, shm_id, item.dequeue_t, late)
             item.cursor += 1
             self.frame_ack(self.v_id, shm_id, 1)
             if item.cursor >= item.frame_cnt:
@@ -292,19 +834,41 @@ class Thread(QThread):
 
             self.view_cur_id = self.view_next_id
             self.view_next_id += item.rate
-            self.last_update_t = cur_t
+            # 以计划的时间为准，唤醒的延迟不会累积；keep-all落后一个间隔以上时
+            # 从当前时间重新开始，keep-time仍然按计划的时间，之后的帧继续跳过
+            if cur_t - deadline < interval or keep_time:
+                self.last_update_t = deadline
+            else:
+                self.last_update_t = cur_t
+            if late:
+                self.readahead.underrun(cur_t)
+                self.sig_underrun.emit(self.readahead.underruns)
+            self.last_show_playing = not self.paused
+            if playing and self.drop_policy == "keep-time":
+                self.adapt_stride(cur_t, late)
+
+            if self.loop is not None and not self.paused:
+                start, end = self.loop_bounds()
+                if self.ahead(self.view_next_id, end) > 0:
+                    # 循环范围内的帧已经固定在视频进程的缓存中，跳回起点不需要再解码
+                    self.seek(start)
+                    self.play()
 
-            margin = self.view_subscribed - self.view_next_id
-            thresh = self.BASE_EXTENT_PACE * self.get_playrate() / 2
+            margin = self.ahead(self.view_subscribed, self.view_next_id)
+            thresh = self.get_read_depth() * abs(self.get_sample_rate()) / 2
             if not self.paused and margin < thresh:
                 self.play()
 
     def run(self):
         while not self.stopped:
-            self.read_view()
-            self.read_video()
+            # 没有要显示的帧时一直阻塞到有新消息为止
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            self.read_msgs(timeout)
             self.update_view()
-            time.sleep(0.001)
+            self.flush_ack()
+        self.unmap_shm()
+        self.latency.close()
 
 
 class AnnWindowManager:
@@ -322,6 +886,7 @@ class AnnWindowManager:
 
         self.navigate_repeat = 0
         self.playrate = 1
+        self.reverse = False
 
         self.annotation_manager = AnnotationManager.from_json("event.json")
         self.annotation_path = None
@@ -371,6 +936,7 @@ class AnnWindowManager:
         self.view_frame_id = 0
         self.is_dirty = False
         self.playrate = 1
+        self.reverse = False
 
     def open_ann(self, ann_path):
         if self.valid() and os.path.exists(ann_path):
@@ -420,8 +986,7 @@ class AnnWindowManager:
         2. 有同名事件包含当前帧
         """
         disabled_events = set()
-        for group_name, anns in self.annotation_manager.annotations.items():
-            group = self.annotation_manager.event_groups[group_name]
+        for group_name, group in self.annotation_manager.event_groups.items():
             group_conflict = False
             chosen_event = None
             for e_name in group.event_names:
@@ -432,11 +997,10 @@ class AnnWindowManager:
                         group_conflict = True
                         chosen_event = e_name
 
-            for ann in anns:
-                if ann.f0 <= self.view_frame_id and ann.f1 >= self.view_frame_id:
-                    disabled_events.add(ann.event_name)
-                    group_conflict = True
-                    chosen_event = None
+            for ann in self.annotation_manager.covering(group_name, self.view_frame_id):
+                disabled_events.add(ann.event_name)
+                group_conflict = True
+                chosen_event = None
 
             if group_conflict and not group.allow_overlap:
                 for e_name in group.event_names:
@@ -447,6 +1011,17 @@ class AnnWindowManager:
     def add_breakpoint(self, frame_id):
         self.breakpoints.append(frame_id)
 
+    def loop_range(self) -> Optional[Tuple[int, int]]:
+        """
+        当前帧前后相邻的两个断点，当前帧在所有断点之外时取最近的两个断点
+        """
+        points = sorted(set(self.breakpoints))
+        if len(points) < 2:
+            return None
+        i = bisect.bisect_right(points, self.view_frame_id)
+        i = min(max(i, 1), len(points) - 1)
+        return points[i - 1], points[i]
+
 
 class AnnWindow(QMainWindow):
     class AnnTableWidget(QTableWidget):
@@ -461,40 +1036,67 @@ class AnnWindow(QMainWindow):
                     table.clearSelection()
             return super().focusInEvent(event)
 
-    def __init__(self, q_frame: Queue, q_cmd: Queue, shm_arr: RawArray) -> None:
+    def __init__(
+        self, q_frame: Queue, q_cmd: Queue, ctrl_arr: Array, playlist_path=None
+    ) -> None:
         super().__init__()
         self.manager: AnnWindowManager = AnnWindowManager()
+        self.playlist: Optional[Playlist] = None
         self.setWindowTitle("Annotator")
 
-        self.shm_arr = shm_arr
-
         self.btn_idl_stylesheet = r"background-color: rgb(240, 248, 255)"
         self.btn_new_stylesheet = r"background-color: rgb(3, 252, 107)"
         self.btn_overlap_stylesheet = r"background-color: palette(window)"
 
         self._create_tool_bar()
         self.status_bar = self.statusBar()
+        self.underrun_label = QLabel(self)
+        self.status_bar.addPermanentWidget(self.underrun_label)
+        # F3显示每一帧各阶段的耗时
+        self.latency_label = QLabel(self)
+        self.latency_label.hide()
+        self.status_bar.addPermanentWidget(self.latency_label)
 
         self.playrates = ["1", "0.1", "0.3", "0.5", "4", "8"]
         top_hlayout = QHBoxLayout()
-        top_hlayout.addLayout(self._create_image_viewer())
+        top_hlayout.addLayout(self._create_image_viewer(), 1)
         top_hlayout.addLayout(self._create_button_group())
-        top_hlayout.addLayout(self._create_control_panel())
+        top_hlayout.addLayout(self._create_control_panel(), 1)
 
         central_widget = QWidget(self)
         central_widget.setLayout(top_hlayout)
         self.setCentralWidget(central_widget)
 
         self.view_update_by_manager(ann_update=True, button_update=True)
-        self.q_view = Queue()
-        self.th = Thread(self, q_frame, q_cmd, self.q_view, self.shm_arr)
+        # 窗口的消息和视频进程的消息放在同一个队列中，Thread只需要阻塞在这一个队列上
+        self.q_view = q_frame
+        self.th = Thread(self, q_frame, q_cmd, self.q_view, ctrl_arr, self.frame_view)
+
+        # 窗口大小改变之后延迟一段时间再通知视频进程
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(200)
+        # 暂停之后一段时间没有新的帧再请求邻近帧。播放时不请求，慢速播放时帧的间隔
+        # 比这更长，请求会占用视频进程正在播放的解码器
+        self.sheet_timer = QTimer(self)
+        self.sheet_timer.setSingleShot(True)
+        self.sheet_timer.setInterval(150)
+        self.latency_timer = QTimer(self)
+        self.latency_timer.setInterval(500)
 
         self.setup_connection()
+        self.send_display_size()
         self.th.start(self.th.Priority.NormalPriority)
+        if playlist_path:
+            self.load_playlist(playlist_path)
 
     def setup_connection(self):
         self.slider.sliderReleased.connect(self.slider_released)
         self.slider.sliderPressed.connect(self.slider_pressed)
+        self.slider.sliderMoved.connect(self.show_preview)
+        self.slider.sliderMoved.connect(self.seek)
+        self.slider.sig_hover.connect(self.show_preview)
+        self.slider.sig_leave.connect(self.preview_label.hide)
         for table in self.annotation_tables.values():
             table.itemDoubleClicked.connect(self.on_double_click_annotation_table_item)
             table.itemChanged.connect(self.on_annotation_table_item_changed)
@@ -510,19 +1112,39 @@ class AnnWindow(QMainWindow):
         self.edit_ann_btn.clicked.connect(self.on_edit_ann_btn_clicked)
         self.check_ann_btn.clicked.connect(self.on_check_ann_btn_clicked)
         self.playrate_combobox.currentTextChanged.connect(self.on_playrate_changed)
+        self.reverse_checkbox.toggled.connect(self.on_reverse_toggled)
+        self.loop_checkbox.toggled.connect(self.on_loop_toggled)
         self.btn_group.buttonClicked.connect(self.on_event_btn_clicked)
 
         self.th.sig_update_frame.connect(self.set_frame)
+        self.frame_view.sig_resized.connect(self.on_frame_view_resized)
+        self.resize_timer.timeout.connect(self.send_display_size)
+        self.full_res_checkbox.toggled.connect(self.send_display_size)
         self.th.sig_open_video.connect(self.on_open_video)
+        self.th.sig_thumbs.connect(self.on_thumbs)
+        self.th.sig_sheet.connect(self.on_sheet)
+        self.latency_timer.timeout.connect(self.update_latency_label)
+        self.sheet_timer.timeout.connect(self.on_sheet_timer)
+        self.sheet_checkbox.toggled.connect(self.on_sheet_toggled)
+        self.keep_time_checkbox.toggled.connect(self.on_keep_time_toggled)
+        self.contact_sheet.sig_clicked.connect(self.seek)
+        self.th.sig_underrun.connect(self.on_underrun)
 
     def _create_image_viewer(self):
         vlayout = QVBoxLayout()
-        self.img_label = QLabel(self)
-        self.img_label.setFixedSize(640, 480)
-        vlayout.addWidget(self.img_label)
-        self.slider = QSlider(Qt.Horizontal)
-        self.slider.setFixedWidth(640)
+        self.frame_view = FrameView(self)
+        self.frame_view.setMinimumSize(640, 480)
+        self.frame_view.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        vlayout.addWidget(self.frame_view)
+        self.slider = FrameSlider(Qt.Horizontal)
         vlayout.addWidget(self.slider)
+        self.filmstrip = Filmstrip()
+        self.contact_sheet = ContactSheet(self)
+        self.contact_sheet.hide()
+        vlayout.addWidget(self.contact_sheet)
+        # 拖动或者悬停在进度条上时显示的缩略图
+        self.preview_label = QLabel(self, Qt.ToolTip)
+        self.preview_label.hide()
 
         button_layout = QHBoxLayout()
 
@@ -541,8 +1163,32 @@ class AnnWindow(QMainWindow):
         combobox_layout.addWidget(self.playrate_combobox)
         button_layout.addLayout(combobox_layout)
 
+        self.reverse_checkbox = QCheckBox("倒放", self)
+        button_layout.addWidget(self.reverse_checkbox)
+
+        self.full_res_checkbox = QCheckBox("原始分辨率", self)
+        button_layout.addWidget(self.full_res_checkbox)
+
         self.breakpoint_btn = QPushButton("断点", self)
         button_layout.addWidget(self.breakpoint_btn)
+
+        self.loop_checkbox = QCheckBox("循环", self)
+        self.loop_checkbox.setToolTip("在当前帧前后的两个断点之间循环播放")
+        button_layout.addWidget(self.loop_checkbox)
+
+        self.keep_time_checkbox = QCheckBox("实时", self)
+        self.keep_time_checkbox.setToolTip(
+            "解码跟不上时跳过来不及显示的帧，保持实际的播放速度，用于复查；"
+            "不勾选时逐帧显示，用于标注"
+        )
+        self.keep_time_checkbox.setChecked(
+            constants.Config.PLAYBACK_DROP_POLICY == "keep-time"
+        )
+        button_layout.addWidget(self.keep_time_checkbox)
+
+        self.sheet_checkbox = QCheckBox("邻近帧", self)
+        self.sheet_checkbox.setToolTip("暂停时显示当前帧前后的帧，点击跳转")
+        button_layout.addWidget(self.sheet_checkbox)
         vlayout.addLayout(button_layout)
         return vlayout
 
@@ -551,6 +1197,8 @@ class AnnWindow(QMainWindow):
         v_layout = QVBoxLayout()
         self.btn_group = QButtonGroup(self)
         self.event_btn_mapping = {}
+        self.btn_styles = {}  # 每个按钮当前的(样式, 是否可用)
+        self.btn_span = None  # (标注版本, lo, hi)，当前帧在[lo, hi)内时按钮不需要更新
         v_layout.setContentsMargins(0, 10, 0, 10)
         v_layout.setSpacing(20)
         for event in event_list:
@@ -558,6 +1206,7 @@ class AnnWindow(QMainWindow):
             button.setStyleSheet(self.btn_idl_stylesheet)
             button.setFixedHeight(40)
             self.event_btn_mapping[event] = button
+            self.btn_styles[event] = (self.btn_idl_stylesheet, True)
             self.btn_group.addButton(button)
             v_layout.addWidget(button)
         v_layout.addStretch()
@@ -574,6 +1223,18 @@ class AnnWindow(QMainWindow):
         open_ann_action.setStatusTip("打开标注文件")
         open_ann_action.triggered.connect(self.view_open_ann)
         toolbar.addAction(open_ann_action)
+        open_playlist_action = QAction("列表", self)
+        open_playlist_action.setStatusTip("打开视频列表，每行一个视频路径")
+        open_playlist_action.triggered.connect(self.view_open_playlist)
+        toolbar.addAction(open_playlist_action)
+        prev_video_action = QAction("上一个", self)
+        prev_video_action.setStatusTip("打开列表中的上一个视频")
+        prev_video_action.triggered.connect(lambda: self.open_playlist_item(-1))
+        toolbar.addAction(prev_video_action)
+        next_video_action = QAction("下一个", self)
+        next_video_action.setStatusTip("打开列表中的下一个视频")
+        next_video_action.triggered.connect(lambda: self.open_playlist_item(1))
+        toolbar.addAction(next_video_action)
 
     def _create_control_panel(self):
         table_width = 300
@@ -679,29 +1340,53 @@ class AnnWindow(QMainWindow):
             self.update_breakpoint_table(self.manager.breakpoints)
 
         if button_update:
-            disabled_events = self.manager.disabled_events()
-            for event, btn in self.event_btn_mapping.items():
-                btn: QPushButton
-                st = self.manager.get_event_btn_state(event)
-                if st == AnnWindowManager.State.IDLE:
-                    btn.setStyleSheet(self.btn_idl_stylesheet)
-                else:
-                    btn.setStyleSheet(self.btn_new_stylesheet)
-                btn.setEnabled(True)
-
-                if event in disabled_events:
-                    btn.setStyleSheet(self.btn_overlap_stylesheet)
-                    btn.setEnabled(False)
+            # 按钮状态可能改变，需要重新计算
+            self.btn_span = None
+            self.update_event_buttons()
 
         # set focus to centralwidget(otherwise the keyboard won't work)
         # TODO: figure out why
         self.centralWidget().setFocus()
 
+    def update_event_buttons(self):
+        """
+        被禁止的事件只在当前帧跨过标注的边界、标注或者按钮状态改变时才会变化，
+        在btn_span范围内不重新计算；setStyleSheet代价较大，只设置有变化的按钮
+        """
+        ann_manager = self.manager.annotation_manager
+        frame_id = self.manager.view_frame_id
+        if self.btn_span is not None:
+            version, lo, hi = self.btn_span
+            if (
+                version == ann_manager.version
+                and (lo is None or lo <= frame_id)
+                and (hi is None or frame_id < hi)
+            ):
+                return
+        self.btn_span = (ann_manager.version, *ann_manager.span(frame_id))
+
+        disabled_events = self.manager.disabled_events()
+        for event, btn in self.event_btn_mapping.items():
+            btn: QPushButton
+            if event in disabled_events:
+                style = (self.btn_overlap_stylesheet, False)
+            elif self.manager.get_event_btn_state(event) == AnnWindowManager.State.IDLE:
+                style = (self.btn_idl_stylesheet, True)
+            else:
+                style = (self.btn_new_stylesheet, True)
+            if self.btn_styles.get(event) != style:
+                btn.setStyleSheet(style[0])
+                btn.setEnabled(style[1])
+                self.btn_styles[event] = style
+
     def pause(self, lag):
         self.q_view.put(Msg(msgtp.VIEW_PAUSE, -1, lag), block=False)
+        # 暂停时可能不再有新的帧，由这里请求邻近帧
+        self.schedule_sheet(force=True)
 
     def toggle(self):
         self.q_view.put(Msg(msgtp.VIEW_TOGGLE, -1, None), block=False)
+        self.schedule_sheet(force=True)
 
     def play(self):
         self.q_view.put(Msg(msgtp.VIEW_PLAY, -1, None), block=False)
@@ -720,6 +1405,50 @@ class AnnWindow(QMainWindow):
             return
         self.q_view.put(Msg(msgtp.VIEW_OPEN, -1, img_path), block=False)
 
+    @Slot()
+    def view_open_playlist(self):
+        list_path, _ = QFileDialog.getOpenFileName()
+        if not list_path:
+            return
+        self.load_playlist(list_path)
+
+    def load_playlist(self, list_path):
+        try:
+            playlist = Playlist.from_file(list_path)
+        except (OSError, UnicodeDecodeError):
+            self.status_bar.showMessage(f"无法读取视频列表 {list_path}")
+            return
+        if len(playlist) == 0:
+            self.status_bar.showMessage("视频列表为空")
+            return
+        self.playlist = playlist
+        self.open_playlist_item(1)
+
+    def open_playlist_item(self, offset):
+        """
+        打开列表中当前视频之后(offset>0)或之前(offset<0)的视频
+        """
+        if self.playlist is None:
+            return
+        path = self.playlist.peek(offset)
+        if path is None:
+            self.status_bar.showMessage("已经是列表中的第一个或最后一个视频")
+            return
+        if self.show_save_dialog() < 0:
+            return
+        self.playlist.index += offset
+        self.q_view.put(Msg(msgtp.VIEW_OPEN, -1, path), block=False)
+
+    def prefetch_next_video(self, video_meta: VideoMetaData):
+        """
+        标注列表中的视频时，让视频进程空闲时预先打开下一个视频
+        """
+        if self.playlist is None or video_meta.path != self.playlist.current():
+            return
+        path = self.playlist.peek(1)
+        if path is not None:
+            self.q_view.put(Msg(msgtp.VIEW_PREFETCH, -1, path), block=False)
+
     @Slot()
     def view_open_ann(self):
         ann_path, _ = QFileDialog.getOpenFileName()
@@ -756,14 +1485,45 @@ class AnnWindow(QMainWindow):
         if rate >= 1:
             rate = int(rate)
         self.manager.playrate = rate
+        self.send_playrate()
+
+    @Slot(bool)
+    def on_reverse_toggled(self, checked):
+        if not self.manager.valid():
+            return
+        self.manager.reverse = checked
+        self.send_playrate()
+
+    @Slot(int, int)
+    def on_frame_view_resized(self, width, height):
+        self.resize_timer.start()
+
+    @Slot()
+    def send_display_size(self):
+        size = self.frame_view.size()
+        full_resolution = self.full_res_checkbox.isChecked()
+        self.q_view.put(
+            Msg(msgtp.VIEW_RESIZE, -1, (size.width(), size.height(), full_resolution)),
+            block=False,
+        )
+
+    def send_playrate(self):
+        rate = self.manager.playrate
+        if self.manager.reverse:
+            rate = -rate
         self.q_view.put(Msg(msgtp.VIEW_PLAYRATE, -1, rate), block=False)
 
-    @Slot(int, QImage)
-    def set_frame(self, frame_id, image):
+    @Slot(int, QImage, object)
+    def set_frame(self, frame_id, image, slot):
+        if not self.frame_view.set_frame(image, slot):
+            return
         self.manager.view_frame_id = frame_id
-        self.slider.setValue(frame_id)
-        self.img_label.setPixmap(QPixmap.fromImage(image))
-        self.view_update_by_manager(button_update=True)
+        # 拖动时进度条的位置由鼠标决定
+        if not self.slider.isSliderDown():
+            self.slider.setValue(frame_id)
+        self.schedule_sheet()
+        self.view_update_by_manager()
+        self.update_event_buttons()
 
     @Slot()
     def slider_pressed(self):
@@ -771,9 +1531,106 @@ class AnnWindow(QMainWindow):
 
     @Slot()
     def slider_released(self):
+        self.preview_label.hide()
         self.seek(self.slider.value())
         self.pause(lag=True)
 
+    LATENCY_STAGE_NAMES = {
+        "decode": "解码",
+        "ring": "排队",
+        "relay": "转发",
+        "buffer": "缓冲",
+        "paint": "绘制",
+        "total": "总计",
+    }
+
+    def toggle_latency_overlay(self):
+        visible = self.latency_label.isHidden()
+        self.latency_label.setVisible(visible)
+        self.th.latency.set_enabled(visible)
+        if visible:
+            self.update_latency_label()
+            self.latency_timer.start()
+        else:
+            self.latency_timer.stop()
+
+    @Slot()
+    def update_latency_label(self):
+        """
+        各阶段耗时的p50/p95/p99(毫秒)，缓冲和共享内存的占用，丢帧和迟到的帧数
+        """
+        stats = self.th.latency
+        parts = []
+        for stage, p in stats.summary().items():
+            if p is not None:
+                name = self.LATENCY_STAGE_NAMES[stage]
+                parts.append(f"{name} {p[0]:.1f}/{p[1]:.1f}/{p[2]:.1f}")
+        buffered, cap, backlog = stats.occupancy
+        parts.append(f"占用 {buffered}/{cap} 环 {backlog}")
+        parts.append(f"丢帧 {stats.dropped} 跳帧 {stats.skipped} 迟到 {stats.late}")
+        self.latency_label.setText(" | ".join(parts))
+
+    @Slot(int)
+    def on_underrun(self, count):
+        self.underrun_label.setText(f"卡顿: {count}")
+
+    @Slot(bool)
+    def on_keep_time_toggled(self, checked):
+        policy = "keep-time" if checked else "keep-all"
+        self.q_view.put(Msg(msgtp.VIEW_DROP_POLICY, -1, policy), block=False)
+        self.centralWidget().setFocus()
+
+    @Slot(bool)
+    def on_sheet_toggled(self, checked):
+        self.contact_sheet.setVisible(checked)
+        if checked:
+            self.request_sheet()
+
+    def schedule_sheet(self, force=False):
+        """
+        Thread已经暂停(拖动进度条时也是暂停的)或force时重新计时，计时结束时仍然暂停才请求
+        """
+        if self.sheet_checkbox.isChecked() and (force or self.th.paused):
+            self.sheet_timer.start()
+
+    @Slot()
+    def on_sheet_timer(self):
+        if self.th.paused:
+            self.request_sheet()
+
+    @Slot()
+    def request_sheet(self):
+        if self.manager.valid() and self.sheet_checkbox.isChecked():
+            self.q_view.put(
+                Msg(msgtp.VIEW_SHEET, -1, self.manager.view_frame_id), block=False
+            )
+
+    @Slot(int, list, object)
+    def on_sheet(self, center, frame_ids, images):
+        # 已经跳到别的帧时，等新的请求
+        if center == self.manager.view_frame_id:
+            self.contact_sheet.set_frames(center, frame_ids, images)
+
+    @Slot(list, object)
+    def on_thumbs(self, frame_ids, images):
+        self.filmstrip.add(frame_ids, images)
+
+    @Slot(int)
+    def show_preview(self, frame_id):
+        thumb = self.filmstrip.nearest(frame_id)
+        if thumb is None:
+            return
+        image = thumb[1]
+        h, w, ch = image.shape
+        img = QImage(image.data, w, h, ch * w, QImage.Format_BGR888)
+        self.preview_label.setPixmap(QPixmap.fromImage(img))
+        self.preview_label.adjustSize()
+        # 显示在鼠标位置的进度条上方
+        x = QCursor.pos().x() - w // 2
+        y = self.slider.mapToGlobal(QPoint(0, 0)).y() - h - 8
+        self.preview_label.move(x, y)
+        self.preview_label.show()
+
     def slider_change_config(self, total):
         self.slider.setMaximum(total)
 
@@ -803,10 +1660,15 @@ class AnnWindow(QMainWindow):
 
     @Slot(VideoMetaData)
     def on_open_video(self, video_meta: VideoMetaData):
+        self.filmstrip.clear()
+        self.contact_sheet.clear()
         self.manager.open(video_meta)
         self.slider_change_config(video_meta.total_frames - 1)
         self.playrate_combobox.setCurrentText("1")
+        self.reverse_checkbox.setChecked(False)
+        self.loop_checkbox.setChecked(False)
         self.view_update_by_manager(ann_update=True, button_update=True)
+        self.prefetch_next_video(video_meta)
 
     @Slot(QTableWidgetItem)
     def on_double_click_annotation_table_item(self, item: QTableWidgetItem):
@@ -882,6 +1744,19 @@ class AnnWindow(QMainWindow):
             self.manager.add_breakpoint(self.manager.view_frame_id)
             self.view_update_by_manager(breakpoint_update=True)
 
+    @Slot(bool)
+    def on_loop_toggled(self, checked):
+        loop = None
+        if checked:
+            loop = self.manager.loop_range() if self.manager.valid() else None
+            if loop is None:
+                self.status_bar.showMessage("需要至少两个断点才能循环播放", 3000)
+                self.loop_checkbox.blockSignals(True)
+                self.loop_checkbox.setChecked(False)
+                self.loop_checkbox.blockSignals(False)
+                return
+        self.q_view.put(Msg(msgtp.VIEW_LOOP, -1, loop), block=False)
+
     @Slot()
     def on_sort_ann_btn_clicked(self):
         if self.manager.valid():
@@ -951,6 +1826,15 @@ class AnnWindow(QMainWindow):
                 cnt_frames = constants.Config.FRAME_PER_FORWARD
             self.navigate_forward(cnt_frames)
 
+        elif event.key() == Qt.Key.Key_R:
+            self.reverse_checkbox.toggle()
+
+        elif event.key() == Qt.Key.Key_L:
+            self.loop_checkbox.toggle()
+
+        elif event.key() == Qt.Key.Key_F3:
+            self.toggle_latency_overlay()
+
         elif event.key() >= Qt.Key.Key_1 and event.key() <= Qt.Key.Key_9:
             index = event.key() - Qt.Key.Key_1
             if index < len(self.playrates):